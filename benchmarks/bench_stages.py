@@ -0,0 +1,240 @@
+"""
+Time each stage of expand_clinvar_vcf on synthetic releases written by
+generate_clinvar.py, and save or compare a JSON baseline
+
+    python benchmarks/bench_stages.py --records 10000 100000 --json base.json
+    (change the code)
+    python benchmarks/bench_stages.py --records 10000 100000 --compare base.json
+
+Each release and VCF format is run in a fresh process so that the peak
+memory of one case does not hide that of the next.
+"""
+import argparse
+import json
+import os
+import platform
+import subprocess
+import sys
+import tempfile
+import time
+from datetime import datetime
+
+from generate_clinvar import generate
+
+from clinvar_vcf.clinvar_vcf_parser import (
+    XML_ENGINES,
+    append_info,
+    mine_xml,
+    read_vcf,
+    split_multi_vcf,
+    split_vcf_info,
+    write_vcf_header)
+
+# slower than the baseline by more than this factor is reported as a
+# regression by --compare, for stages taking at least MIN_SECONDS
+REGRESSION_FACTOR = 1.2
+MIN_SECONDS = 0.1
+
+
+def peak_rss_mb():
+    """
+    Peak resident set size of the current process in MB, or None where it
+    is not available (Windows)
+    """
+    try:
+        import resource  # Unix only
+    except ImportError:
+        return None
+    peak = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    if sys.platform == 'darwin':  # bytes on macOS, kB elsewhere
+        peak /= 1024
+    return round(peak / 1024, 1)
+
+
+def run_case(xml_file, vcf_file, pre_may_2017=False, workers=1,
+             engine='etree'):
+    """
+    Run the stages of expand_clinvar_vcf one after the other
+
+    Returns:
+        dictionary of {stage: {seconds, records, records_per_s,
+            peak_rss_mb}}
+    """
+    stages = {}
+
+    def record(stage, start, n):
+        seconds = time.perf_counter() - start
+        stages[stage] = {'seconds': round(seconds, 3), 'records': n,
+                         'records_per_s': round(n / seconds) if seconds else 0,
+                         'peak_rss_mb': peak_rss_mb()}
+
+    start = time.perf_counter()
+    header, vcf_df = read_vcf(vcf_file)
+    record('read_vcf', start, len(vcf_df))
+
+    start = time.perf_counter()
+    if pre_may_2017:
+        vcf_df = split_multi_vcf(vcf_df)
+        id_dict = split_vcf_info(vcf_df)
+    else:
+        id_dict = dict(zip(vcf_df['ID'], [{x} for x in vcf_df.index]))
+    record('lookup', start, len(vcf_df))
+
+    with open(xml_file, 'rb') as f:
+        n_sets = sum(1 for line in f if line.startswith(b'<ClinVarSet '))
+    start = time.perf_counter()
+    xml_dict = mine_xml(xml_file, id_dict, pre_may_2017=pre_may_2017,
+                        workers=workers, engine=engine)
+    record('mine_xml', start, n_sets)
+
+    start = time.perf_counter()
+    vcf_df = append_info(vcf_df, xml_dict)
+    record('join_entries', start, len(xml_dict))
+
+    with tempfile.TemporaryDirectory() as tempdir:
+        out_file = os.path.join(tempdir, 'annotated.vcf')
+        start = time.perf_counter()
+        write_vcf_header(header, out_file)
+        vcf_df.to_csv(out_file, mode='a', index=False, sep='\t',
+                      header=True)
+        record('output', start, len(vcf_df))
+    return stages
+
+
+def git_commit():
+    """
+    Return the commit of the working tree, if it is a git checkout
+    """
+    try:
+        return subprocess.run(
+            ['git', 'rev-parse', '--short', 'HEAD'], capture_output=True,
+            text=True, check=True,
+            cwd=os.path.dirname(os.path.abspath(__file__))).stdout.strip()
+    except (OSError, subprocess.CalledProcessError):
+        return None
+
+
+def compare(results, baseline):
+    """
+    Print the time of each stage relative to the baseline
+
+    Returns:
+        number of stages slower than REGRESSION_FACTOR times the baseline
+    """
+    old_cases = {(c['records'], c['format']): c for c in baseline['cases']}
+    regressions = 0
+    for case in results['cases']:
+        old = old_cases.get((case['records'], case['format']))
+        if old is None:
+            continue
+        print(f'{case["records"]} records, {case["format"]} '
+              f'(baseline {baseline["meta"].get("commit")}):')
+        for stage, new_stats in case['stages'].items():
+            old_stats = old['stages'].get(stage)
+            if not old_stats or not old_stats['seconds']:
+                continue
+            ratio = new_stats['seconds'] / old_stats['seconds']
+            flag = ''
+            if (ratio > REGRESSION_FACTOR
+                    and new_stats['seconds'] >= MIN_SECONDS):
+                flag = '  <-- slower'
+                regressions += 1
+            print(f'  {stage:13} {old_stats["seconds"]:9.3f}s -> '
+                  f'{new_stats["seconds"]:9.3f}s  x{ratio:.2f}  '
+                  f'peak {old_stats["peak_rss_mb"]} -> '
+                  f'{new_stats["peak_rss_mb"]} MB{flag}')
+    return regressions
+
+
+def main():
+    """
+    Parse the command-line, run the cases and report
+    """
+    parser = argparse.ArgumentParser(
+        description=__doc__, formatter_class=argparse.RawTextHelpFormatter)
+    parser.add_argument('--records', type=int, nargs='+', default=[10000],
+                        help='Release sizes in ClinVarSet records '
+                             '(default: %(default)s)')
+    parser.add_argument('--formats', nargs='+', default=['current', 'pre2017'],
+                        choices=['current', 'pre2017'])
+    parser.add_argument('--data-dir', default=None,
+                        help='Where the synthetic releases are written and '
+                             'reused (default: a temporary directory)')
+    parser.add_argument('--seed', type=int, default=1)
+    parser.add_argument('--repeat', type=int, default=1,
+                        help='Run each case this many times and keep the '
+                             'fastest time of each stage')
+    parser.add_argument('--workers', type=int, default=1)
+    parser.add_argument('--xml-engine', choices=XML_ENGINES, default='etree')
+    parser.add_argument('--json', help='Write the results to this file')
+    parser.add_argument('--compare',
+                        help='Baseline JSON file to compare the results with')
+    parser.add_argument('--case', nargs=3, help=argparse.SUPPRESS)
+    args = parser.parse_args()
+
+    if args.case:  # child process: run one case and print its stages
+        xml_file, vcf_file, fmt = args.case
+        print(json.dumps(run_case(xml_file, vcf_file,
+                                  pre_may_2017=fmt == 'pre2017',
+                                  workers=args.workers,
+                                  engine=args.xml_engine)))
+        return
+
+    with tempfile.TemporaryDirectory() as tempdir:
+        data_dir = args.data_dir or tempdir
+        cases = []
+        for n in args.records:
+            xml_file, vcf_file, pre2017_file = (
+                os.path.join(data_dir, f'clinvar_{n}{suffix}')
+                for suffix in ('.xml', '.vcf', '_pre2017.vcf'))
+            if not all(os.path.exists(f)
+                       for f in (xml_file, vcf_file, pre2017_file)):
+                print(f'Generating {n} records in {data_dir}',
+                      file=sys.stderr)
+                generate(n, data_dir, seed=args.seed)
+            for fmt in args.formats:
+                case_vcf = pre2017_file if fmt == 'pre2017' else vcf_file
+                stages = {}
+                for _ in range(args.repeat):
+                    child = subprocess.run(
+                        [sys.executable, __file__, '--case', xml_file,
+                         case_vcf, fmt, '--workers', str(args.workers),
+                         '--xml-engine', args.xml_engine],
+                        capture_output=True, text=True, check=True)
+                    for stage, run in json.loads(
+                            child.stdout.splitlines()[-1]).items():
+                        if (stage not in stages
+                                or run['seconds'] < stages[stage]['seconds']):
+                            stages[stage] = run
+                cases.append({
+                    'records': n, 'format': fmt, 'stages': stages,
+                    'total_seconds': round(sum(
+                        s['seconds'] for s in stages.values()), 3),
+                    'peak_rss_mb': max(
+                        (s['peak_rss_mb'] for s in stages.values()
+                         if s['peak_rss_mb'] is not None), default=None)})
+                print(f'{n} records, {fmt}: '
+                      + ', '.join(f'{stage} {s["seconds"]}s'
+                                  for stage, s in stages.items())
+                      + f' (peak {cases[-1]["peak_rss_mb"]} MB)')
+
+    results = {
+        'meta': {'commit': git_commit(),
+                 'date': datetime.now().isoformat(timespec='seconds'),
+                 'python': platform.python_version(),
+                 'machine': platform.machine(), 'cpus': os.cpu_count(),
+                 'seed': args.seed, 'repeat': args.repeat,
+                 'workers': args.workers,
+                 'xml_engine': args.xml_engine},
+        'cases': cases,
+    }
+    if args.json:
+        with open(args.json, 'w') as f:
+            json.dump(results, f, indent=2)
+    if args.compare:
+        with open(args.compare) as f:
+            sys.exit(1 if compare(results, json.load(f)) else 0)
+
+
+if __name__ == '__main__':
+    main()
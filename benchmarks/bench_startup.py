@@ -0,0 +1,98 @@
+"""
+Time the start-up of the clinvar_vcf_parser command (python -m
+clinvar_vcf.clinvar_vcf_parser --help) and list the slowest imports, and
+save or compare a JSON baseline
+
+    python benchmarks/bench_startup.py --json startup.json
+    (change the code)
+    python benchmarks/bench_startup.py --compare startup.json
+
+The command does not need pandas, so it should start in well under the
+time it takes to import pandas.
+"""
+import argparse
+import json
+import statistics
+import subprocess
+import sys
+import time
+
+COMMAND = [sys.executable, '-m', 'clinvar_vcf.clinvar_vcf_parser', '--help']
+
+# slower than the baseline by more than this factor is reported as a
+# regression by --compare, or if it imports one of HEAVY_MODULES
+REGRESSION_FACTOR = 1.5
+HEAVY_MODULES = ('pandas', 'numpy', 'pyarrow', 'lxml')
+
+
+def command_imports():
+    """
+    Return [(module, cumulative microseconds)] of the imports of the
+    command, slowest first, from python -X importtime
+    """
+    child = subprocess.run(
+        [sys.executable, '-X', 'importtime', *COMMAND[1:]],
+        capture_output=True, text=True, check=True)
+    imports = []
+    for line in child.stderr.splitlines():
+        if not line.startswith('import time:') or 'cumulative' in line:
+            continue
+        _, cumulative, module = line.split('|')
+        imports.append((module.strip(), int(cumulative)))
+    return sorted(imports, key=lambda x: -x[1])
+
+
+def time_command(repeat):
+    """
+    Return the median wall time in seconds of the command over repeat runs
+    """
+    times = []
+    for _ in range(repeat):
+        start = time.perf_counter()
+        subprocess.run(COMMAND, capture_output=True, check=True)
+        times.append(time.perf_counter() - start)
+    return statistics.median(times)
+
+
+def main():
+    """
+    Parse the command-line, time the command and report
+    """
+    parser = argparse.ArgumentParser(
+        description=__doc__, formatter_class=argparse.RawTextHelpFormatter)
+    parser.add_argument('--repeat', type=int, default=20,
+                        help='Number of runs, the median is kept '
+                             '(default: %(default)s)')
+    parser.add_argument('--json', help='Write the results to this file')
+    parser.add_argument('--compare',
+                        help='Baseline JSON file to compare the results with')
+    args = parser.parse_args()
+
+    imports = command_imports()
+    results = {'seconds': round(time_command(args.repeat), 4),
+               'imports': imports[:10],
+               'heavy_modules': sorted(
+                   {module.split('.')[0] for module, _ in imports}
+                   & set(HEAVY_MODULES))}
+    print(f'{" ".join(COMMAND[1:])}: {results["seconds"]}s (median of '
+          f'{args.repeat})')
+    for module, microseconds in results['imports']:
+        print(f'  {module:40} {microseconds / 1000:8.1f} ms')
+    if args.json:
+        with open(args.json, 'w') as f:
+            json.dump(results, f, indent=2)
+    if args.compare:
+        with open(args.compare) as f:
+            baseline = json.load(f)
+        ratio = results['seconds'] / baseline['seconds']
+        print(f'baseline {baseline["seconds"]}s -> {results["seconds"]}s '
+              f'x{ratio:.2f}')
+        if results['heavy_modules']:
+            print(f'imports {", ".join(results["heavy_modules"])}  '
+                  '<-- slower')
+        if ratio > REGRESSION_FACTOR or results['heavy_modules']:
+            sys.exit(1)
+
+
+if __name__ == '__main__':
+    main()
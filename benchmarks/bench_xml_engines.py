@@ -0,0 +1,58 @@
+"""
+Compare the throughput of the XML parser backends (--xml-engine) on the same
+ClinVar XML file
+"""
+import argparse
+import time
+
+from clinvar_vcf.clinvar_vcf_parser import (
+    ALL_KEYS,
+    XML_ENGINES,
+    mine_xml_sequential)
+
+
+def bench_engine(xml_file, engine, pre_may_2017=False):
+    """
+    Mine every record of xml_file with engine
+
+    Returns:
+        (number of ClinVarSet records, seconds, matches)
+    """
+    start = time.perf_counter()
+    n = 0
+    matches = []
+    for n_processed, records in mine_xml_sequential(
+            xml_file, ALL_KEYS, pre_may_2017=pre_may_2017, engine=engine):
+        n += n_processed
+        matches.extend(records)
+    return n, time.perf_counter() - start, matches
+
+
+def main():
+    """
+    Parse the command-line and print one line per engine
+    """
+    parser = argparse.ArgumentParser(description=__doc__)
+    parser.add_argument('xml', help='ClinVar XML file (can be .gz)')
+    parser.add_argument('--engines', nargs='+', choices=XML_ENGINES,
+                        default=list(XML_ENGINES))
+    parser.add_argument('--pre-may-2017', action='store_true', default=False)
+    args = parser.parse_args()
+
+    reference = None
+    for engine in args.engines:
+        try:
+            n, seconds, matches = bench_engine(args.xml, engine,
+                                               args.pre_may_2017)
+        except ImportError as e:
+            print(f'{engine:6} unavailable: {e}')
+            continue
+        if reference is None:
+            reference = matches
+        same = 'same' if matches == reference else 'DIFFERENT'
+        print(f'{engine:6} {n} records in {seconds:.2f}s '
+              f'({n / seconds:.0f} records/s, annotations {same})')
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,274 @@
+"""
+Generate a synthetic ClinVar release: a full-release XML file and matching
+VCF files in the current (ID column) and pre-May-2017 (CLNACC) formats.
+
+The output only depends on the number of records and the seed, so benchmark
+runs on different commits read the same data.
+"""
+import argparse
+import gzip
+import os
+import random
+
+XML_HEADER = (
+    '<?xml version="1.0" encoding="UTF-8" standalone="yes"?>\n'
+    '<ReleaseSet Dated="2021-03-02" Type="full">\n')
+XML_FOOTER = '</ReleaseSet>\n'
+
+CLINVAR_SET = '''\
+<ClinVarSet ID="{set_id}">
+  <RecordStatus>current</RecordStatus>
+  <Title>{hgvs} AND {trait}</Title>
+  <ReferenceClinVarAssertion DateCreated="{created}" DateLastUpdated="{updated}" ID="{rcva_id}">
+    <ClinVarAccession Acc="{rcv}" Version="{version}" Type="RCV" DateUpdated="{updated}"/>
+    <RecordStatus>current</RecordStatus>
+    <ClinicalSignificance DateLastEvaluated="{evaluated}">
+      <ReviewStatus>{status}</ReviewStatus>
+      <Description>{significance}</Description>
+    </ClinicalSignificance>
+    <Assertion Type="variation to disease"/>
+    <MeasureSet Type="Variant" ID="{ms_id}" Acc="VCV{ms_id:09d}" Version="1">
+      <Measure Type="single nucleotide variant" ID="{allele_id}">
+        <Name>
+          <ElementValue Type="Preferred">{hgvs}</ElementValue>
+        </Name>
+        <SequenceLocation Assembly="GRCh37" Chr="{chrom}" start="{pos}" stop="{pos}" positionVCF="{pos}" referenceAlleleVCF="{ref}" alternateAlleleVCF="{alt}"/>
+      </Measure>
+    </MeasureSet>
+    <TraitSet Type="Disease" ID="{trait_set_id}">
+      <Trait ID="{trait_id}" Type="Disease">
+        <Name>
+          <ElementValue Type="Preferred">{trait}</ElementValue>
+        </Name>
+        <XRef ID="CN{trait_id}" DB="MedGen"/>
+      </Trait>
+    </TraitSet>
+  </ReferenceClinVarAssertion>
+{assertions}</ClinVarSet>
+'''
+
+CLINVAR_ASSERTION = '''\
+  <ClinVarAssertion ID="{cva_id}" SubmissionName="SUB{cva_id}">
+    <ClinVarSubmissionID localKey="{cva_id}|MedGen:CN{trait_id}" submitter="{submitter}" submitterDate="{submitted}"/>
+    <ClinVarAccession Acc="SCV{cva_id:09d}" Version="1" Type="SCV" OrgID="{org_id}" DateUpdated="{submitted}"/>
+    <RecordStatus>current</RecordStatus>
+    <ClinicalSignificance DateLastEvaluated="{evaluated}">
+      <ReviewStatus>{status}</ReviewStatus>
+      <Description>{significance}</Description>{comment}
+    </ClinicalSignificance>
+    <Assertion Type="variation to disease"/>
+    <ObservedIn>
+      <Sample>
+        <Origin>{origin}</Origin>
+        <Species TaxonomyId="9606">human</Species>
+        <AffectedStatus>unknown</AffectedStatus>
+      </Sample>
+      <Method>
+        <MethodType>clinical testing</MethodType>
+      </Method>
+    </ObservedIn>
+    <MeasureSet Type="Variant">
+      <Measure Type="Variation">
+        <AttributeSet>
+          <Attribute Type="HGVS">{hgvs}</Attribute>
+        </AttributeSet>
+      </Measure>
+    </MeasureSet>
+    <TraitSet Type="Disease">
+      <Trait Type="Disease">
+        <Name>
+          <ElementValue Type="Preferred">{trait}</ElementValue>
+        </Name>
+      </Trait>
+    </TraitSet>
+  </ClinVarAssertion>
+'''
+
+VCF_HEADER = '''\
+##fileformat=VCFv4.1
+##fileDate={date}
+##source=ClinVar (synthetic)
+##reference=GRCh37
+##INFO=<ID=ALLELEID,Number=1,Type=Integer,Description="the ClinVar Allele ID">
+##INFO=<ID=CLNSIG,Number=.,Type=String,Description="Clinical significance for this single variant">
+##INFO=<ID=CLNALLE,Number=.,Type=Integer,Description="Variant alleles from REF or ALT columns">
+##INFO=<ID=CLNACC,Number=.,Type=String,Description="Variant Accession and Versions">
+#CHROM\tPOS\tID\tREF\tALT\tQUAL\tFILTER\tINFO
+'''
+
+SIGNIFICANCES = ['Pathogenic', 'Likely pathogenic', 'Uncertain significance',
+                 'Likely benign', 'Benign',
+                 'Conflicting interpretations of pathogenicity']
+STATUSES = ['criteria provided, single submitter',
+            'criteria provided, multiple submitters, no conflicts',
+            'no assertion criteria provided', 'reviewed by expert panel']
+ORIGINS = ['germline', 'germline', 'germline', 'somatic', 'unknown',
+           'not provided']
+BASES = 'ACGT'
+WORDS = ('variant', 'observed', 'individuals', 'affected', 'segregates',
+         'disease', 'functional', 'studies', 'protein', 'frequency',
+         'population', 'databases', 'reported', 'literature', 'evidence',
+         'insufficient', 'classified', 'missense', 'conserved', 'residue')
+
+
+def make_pools(rng):
+    """
+    Return the submitter and trait name pools; real releases repeat a few
+    thousand names over millions of submissions
+    """
+    submitters = [f'Laboratory {i} ({rng.choice(WORDS).title()} Genetics)'
+                  for i in range(300)]
+    traits = [f'{rng.choice(WORDS).title()} syndrome type {i}'
+              for i in range(2000)] + ['not provided', 'not specified']
+    return submitters, traits
+
+
+def n_submissions(rng):
+    """
+    Number of SCVs of a ClinVarSet: mostly one, sometimes many
+    """
+    x = rng.random()
+    if x < 0.6:
+        return 1
+    if x < 0.85:
+        return 2
+    if x < 0.95:
+        return 3
+    return rng.randint(4, 12)
+
+
+def random_date(rng):
+    """
+    Return a YYYY-MM-DD date
+    """
+    return (f'{rng.randint(2012, 2021)}-{rng.randint(1, 12):02d}-'
+            f'{rng.randint(1, 28):02d}')
+
+
+def generate(n_records, out_dir, seed=1, multiallelic=0.1, unmatched=0.05,
+             compress=False):
+    """
+    Write clinvar_<n>.xml[.gz], clinvar_<n>.vcf and clinvar_<n>_pre2017.vcf
+
+    Args:
+        n_records: number of ClinVarSet records
+        out_dir: output directory
+        seed: random seed
+        multiallelic: fraction of pre-May-2017 VCF records with several ALT
+            alleles
+        unmatched: fraction of VCF records that are not in the XML file
+        compress: gzip the XML file
+    Returns:
+        (xml_file, vcf_file, pre2017_vcf_file)
+    """
+    rng = random.Random(seed)
+    submitters, traits = make_pools(rng)
+    os.makedirs(out_dir, exist_ok=True)
+    xml_file = os.path.join(out_dir, f'clinvar_{n_records}.xml')
+    if compress:
+        xml_file += '.gz'
+    vcf_file = os.path.join(out_dir, f'clinvar_{n_records}.vcf')
+    pre2017_file = os.path.join(out_dir, f'clinvar_{n_records}_pre2017.vcf')
+
+    opener = gzip.open if compress else open
+    cva_id = 1
+    pos = 10000
+    chrom = 1
+    pre2017_alleles = []  # (ALT, RCV) of the current pre-May-2017 record
+    with opener(xml_file, 'wt') as xml, open(vcf_file, 'w') as vcf, \
+            open(pre2017_file, 'w') as pre2017:
+        xml.write(XML_HEADER)
+        vcf.write(VCF_HEADER.format(date='2021-03-02'))
+        pre2017.write(VCF_HEADER.format(date='20170404'))
+        for i in range(n_records):
+            if i and i % (n_records // 22 + 1) == 0:
+                chrom += 1
+                pos = 10000
+            pos += rng.randint(1, 500)
+            ref = rng.choice(BASES)
+            alt = rng.choice(BASES.replace(ref, ''))
+            ms_id = 100000 + i
+            rcv = f'RCV{i + 1:09d}'
+            trait_id = rng.randrange(len(traits))
+            fields = {
+                'set_id': 50000000 + i, 'rcva_id': 2000000 + i,
+                'rcv': rcv, 'version': rng.randint(1, 5),
+                'created': random_date(rng), 'updated': random_date(rng),
+                'evaluated': random_date(rng),
+                'status': rng.choice(STATUSES),
+                'significance': rng.choice(SIGNIFICANCES),
+                'ms_id': ms_id, 'allele_id': 800000 + i,
+                'hgvs': f'NC_0000{chrom:02d}.10:g.{pos}{ref}&gt;{alt}',
+                'chrom': chrom, 'pos': pos, 'ref': ref, 'alt': alt,
+                'trait': traits[trait_id], 'trait_id': trait_id,
+                'trait_set_id': 9000 + trait_id,
+            }
+            assertions = []
+            for _ in range(n_submissions(rng)):
+                comment = ''
+                if rng.random() < 0.3:
+                    comment = '\n      <Comment>{}.</Comment>'.format(
+                        ' '.join(rng.choice(WORDS)
+                                 for _ in range(rng.randint(5, 80))))
+                assertions.append(CLINVAR_ASSERTION.format(
+                    cva_id=cva_id, trait_id=trait_id,
+                    submitter=rng.choice(submitters),
+                    submitted=random_date(rng), org_id=rng.randint(1, 500000),
+                    evaluated=random_date(rng), status=rng.choice(STATUSES),
+                    significance=rng.choice(SIGNIFICANCES), comment=comment,
+                    origin=rng.choice(ORIGINS), hgvs=fields['hgvs'],
+                    trait=fields['trait']))
+                cva_id += 1
+            xml.write(CLINVAR_SET.format(assertions=''.join(assertions),
+                                         **fields))
+
+            info = (f'ALLELEID={800000 + i};'
+                    f'CLNSIG={fields["significance"].replace(" ", "_")}')
+            variant_id = ms_id if rng.random() >= unmatched else 90000000 + i
+            vcf.write(f'{chrom}\t{pos}\t{variant_id}\t{ref}\t{alt}\t.\t.\t'
+                      f'{info}\n')
+
+            # pre-May-2017 records group the RCVs of up to three ALT alleles
+            if variant_id != ms_id:
+                rcv = f'RCV{900000000 + i:09d}'
+            pre2017_alleles.append((alt, rcv))
+            if len(pre2017_alleles) < 3 and rng.random() < multiallelic:
+                continue
+            alts = []
+            for allele_alt, _ in pre2017_alleles:
+                while allele_alt in alts or allele_alt == ref:
+                    allele_alt = ref + allele_alt
+                alts.append(allele_alt)
+            rcvs = [f'{allele_rcv}.1' for _, allele_rcv in pre2017_alleles]
+            clnalle = ','.join(str(n + 1) for n in range(len(alts)))
+            clnsig = ','.join(str(rng.choice([2, 3, 5, 255])) for _ in alts)
+            pre2017.write(
+                f'{chrom}\t{pos}\trs{ms_id}\t{ref}\t{",".join(alts)}\t.\t.\t'
+                f'RS={ms_id};CLNALLE={clnalle};CLNSIG={clnsig};'
+                f'CLNACC={",".join(rcvs)}\n')
+            pre2017_alleles = []
+        xml.write(XML_FOOTER)
+    return xml_file, vcf_file, pre2017_file
+
+
+def main():
+    """
+    Parse the command-line and write the files
+    """
+    parser = argparse.ArgumentParser(description=__doc__)
+    parser.add_argument('records', type=int, nargs='+',
+                        help='Number of ClinVarSet records, one release per '
+                             'value (e.g. 10000 100000 1000000)')
+    parser.add_argument('-o', '--out-dir', default='.')
+    parser.add_argument('--seed', type=int, default=1)
+    parser.add_argument('--gzip', action='store_true', default=False,
+                        help='gzip the XML file')
+    args = parser.parse_args()
+    for n in args.records:
+        for fname in generate(n, args.out_dir, seed=args.seed,
+                              compress=args.gzip):
+            print(fname)
+
+
+if __name__ == '__main__':
+    main()
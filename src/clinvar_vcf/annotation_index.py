@@ -0,0 +1,305 @@
+"""
+On-disk index of the xml-derived INFO fields, keyed by MeasureSet ID and RCV
+accession, so the ClinVar XML only needs to be mined once per release
+"""
+import hashlib
+import json
+import logging
+import os
+import re
+import sqlite3
+from datetime import datetime
+
+from clinvar_vcf.clinvar_vcf_parser import (
+    ALL_KEYS,
+    INFO_FIELDS,
+    get_handle,
+    imap_xml_chunks,
+    iter_clinvar_set_chunks,
+    mine_clinvar_set,
+    scan_key_id,
+    split_clinvar_sets)
+
+INDEX_FORMAT_VERSION = '2'
+SQLITE_MAGIC = b'SQLite format 3\x00'
+
+# start tags whose attributes change when a record is updated: the
+# DateLastUpdated of the ReferenceClinVarAssertion, the Version and
+# DateUpdated of each RCV/SCV accession, and the submission dates
+STAMP_TAGS = re.compile(
+    rb'<(?:ReferenceClinVarAssertion|ClinVarAccession|ClinVarSubmissionID'
+    rb'|MeasureSet)[\s/>][^>]*')
+
+SCHEMA = """
+CREATE TABLE meta (key TEXT PRIMARY KEY, value TEXT);
+CREATE TABLE clinvar_sets (
+    seq INTEGER PRIMARY KEY,
+    ms_id TEXT,
+    rcv TEXT,
+    stamp TEXT,
+    annotations TEXT
+);
+"""
+# per-process state of the index building pool, see init_index_worker
+_WORKER_STATE = {}
+
+INDICES = """
+CREATE INDEX clinvar_sets_ms_id ON clinvar_sets (ms_id);
+CREATE INDEX clinvar_sets_rcv ON clinvar_sets (rcv);
+"""
+
+
+def build_index(xml_file, index_file, workers=1, engine='etree',
+                previous=None, gzip_backend='auto', scv_table=None):
+    """
+    Mine every ClinVarSet in the XML file into an SQLite index
+
+    Args:
+        xml_file: input ClinVar XML annotation file
+        index_file: output index file, replaced if it exists
+        workers: number of processes used to mine the XML file
+        engine: XML parser backend, one of XML_ENGINES
+        previous: index of an earlier release; records whose record_stamp
+            is unchanged since then are copied from it instead of being
+            parsed again
+        gzip_backend: decompression backend of a gzipped xml_file
+        scv_table: also write the SCVs of every record to this Parquet
+            file, see ScvTableWriter
+    Returns:
+        number of ClinVarSet records indexed
+    """
+    tmp_file = f'{index_file}.tmp'
+    if os.path.exists(tmp_file):
+        os.remove(tmp_file)
+    if previous is not None:
+        open_index(previous).close()  # fail early on a bad index
+
+    if workers > 1:
+        results = imap_xml_chunks(xml_file, index_chunk, workers=workers,
+                                  initializer=init_index_worker,
+                                  initargs=(engine, previous),
+                                  gzip_backend=gzip_backend)
+    else:
+        results = index_chunks(xml_file, engine=engine, previous=previous,
+                               gzip_backend=gzip_backend)
+
+    scv_writer = None
+    previous_conn = None
+    if scv_table is not None:
+        from clinvar_vcf.scv_table import ScvTableWriter
+        scv_writer = ScvTableWriter(scv_table)
+        if previous is not None:
+            previous_conn = open_index(previous)
+
+    n = 0
+    n_reused = 0
+    with sqlite3.connect(tmp_file) as conn:
+        conn.executescript(SCHEMA)
+        for n_processed, rows in results:
+            conn.executemany(
+                'INSERT INTO clinvar_sets (ms_id, rcv, stamp, annotations) '
+                'VALUES (?, ?, ?, ?)', rows)
+            n_reused += sum(1 for row in rows if row[3] is None)
+            if scv_writer is not None:
+                for ms_id, rcv, stamp, payload in rows:
+                    if payload is None:
+                        payload = previous_conn.execute(
+                            'SELECT annotations FROM clinvar_sets '
+                            'WHERE rcv = ? AND stamp = ?',
+                            (rcv, stamp)).fetchone()[0]
+                    scv_writer.add(ms_id, rcv, decode_annotations(payload))
+            if (n + n_processed) // 50000 > n // 50000:
+                logging.info('%s records indexed',
+                             (n + n_processed) // 50000 * 50000)
+            n += n_processed
+        conn.executescript(INDICES)
+        if previous is not None:
+            logging.info('Copying %s unchanged records from %s',
+                         n_reused, previous)
+            conn.execute('ATTACH DATABASE ? AS previous', (previous,))
+            conn.execute(
+                'UPDATE clinvar_sets SET annotations = ('
+                'SELECT p.annotations FROM previous.clinvar_sets p '
+                'WHERE p.rcv = clinvar_sets.rcv '
+                'AND p.stamp = clinvar_sets.stamp LIMIT 1) '
+                'WHERE annotations IS NULL')
+        conn.executemany(
+            'INSERT INTO meta (key, value) VALUES (?, ?)',
+            [('format_version', INDEX_FORMAT_VERSION),
+             ('xml_file', os.path.basename(xml_file)),
+             ('created', datetime.now().isoformat(timespec='seconds')),
+             ('records', str(n)),
+             ('previous', os.path.basename(previous or '')),
+             ('reused', str(n_reused))])
+    if previous is not None:
+        conn.execute('DETACH DATABASE previous')
+    conn.close()
+    if scv_writer is not None:
+        scv_writer.close()
+        logging.info('Wrote %s SCVs to %s', scv_writer.n, scv_table)
+        if previous_conn is not None:
+            previous_conn.close()
+    os.replace(tmp_file, index_file)
+    logging.info('Indexed %s ClinVarSet records (%s re-extracted)',
+                 n, n - n_reused)
+    return n
+
+
+def decode_annotations(payload):
+    """
+    Inverse of encode_annotations
+    """
+    return dict(zip(INFO_FIELDS, json.loads(payload)))
+
+
+def encode_annotations(annotations):
+    """
+    Serialise a {INFO field: list of values} dictionary for the index
+    """
+    return json.dumps([annotations[field] for field in INFO_FIELDS],
+                      separators=(',', ':'))
+
+
+def index_chunk(chunk, engine=None, previous=None):
+    """
+    Compute the index rows of a chunk produced by iter_clinvar_set_chunks
+
+    Args:
+        chunk: bytes (or memoryview) holding one or more whole ClinVarSet
+            elements
+        engine: XML parser backend, one of XML_ENGINES; if not given engine
+            and previous are those set by init_index_worker
+        previous: connection to the index of an earlier release
+    Returns:
+        (n, rows) where rows is a list of (ms_id, rcv, stamp, annotations), with
+            annotations None for a record unchanged since previous, and n
+            is len(rows)
+    """
+    if engine is None:
+        engine = _WORKER_STATE['engine']
+        previous = _WORKER_STATE['previous']
+    rows = []
+    for span in split_clinvar_sets(chunk):
+        stamp = record_stamp(span)
+        if previous is not None:
+            rcv = scan_key_id(span, pre_may_2017=True)
+            ms_id = scan_key_id(span)
+            if rcv is not None and ms_id is not None and previous.execute(
+                    'SELECT 1 FROM clinvar_sets WHERE rcv = ? AND stamp = ?',
+                    (rcv, stamp)).fetchone():
+                rows.append((ms_id, rcv, stamp, None))
+                continue
+        match = mine_clinvar_set(span, ALL_KEYS, pre_may_2017=True,
+                                 engine=engine)
+        if match is not None:
+            rcv, ms_id, annotations = match
+            rows.append((ms_id, rcv, stamp, encode_annotations(annotations)))
+    return len(rows), rows
+
+
+def index_chunks(xml_file, engine='etree', previous=None,
+                 gzip_backend='auto'):
+    """
+    Run index_chunk over an XML file in the current process
+
+    Args:
+        see build_index
+    Yields:
+        index_chunk results in the order of the XML file
+    """
+    previous_conn = None if previous is None else open_index(previous)
+    try:
+        with get_handle(xml_file, gzip_backend=gzip_backend) as handle:
+            for chunk in iter_clinvar_set_chunks(handle):
+                yield index_chunk(chunk, engine=engine,
+                                  previous=previous_conn)
+    finally:
+        if previous_conn is not None:
+            previous_conn.close()
+
+
+def init_index_worker(engine, previous):
+    """
+    Pool initializer storing the settings of index_chunk
+    """
+    _WORKER_STATE['engine'] = engine
+    _WORKER_STATE['previous'] = (None if previous is None
+                                 else open_index(previous))
+
+
+def is_index(fname):
+    """
+    Return True if fname looks like an index written by build_index
+    """
+    try:
+        with open(fname, 'rb') as f:
+            return f.read(len(SQLITE_MAGIC)) == SQLITE_MAGIC
+    except OSError:
+        return False
+
+
+def iter_index_records(index_file):
+    """
+    Yield (seq, ms_id, rcv, payload) for every record of an index written
+    by build_index, in the order of the original XML file; payload is the
+    encode_annotations string of the record
+    """
+    conn = open_index(index_file)
+    try:
+        yield from conn.execute(
+            'SELECT seq, ms_id, rcv, annotations FROM clinvar_sets '
+            'ORDER BY seq')
+    finally:
+        conn.close()
+
+
+def mine_index(index_file, keys, pre_may_2017=False):
+    """
+    Look up annotations in an index written by build_index
+
+    Args:
+        index_file: index file
+        keys: key_ids to extract
+        pre_may_2017: key on RCV accession instead of MeasureSet ID
+    Yields:
+        (1, [(key_id, ms_id, annotations)]) per matching ClinVarSet record,
+            in the order of the original XML file
+    """
+    key_column = 'rcv' if pre_may_2017 else 'ms_id'
+    conn = open_index(index_file)
+    try:
+        conn.execute('CREATE TEMP TABLE wanted (key_id TEXT PRIMARY KEY)')
+        conn.executemany('INSERT OR IGNORE INTO wanted VALUES (?)',
+                         ((key,) for key in keys))
+        cursor = conn.execute(
+            f'SELECT {key_column}, ms_id, annotations FROM clinvar_sets '
+            f'JOIN wanted ON {key_column} = wanted.key_id ORDER BY seq')
+        for key_id, ms_id, payload in cursor:
+            yield 1, [(key_id, ms_id, decode_annotations(payload))]
+    finally:
+        conn.close()
+
+
+def open_index(index_file):
+    """
+    Open an index written by build_index, checking its format version
+    """
+    if not is_index(index_file):
+        raise ValueError(f'{index_file} is not a ClinVar annotation index')
+    conn = sqlite3.connect(index_file)
+    row = conn.execute(
+        "SELECT value FROM meta WHERE key = 'format_version'").fetchone()
+    if row is None or row[0] != INDEX_FORMAT_VERSION:
+        conn.close()
+        raise ValueError(f'{index_file} has an unsupported index format')
+    return conn
+
+
+def record_stamp(span):
+    """
+    Return a digest of the version and date attributes of a raw ClinVarSet
+    element (see STAMP_TAGS); it changes whenever ClinVar updates the record
+    or any of its submissions
+    """
+    return hashlib.blake2b(b''.join(STAMP_TAGS.findall(span)),
+                           digest_size=16).hexdigest()
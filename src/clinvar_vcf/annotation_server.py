@@ -0,0 +1,258 @@
+"""
+Local HTTP service keeping the annotations of an index written by build-index
+in memory, to annotate many small VCFs without mining the XML for each one
+
+    POST /annotate     VCF text -> annotated VCF text
+    POST /annotations  JSON list of IDs -> {ID: {INFO field: list of values}}
+    POST /reload       load the index again, or {"index": FILE} instead
+    GET  /status       index file, its metadata and when it was loaded
+
+/annotate and /annotations key on Variation IDs, or on RCV accessions with
+?pre_may_2017=1, as clinvar_vcf_parser does.
+"""
+import json
+import logging
+import signal
+import sqlite3
+import threading
+import time
+from collections import defaultdict, namedtuple
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from urllib.parse import parse_qs, urlsplit
+
+from clinvar_vcf.annotation_index import decode_annotations, open_index
+from clinvar_vcf.clinvar_vcf_parser import (
+    INFO_FIELDS,
+    AnnotationTable,
+    annotated_vcf_header,
+    format_annotations,
+    iter_vcf_records,
+    split_rcv_ids)
+
+# the annotations of an index: table holds the annotations of each
+# ClinVarSet record by its position in the XML file, and keys maps the
+# MeasureSet IDs (keys[False]) and RCV accessions (keys[True]) to positions
+Snapshot = namedtuple('Snapshot',
+                      ['index_file', 'meta', 'table', 'keys', 'loaded_at'])
+
+MAX_REQUEST_BYTES = 1 << 30
+
+
+class AnnotationHandler(BaseHTTPRequestHandler):
+    """
+    Request handler of AnnotationServer
+    """
+
+    def do_GET(self):
+        url = urlsplit(self.path)
+        if url.path == '/status':
+            self.send_json(status(self.server.snapshot))
+        else:
+            self.send_error(404)
+
+    def do_POST(self):
+        url = urlsplit(self.path)
+        query = parse_qs(url.query)
+        pre_may_2017 = query.get('pre_may_2017', ['0'])[0] not in ('0', '')
+        # each request uses the snapshot it started with, even if another
+        # request reloads the index meanwhile
+        snapshot = self.server.snapshot
+        try:
+            length = int(self.headers.get('Content-Length', 0))
+            if length < 0:
+                raise ValueError(f'Invalid Content-Length {length}')
+            if length > MAX_REQUEST_BYTES:
+                self.send_error(413)
+                return
+            body = self.rfile.read(length).decode()
+            if url.path == '/annotate':
+                self.send_text(''.join(annotate_vcf_lines(
+                    snapshot, body.splitlines(), pre_may_2017=pre_may_2017)))
+            elif url.path == '/annotations':
+                key_ids = json.loads(body)
+                if not isinstance(key_ids, list):
+                    raise ValueError('Expected a JSON list of IDs')
+                self.send_json(lookup_annotations(
+                    snapshot, key_ids, pre_may_2017=pre_may_2017))
+            elif url.path == '/reload':
+                request = json.loads(body or '{}')
+                if not isinstance(request, dict):
+                    raise ValueError('Expected a JSON object')
+                self.send_json(status(self.server.reload(
+                    request.get('index'))))
+            else:
+                self.send_error(404)
+        except (ValueError, KeyError, IndexError) as exc:
+            self.send_error(400, explain=str(exc))
+        except sqlite3.DatabaseError as exc:
+            # a corrupt index posted to /reload; the current one is kept
+            self.send_error(400, explain=f'Cannot load the index: {exc}')
+
+    def log_message(self, format, *args):
+        logging.info('%s %s', self.address_string(), format % args)
+
+    def send_body(self, body, content_type):
+        """
+        Send a 200 response
+        """
+        self.send_response(200)
+        self.send_header('Content-Type', content_type)
+        self.send_header('Content-Length', str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def send_json(self, obj):
+        """
+        Send obj as a JSON response
+        """
+        self.send_body(json.dumps(obj).encode(), 'application/json')
+
+    def send_text(self, text):
+        """
+        Send a text response
+        """
+        self.send_body(text.encode(), 'text/plain; charset=utf-8')
+
+
+class AnnotationServer(ThreadingHTTPServer):
+    """
+    Threaded HTTP server holding the Snapshot of an index; reload swaps in a
+    new snapshot once it is fully loaded, so requests are never blocked
+    """
+
+    daemon_threads = True
+
+    def __init__(self, address, index_file):
+        self.reload_lock = threading.Lock()
+        self.snapshot = load_snapshot(index_file)
+        super().__init__(address, AnnotationHandler)
+
+    def reload(self, index_file=None):
+        """
+        Load index_file, or the current index again, and serve it
+
+        Returns:
+            the new Snapshot
+        """
+        with self.reload_lock:
+            snapshot = load_snapshot(index_file or self.snapshot.index_file)
+            self.snapshot = snapshot
+        return snapshot
+
+
+def annotate_vcf_lines(snapshot, lines, pre_may_2017=False):
+    """
+    Annotate the lines of a VCF file as expand_clinvar_vcf does
+
+    Args:
+        snapshot: Snapshot returned by load_snapshot
+        lines: VCF lines, without line ends
+        pre_may_2017: key on the RCV accessions in INFO field CLNACC
+    Yields:
+        lines of the annotated VCF, with line ends
+    """
+    header = [line.strip() for line in lines if line.startswith('##')]
+    for line in annotated_vcf_header(header):
+        yield line + '\n'
+    columns = next((line for line in lines if line.startswith('#')
+                    and not line.startswith('##')), None)
+    if columns is None:
+        raise ValueError('no #CHROM line')
+    yield columns.rstrip('\r\n') + '\n'
+    info_col = columns.rstrip('\r\n').split('\t').index('INFO')
+    for i, fields in enumerate(iter_vcf_records(
+            lines, pre_may_2017=pre_may_2017)):
+        key_ids = (split_rcv_ids(fields[7], i) if pre_may_2017
+                   else [fields[2]])
+        annotations = get_snapshot_annotations(snapshot, key_ids,
+                                               pre_may_2017=pre_may_2017)
+        if annotations is not None:
+            fields[info_col] += ';' + format_annotations(annotations)
+        yield '\t'.join(fields) + '\n'
+
+
+def get_snapshot_annotations(snapshot, key_ids, pre_may_2017=False):
+    """
+    Return the annotations of the ClinVarSet records of key_ids, merged in
+    the order of the XML file, or None if none of them is in the index
+    """
+    positions = set()
+    for key_id in key_ids:
+        positions.update(snapshot.keys[pre_may_2017].get(key_id, ()))
+    if not positions:
+        return None
+    annotations = {field: [] for field in INFO_FIELDS}
+    for position in sorted(positions):
+        for field, values in snapshot.table[position].items():
+            annotations[field] += values
+    return annotations
+
+
+def load_snapshot(index_file):
+    """
+    Read every record of an index written by build_index into memory
+
+    Returns:
+        Snapshot
+    """
+    start = time.perf_counter()
+    conn = open_index(index_file)
+    try:
+        meta = dict(conn.execute('SELECT key, value FROM meta'))
+        table = AnnotationTable()
+        keys = {False: defaultdict(list), True: defaultdict(list)}
+        for seq, ms_id, rcv, payload in conn.execute(
+                'SELECT seq, ms_id, rcv, annotations FROM clinvar_sets '
+                'ORDER BY seq'):
+            table.add(seq, decode_annotations(payload))
+            keys[False][ms_id].append(seq)
+            keys[True][rcv].append(seq)
+    finally:
+        conn.close()
+    logging.info('Loaded %s ClinVarSet records from %s in %.1f s',
+                 len(table), index_file, time.perf_counter() - start)
+    return Snapshot(index_file, meta, table, keys, time.time())
+
+
+def lookup_annotations(snapshot, key_ids, pre_may_2017=False):
+    """
+    Return {key_id: {INFO field: list of values}} for the key_ids found in
+    the snapshot
+    """
+    if not isinstance(key_ids, list):
+        raise ValueError('Expected a JSON list of IDs')
+    found = {}
+    for key_id in key_ids:
+        annotations = get_snapshot_annotations(
+            snapshot, [str(key_id)], pre_may_2017=pre_may_2017)
+        if annotations is not None:
+            found[str(key_id)] = annotations
+    return found
+
+
+def serve(index_file, host='127.0.0.1', port=8765):
+    """
+    Serve an index until interrupted; SIGHUP reloads it, like POST /reload
+    """
+    server = AnnotationServer((host, port), index_file)
+    if hasattr(signal, 'SIGHUP'):  # kill -HUP reloads the index
+        signal.signal(signal.SIGHUP, lambda signum, frame: threading.Thread(
+            target=server.reload, daemon=True).start())
+    logging.info('Serving %s on http://%s:%s/', index_file,
+                 *server.server_address[:2])
+    try:
+        server.serve_forever()
+    except KeyboardInterrupt:
+        pass
+    finally:
+        server.server_close()
+
+
+def status(snapshot):
+    """
+    Return the /status response of a Snapshot
+    """
+    return {'index': snapshot.index_file, 'meta': snapshot.meta,
+            'records': len(snapshot.table),
+            'loaded_at': time.strftime('%Y-%m-%dT%H:%M:%S',
+                                       time.localtime(snapshot.loaded_at))}
@@ -2,110 +2,1162 @@
 Parse ClinVar vcf and append extra information from the ClinVar XML
 """
 import argparse
+import bisect
 import gzip
+import hashlib
 import io
+import json
 import logging
+import mmap
 import os
+import pickle
+import queue
 import re
+import sys
+import threading
+import time
 import xml.etree.ElementTree as ET
-from collections import defaultdict
-from csv import writer
+import xml.parsers.expat
+from array import array
+from collections import defaultdict, deque, namedtuple
+from contextlib import contextmanager
 from datetime import datetime
-import pandas as pd
+
+CLINVARSET_START = b'<ClinVarSet'
+CLINVARSET_END = b'</ClinVarSet>'
+CLINVARSET_END_PATTERN = re.compile(re.escape(CLINVARSET_END))
+XML_BLOCK_SIZE = 1 << 20
+XML_CHUNK_RECORDS = 1000
+# number of decompressed blocks ReadAheadReader keeps ready
+READ_AHEAD_BLOCKS = 16
+# bytes of a mapped XML file MmapReader keeps in memory behind the read
+# position, for the chunks queued but not parsed yet
+MMAP_RELEASE_BYTES = 64 << 20
+# seconds between two checkpoints of mine_xml
+CHECKPOINT_INTERVAL = 600
+CHECKPOINT_FORMAT_VERSION = 1
+# bytes of records buffered by each sort of the sort-merge mode
+SORT_MERGE_MEMORY = 256 << 20
+# items (chunks of XML or blocks of output lines) each queue of a pipeline
+# holds, and lines per block of output
+PIPELINE_QUEUE_SIZE = 8
+OUTPUT_BLOCK_LINES = 1000
+
+# start tag holding the key_id of a ClinVarSet, by pre_may_2017, and the
+# attribute it is read from
+KEY_START_TAGS = {
+    False: (re.compile(rb'<MeasureSet[\s/>][^>]*'),
+            re.compile(rb'\sID="([^"&]*)"')),
+    True: (re.compile(rb'<ClinVarAccession[\s/>][^>]*'),
+           re.compile(rb'\sAcc="([^"&]*)"')),
+}
+
+# xml-derived INFO fields in the order they are appended to the INFO column
+INFO_FIELDS = ('CLNSUBA', 'CLNREVSTATA', 'CLNDATEA', 'CLNDATESUBA', 'CLNSIGA',
+               'CLNORA', 'CLNCOMA', 'CLNSCVA', 'CLNDNA')
+
+# VCF record yielded by iter_annotated_records: the eight fixed VCF columns,
+# with POS as an int, and annotations, a dictionary of {INFO field: list of
+# values} with empty lists when no ClinVarSet matched the record
+AnnotatedRecord = namedtuple(
+    'AnnotatedRecord',
+    ['chrom', 'pos', 'id', 'ref', 'alt', 'qual', 'filter', 'info',
+     'annotations'])
+
+# escaping of the values of xml-derived INFO fields: the VCF separators are
+# replaced, double quotes dropped and tabs and newlines turned into spaces
+INFO_VALUE_ESCAPES = str.maketrans({';': ':', '|': ':', ' ': '_', '"': '',
+                                    ',': '&', '\t': ' ', '\n': ' ',
+                                    '\r': ' '})
+
+# placeholder for an element that has not been seen, see ExpatClinVarSet
+MISSING = object()
+
+# per-process state of the XML mining pool, see init_mining_worker
+_WORKER_STATE = {}
+
+
+class AllKeys:
+    """
+    Container of every key_id, used to mine all records of an XML file
+    """
+
+    def __contains__(self, key_id):
+        return True
 
 
-def expand_clinvar_vcf(xml_file, vcf_file, out_file, pre_may_2017=False):
+ALL_KEYS = AllKeys()
+
+
+class AnnotationTable:
     """
-    Args:
-        xml_file: input ClinVar XML annotation file
-        vcf_file: input ClinVar VCF file
-        out_file: output annotated VCF
-        pre_may_2017: assume old format ClinVar file
+    Compact {row index: {INFO field: list of values}} mapping filled by
+    mine_xml.
+
+    Values are dictionary-encoded: each distinct string is stored once and
+    a row is a single array of the number of values of each INFO field
+    followed by their codes, instead of nine lists of separate strings.
     """
 
-    logging.info('Reading in vcf file')
-    header, vcf_df = read_vcf(vcf_file)
+    __slots__ = ('rows', 'values', 'codes', 'joined_values')
+
+    def __init__(self):
+        self.rows = {}
+        self.values = []
+        self.codes = {}
+        self.joined_values = []
+
+    def __contains__(self, idx):
+        return idx in self.rows
+
+    def __getitem__(self, idx):
+        row = self.rows[idx]
+        values = self.values
+        annotations = {}
+        start = len(INFO_FIELDS)
+        for field, n in zip(INFO_FIELDS, row):
+            annotations[field] = [values[code]
+                                  for code in row[start:start + n]]
+            start += n
+        return annotations
+
+    def __iter__(self):
+        return iter(self.rows)
+
+    def __len__(self):
+        return len(self.rows)
+
+    def add(self, idx, annotations):
+        """
+        Append the values of an {INFO field: list of values} dictionary to
+        those of row idx
+        """
+        if idx in self.rows:
+            merged = self[idx]
+            for field in INFO_FIELDS:
+                merged[field] += annotations[field]
+            annotations = merged
+        self.rows[idx] = self.encode_row(annotations)
+
+    def add_many(self, indices, annotations):
+        """
+        add the same annotations to several rows, encoding them once; rows
+        that had no values yet share one array
+        """
+        row = None
+        for idx in indices:
+            if idx in self.rows:
+                self.add(idx, annotations)
+            else:
+                if row is None:
+                    row = self.encode_row(annotations)
+                self.rows[idx] = row
+
+    def encode(self, value):
+        """
+        Return the code of a value, adding it to the table if it is new
+        """
+        code = self.codes.get(value)
+        if code is None:
+            code = self.codes[value] = len(self.values)
+            self.values.append(value)
+        return code
+
+    def encode_row(self, annotations):
+        """
+        Return the array of an {INFO field: list of values} dictionary
+        """
+        row = array('I', [len(annotations[field]) for field in INFO_FIELDS])
+        for field in INFO_FIELDS:
+            row.extend(self.encode(value) for value in annotations[field])
+        return row
+
+    def items(self):
+        """
+        Yield (row index, {INFO field: list of values}) pairs
+        """
+        for idx in self.rows:
+            yield idx, self[idx]
+
+    def joined(self, idx, with_sep='|'):
+        """
+        Return the {INFO field: joined string} dictionary of row idx, as
+        join_entries makes it, cleaning each distinct value only once
+        """
+        joined_values = self.joined_values
+        joined_values.extend(value.translate(INFO_VALUE_ESCAPES)
+                             for value in self.values[len(joined_values):])
+        lookup = joined_values.__getitem__
+        row = self.rows[idx]
+        joined = {}
+        start = len(INFO_FIELDS)
+        for field, n in zip(INFO_FIELDS, row):
+            joined[field] = with_sep.join(map(lookup, row[start:start + n]))
+            start += n
+        return joined
+
+    def info(self, idx):
+        """
+        Return the INFO string of row idx, as format_annotations makes it
+        """
+        return ';'.join([field + '=' + value
+                         for field, value in self.joined(idx).items()])
+
+
+class CountingReader:
+    """
+    Binary file wrapper counting the bytes read from the underlying file
+    into a Metrics counter
+    """
 
-    logging.info('Writing out updated vcf header')
+    def __init__(self, raw, metrics, counter):
+        self.raw = raw
+        self.metrics = metrics
+        self.counter = counter
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc_info):
+        self.close()
+
+    def close(self):
+        """
+        Close the underlying file
+        """
+        self.raw.close()
+
+    @property
+    def mapped(self):
+        """
+        The mmap of the underlying file if it is an MmapReader, else None
+        """
+        return getattr(self.raw, 'mapped', None)
+
+    def read(self, size=-1):
+        """
+        Read up to size bytes from the underlying file
+        """
+        data = self.raw.read(size)
+        self.metrics.count(self.counter, len(data))
+        return data
+
+    def read_view(self, size=-1):
+        """
+        MmapReader.read_view of the underlying file
+        """
+        view = self.raw.read_view(size)
+        self.metrics.count(self.counter, len(view))
+        return view
+
+    def tell(self):
+        """
+        Current position in the underlying file
+        """
+        return self.raw.tell()
+
+
+class ExpatClinVarSet:
+    """
+    Expat handlers collecting the values read by get_record_ids and
+    get_annotations in a single pass over a ClinVarSet element, without
+    building an element tree.
+
+    Only the regular layout is handled (every ClinVarAssertion has a
+    ClinVarSubmissionID with a submitter, a ClinVarAccession and
+    ClinicalSignificance elements with ReviewStatus and Description, and
+    there is a TraitSet); `regular` is False otherwise, and the element
+    should then be parsed with get_annotations, which logs the
+    irregularities.
+    """
 
-    write_vcf_header(header, out_file)
+    def __init__(self):
+        self.stack = []
+        self.measure_set = None
+        self.accession = None
+        self.submitters = []
+        self.regular = True
+        self.cvas = []
+        self.traits = None
+        self.trait_depth = None
+        self.text = None
+        self.text_target = None
+
+    def parse(self, span):
+        """
+        Run expat over the bytes of a ClinVarSet element
+        """
+        parser = xml.parsers.expat.ParserCreate()
+        parser.buffer_text = True
+        parser.StartElementHandler = self.start
+        parser.EndElementHandler = self.end
+        parser.CharacterDataHandler = self.data
+        parser.Parse(span, True)
+        if self.measure_set is None or self.accession is None \
+                or self.traits is None or not self.cvas:
+            self.regular = False
+        for cva in self.cvas:
+            if cva['ClinVarSubmissionID'] is None \
+                    or cva['ClinVarAccession'] is None \
+                    or not cva['ClinicalSignificance']:
+                self.regular = False
+            for clinsig in cva['ClinicalSignificance']:
+                if clinsig['ReviewStatus'] is MISSING \
+                        or clinsig['Description'] is MISSING:
+                    self.regular = False
+        return self
+
+    def start(self, tag, attrib):
+        """
+        StartElementHandler
+        """
+        self.end_text()
+        stack = self.stack
+        depth = len(stack)
+        if tag == 'MeasureSet' and self.measure_set is None:
+            self.measure_set = attrib
+        if tag == 'ClinVarAccession' and self.accession is None:
+            self.accession = attrib
+        if tag == 'ClinVarSubmissionID':
+            if 'submitter' in attrib:
+                self.submitters.append(attrib['submitter'])
+            else:
+                self.regular = False
+        if tag == 'TraitSet' and self.traits is None:
+            self.traits = []
+            self.trait_depth = depth
+
+        if depth == 1 and tag == 'ClinVarAssertion':
+            self.cvas.append({'ClinVarSubmissionID': None,
+                              'ClinVarAccession': None,
+                              'ClinicalSignificance': [],
+                              'Origin': MISSING})
+        elif depth == 2 and stack[1] == 'ClinVarAssertion':
+            cva = self.cvas[-1]
+            if tag == 'ClinicalSignificance':
+                cva[tag].append({'attrib': attrib,
+                                 'ReviewStatus': MISSING,
+                                 'Description': MISSING,
+                                 'Comment': MISSING})
+            elif tag in ('ClinVarSubmissionID', 'ClinVarAccession') \
+                    and cva[tag] is None:
+                cva[tag] = attrib
+        elif depth == 3 and stack[1] == 'ClinVarAssertion' \
+                and stack[2] == 'ClinicalSignificance':
+            clinsig = self.cvas[-1]['ClinicalSignificance'][-1]
+            if tag in ('ReviewStatus', 'Description', 'Comment') \
+                    and clinsig[tag] is MISSING:
+                self.start_text(clinsig, tag)
+        elif depth == 4 and tag == 'Origin' and stack[1] == 'ClinVarAssertion' \
+                and stack[2] == 'ObservedIn' and stack[3] == 'Sample' \
+                and self.cvas[-1]['Origin'] is MISSING:
+            self.start_text(self.cvas[-1], tag)
+
+        # preferred disease names of the first TraitSet, see get_traits
+        if tag == 'ElementValue' and self.trait_depth is not None \
+                and depth > self.trait_depth and stack[-1] == 'Name' \
+                and attrib.get('Type') == 'Preferred':
+            self.start_text(self.traits, None)
+        stack.append(tag)
+
+    def end(self, tag):
+        """
+        EndElementHandler
+        """
+        self.end_text()
+        self.stack.pop()
+        if tag == 'TraitSet' and len(self.stack) == self.trait_depth:
+            self.trait_depth = None
+
+    def data(self, text):
+        """
+        CharacterDataHandler
+        """
+        if self.text is not None:
+            self.text.append(text)
+
+    def start_text(self, container, key):
+        """
+        Collect the text of the element being started, as Element.text
+        """
+        self.text = []
+        self.text_target = (container, key)
+
+    def end_text(self):
+        """
+        Store the text collected since start_text, if any
+        """
+        if self.text is None:
+            return
+        container, key = self.text_target
+        text = ''.join(self.text) if self.text else None
+        if key is None:
+            container.append(text)
+        else:
+            container[key] = text
+        self.text = None
+        self.text_target = None
+
+    def annotations(self):
+        """
+        Return the get_annotations dictionary of a regular ClinVarSet
+        """
+        clinsigs = [clinsig for cva in self.cvas
+                    for clinsig in cva['ClinicalSignificance']]
+        scv_ids = [cva['ClinVarAccession'].get('Acc') for cva in self.cvas
+                   if cva['ClinVarAccession'].get('Type') == 'SCV']
+        disease_name = '/'.join(self.traits)
+        annotations = {}
+        annotations['CLNSUBA'] = self.submitters
+        annotations['CLNREVSTATA'] = [x['ReviewStatus'] for x in clinsigs]
+        annotations['CLNDATEA'] = [
+            x['attrib'].get('DateLastEvaluated', '0000-00-00')
+            for x in clinsigs]
+        annotations['CLNDATESUBA'] = [
+            cva['ClinVarSubmissionID'].get('submitterDate', '0000-00-00')
+            for cva in self.cvas]
+        annotations['CLNSIGA'] = [x['Description'] for x in clinsigs]
+        annotations['CLNORA'] = [
+            '' if cva['Origin'] is MISSING else cva['Origin']
+            for cva in self.cvas]
+        annotations['CLNCOMA'] = [
+            '' if x['Comment'] is MISSING else x['Comment']
+            for x in clinsigs]
+        annotations['CLNSCVA'] = scv_ids
+        annotations['CLNDNA'] = [disease_name] * len(scv_ids)
+        return annotations
+
+
+class Metrics:
+    """
+    Wall time, CPU time, throughput and peak memory of the stages of a run,
+    and counters such as the number of matched ClinVarSet records, reported
+    as JSON by --metrics-json
+    """
 
-    logging.info('Creating dictionary for looking up IDs')
-    if pre_may_2017:
-        logging.info('VCF dataframe size:%s', vcf_df.shape)
-        logging.info('Expanding multiallelic variants')
-        vcf_df = split_multi_vcf(vcf_df)
-        logging.info('VCF dataframe size post expansion:%s', vcf_df.shape)
-        # (Only works when RCV IDs are in INFO vcf column - field CLNACC.
-        # Works with ClinVar vcf older than May 2017)
-        id_dict = split_vcf_info(vcf_df)
-    else:
-        # (Only works when ClinVar Variation IDs are in ID vcf column.
-        # ClinVar vcf older than May 2017 won't work)
-        id_dict = dict(zip(vcf_df['ID'], [{x} for x in vcf_df.index]))
+    def __init__(self):
+        self.stages = {}
+        self.counters = defaultdict(int)
+        self.queues = {}
+        self.start = time.perf_counter()
+
+    def count(self, counter, n=1):
+        """
+        Add n to a counter
+        """
+        self.counters[counter] += n
+
+    def queue(self, name, stats):
+        """
+        Record the occupancy of the queue of a PipelineStage
+        """
+        self.queues[name] = stats
+        logging.info('Queue %s: %s', name, stats)
+
+    def reader(self, handle, counter='xml_bytes_read'):
+        """
+        Wrap a binary file handle so that the bytes read are counted
+        """
+        return CountingReader(handle, self, counter)
+
+    def report(self):
+        """
+        Return the metrics as a JSON-serialisable dictionary
+        """
+        return {'wall_seconds': round(time.perf_counter() - self.start, 3),
+                'peak_rss_mb': peak_rss_mb(),
+                'stages': self.stages,
+                'counters': dict(self.counters),
+                'queues': self.queues}
+
+    @contextmanager
+    def stage(self, name):
+        """
+        Time the body of a with statement as stage name; the body can set
+        'records' in the yielded dictionary to get a records/s rate
+        """
+        stats = {}
+        wall = time.perf_counter()
+        cpu = time.process_time()
+        children_cpu = child_cpu_seconds()
+        try:
+            yield stats
+        finally:
+            stats['wall_seconds'] = round(time.perf_counter() - wall, 3)
+            stats['cpu_seconds'] = round(time.process_time() - cpu, 3)
+            stats['child_cpu_seconds'] = None if children_cpu is None \
+                else round(child_cpu_seconds() - children_cpu, 3)
+            if 'records' in stats and stats['wall_seconds']:
+                stats['records_per_s'] = round(
+                    stats['records'] / stats['wall_seconds'])
+            stats['peak_rss_mb'] = peak_rss_mb()
+            self.stages[name] = stats
+            logging.info('Stage %s: %s', name, stats)
+
+    def write(self, fname):
+        """
+        Write the report to a JSON file
+        """
+        with open(fname, 'w') as f:
+            json.dump(self.report(), f, indent=2)
+
+
+class MmapReader:
+    """
+    Binary reader of an uncompressed file mapped into memory, which can
+    hand out memoryview slices of the file instead of copies (see
+    iter_mapped_clinvar_set_chunks)
+    """
 
-    logging.info('Mining through XML file')
-    xml_dict = defaultdict(lambda: defaultdict(list))
-    n = 0
+    def __init__(self, raw):
+        self.raw = raw
+        self.mapped = mmap.mmap(raw.fileno(), 0, access=mmap.ACCESS_READ)
+        self.view = memoryview(self.mapped)
+        self.pos = 0
+        self.released = 0
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc_info):
+        self.close()
+
+    def close(self):
+        """
+        Unmap and close the file; the mapping stays open as long as slices
+        handed out by read_view are alive
+        """
+        self.view.release()
+        try:
+            self.mapped.close()
+        except BufferError:
+            pass
+        self.raw.close()
+
+    def read(self, size=-1):
+        """
+        Read up to size bytes from the current position
+        """
+        return bytes(self.read_view(size))
+
+    def read_view(self, size=-1):
+        """
+        Return up to size bytes from the current position as a memoryview
+        of the mapping, without copying them
+        """
+        if (self.pos - self.released >= 2 * MMAP_RELEASE_BYTES
+                and hasattr(mmap, 'MADV_DONTNEED')):
+            # drop the pages read long ago from the resident memory of the
+            # process; they are read again from the page cache if a slice
+            # still uses them
+            released = self.pos - MMAP_RELEASE_BYTES
+            released -= released % mmap.PAGESIZE
+            self.mapped.madvise(mmap.MADV_DONTNEED, self.released,
+                                released - self.released)
+            self.released = released
+        end = len(self.view) if size < 0 else min(self.pos + size,
+                                                   len(self.view))
+        view = self.view[self.pos:end]
+        self.pos = end
+        return view
+
+    def tell(self):
+        """
+        Current position in the file
+        """
+        return self.pos
+
+
+class PipelineStage:
+    """
+    Iterate over source on a background thread, handing its items to the
+    consumer through a bounded queue, so that a producer that does I/O or
+    decompression overlaps with the consumer.
+
+    The occupancy of the queue is reported to metrics once the source is
+    exhausted: a queue that is mostly full, with the producer waiting on
+    it, means the consumer is the bottleneck; a queue that is mostly
+    empty, with the consumer waiting on it, means the producer is.
+    """
 
-    context = ET.iterparse(get_handle(xml_file), events=('start', 'end'))
-    for event, elem in context:
-        if elem.tag != 'ClinVarSet' or event != 'end':
-            continue
-        ms_id = elem.find('.//MeasureSet').attrib.get('ID')
-        key_id = (elem.find('.//ClinVarAccession').attrib.get('Acc')
-                  if pre_may_2017 else ms_id)
-        cva = elem.findall('./ClinVarAssertion')
-
-        if key_id in id_dict:
-            for idx in id_dict[key_id]:
-                xml_dict[idx]['CLNSUBA'] += get_submitters(elem)
-                xml_dict[idx]['CLNREVSTATA'] += get_clinsig(
-                        cva, field='status_ordered', record_id=ms_id)
-                xml_dict[idx]['CLNDATEA'] += get_clinsig(
-                        cva, field='last_eval', record_id=ms_id)
-                xml_dict[idx]['CLNDATESUBA'] += get_submitdate(
-                        cva, field='submitterDate', record_id=ms_id)
-                xml_dict[idx]['CLNSIGA'] += get_clinsig(
-                        cva, field='description', record_id=ms_id)
-                xml_dict[idx]['CLNORA'] += get_origin(
-                        cva, as_set=False)
-                xml_dict[idx]['CLNCOMA'] += get_clinsig(
-                        cva, field='comment', record_id=ms_id)
-
-                # Duplicate disease name if multiple SCV entries in one ClinVarSet
-                # record
-                scv_ids = get_accession(cva, field='SCV')
-                xml_dict[idx]['CLNSCVA'] += scv_ids
-                disease_name = '/'.join(get_traits(elem))
-                for _ in range(len(scv_ids)):
-                    xml_dict[idx]['CLNDNA'] += [disease_name]
-
-        elem.clear()
+    def __init__(self, name, source, maxsize=PIPELINE_QUEUE_SIZE,
+                 metrics=None):
+        self.name = name
+        self.items = queue.Queue(maxsize)
+        self.metrics = metrics
+        self.error = None
+        self.closing = threading.Event()
+        self.n = 0
+        self.occupancy = 0
+        self.producer_wait = 0.
+        self.consumer_wait = 0.
+        self.thread = threading.Thread(target=self.fill, args=(source,),
+                                       daemon=True)
+        self.thread.start()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc_info):
+        self.close()
+
+    def __iter__(self):
+        items = self.items
+        try:
+            while True:
+                try:
+                    item = items.get_nowait()
+                except queue.Empty:
+                    start = time.perf_counter()
+                    item = items.get()
+                    self.consumer_wait += time.perf_counter() - start
+                if item is MISSING:
+                    break
+                self.occupancy += items.qsize()
+                self.n += 1
+                yield item
+        finally:
+            self.close()
+        if self.error is not None:
+            raise self.error
+        if self.metrics is not None:
+            self.metrics.queue(self.name, self.stats())
+
+    def close(self):
+        """
+        Stop the background thread, e.g. when the consumer stops early
+        """
+        self.closing.set()
+        while self.thread.is_alive():
+            try:
+                self.items.get(timeout=0.1)
+            except queue.Empty:
+                pass
+
+    def fill(self, source):
+        """
+        Background thread: queue the items of source, then MISSING
+        """
+        try:
+            for item in source:
+                if self.closing.is_set():
+                    return
+                try:
+                    self.items.put_nowait(item)
+                except queue.Full:
+                    start = time.perf_counter()
+                    while not self.put(item):
+                        if self.closing.is_set():
+                            return
+                    self.producer_wait += time.perf_counter() - start
+        except Exception as exc:  # re-raised by the consumer
+            self.error = exc
+        while not self.put(MISSING) and not self.closing.is_set():
+            pass
+
+    def put(self, item):
+        """
+        Queue item, waiting at most 0.1 s; return False if the queue is
+        still full
+        """
+        try:
+            self.items.put(item, timeout=0.1)
+        except queue.Full:
+            return False
+        return True
+
+    def stats(self):
+        """
+        Return the number of items passed through the queue, the mean
+        number of items left in it when the consumer takes one as a fraction
+        of its size, and the seconds the producer waited on a full queue
+        and the consumer on an empty one
+        """
+        return {'items': self.n,
+                'size': self.items.maxsize,
+                'mean_occupancy': round(
+                    self.occupancy / max(self.n, 1) / self.items.maxsize, 3),
+                'producer_wait_seconds': round(self.producer_wait, 3),
+                'consumer_wait_seconds': round(self.consumer_wait, 3)}
+
+
+class ReadAheadReader:
+    """
+    Binary file wrapper reading the underlying file on a background thread,
+    so that decompression overlaps with parsing. zlib releases the GIL
+    while it inflates a block.
+    """
 
-        # Progress report
-        n += 1
-        if n % 50000 == 0:
-            logging.info('%s records processed', n)
+    def __init__(self, raw, block_size=XML_BLOCK_SIZE,
+                 blocks=READ_AHEAD_BLOCKS):
+        self.raw = raw
+        self.block_size = block_size
+        self.blocks = queue.Queue(blocks)
+        self.buffer = b''
+        self.eof = False
+        self.closing = threading.Event()
+        self.thread = threading.Thread(target=self.fill, daemon=True)
+        self.thread.start()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc_info):
+        self.close()
+
+    def close(self):
+        """
+        Stop the background thread and close the underlying file
+        """
+        self.closing.set()
+        while self.thread.is_alive():
+            try:
+                self.blocks.get(timeout=0.1)
+            except queue.Empty:
+                pass
+        self.raw.close()
+
+    def fill(self):
+        """
+        Background thread: queue blocks until the end of the file, then b''
+        """
+        try:
+            while not self.closing.is_set():
+                block = self.raw.read(self.block_size)
+                self.blocks.put(block)
+                if not block:
+                    return
+        except Exception as exc:  # re-raised by read
+            self.blocks.put(exc)
+
+    def read(self, size=-1):
+        """
+        Read up to size bytes, or to the end of the file if size is negative
+        """
+        while not self.eof and (size < 0 or len(self.buffer) < size):
+            block = self.blocks.get()
+            if isinstance(block, Exception):
+                raise block
+            if not block:
+                self.eof = True
+            self.buffer += block
+        if size < 0:
+            size = len(self.buffer)
+        data, self.buffer = self.buffer[:size], self.buffer[size:]
+        return data
+
+
+class RecordSelection:
+    """
+    Predicate on the fields of a VCF record (see iter_vcf_records) keeping
+    the records whose POS is in regions and whose key_id is in ids; either
+    can be None to keep every record
+    """
 
-    logging.info('Finished mining through XML file')
-    logging.info('Processed %s ClinVarSet records', n)
+    def __init__(self, regions=None, ids=None, pre_may_2017=False):
+        """
+        Args:
+            regions: {chromosome: (starts, ends)} returned by
+                read_bed_regions
+            ids: set of key_ids: Variation IDs of the ID column, or RCV
+                accessions without version with pre_may_2017
+            pre_may_2017: match ids against the RCV accessions in INFO field
+                CLNACC
+        """
+        self.regions = regions
+        self.ids = ids
+        self.pre_may_2017 = pre_may_2017
+
+    def __call__(self, fields):
+        if self.regions is not None and not self.in_regions(
+                fields[0], int(fields[1])):
+            return False
+        if self.ids is None:
+            return True
+        if not self.pre_may_2017:
+            return fields[2] in self.ids
+        for field in fields[7].split(';'):
+            if field.startswith('CLNACC='):
+                return any(rcv_id.split('.')[0] in self.ids
+                           for rcv_id in field[7:].split('|'))
+        return False
+
+    def in_regions(self, chrom, pos):
+        """
+        Return True if the 1-based position pos is in one of the regions
+        """
+        intervals = self.regions.get(strip_chr(chrom))
+        if intervals is None:
+            return False
+        starts, ends = intervals
+        i = bisect.bisect_right(starts, pos - 1) - 1
+        return i >= 0 and pos <= ends[i]
+
+
+def annotated_vcf_header(header):
+    """
+    Return the VCF header lines with the definitions of the xml-derived INFO
+    fields added
+    """
+    header = list(header)
+    vcf_header_dict = {
+        'CLNSUBA': 'Submitters - all, ordered',
+        'CLNSIGA': 'Clinical significance - all, ordered',
+        'CLNDATEA': 'Date pathogenicity last reviewed - all, ordered',
+        'CLNDATESUBA': 'Submission date - all, ordered',
+        'CLNREVSTATA': 'ClinVar review status for the Variation ID - all, ordered',
+        'CLNORA': 'Allele origin - all, ordered',
+        'CLNSCVA': 'SCV IDs - all, ordered',
+        'CLNDNA': 'Preferred disease name - all, ordered',
+        'CLNCOMA': 'Comment on clinical significance - all, ordered'
+    }
+
+    for key, value in vcf_header_dict.items():
+        add_line = f'##INFO=<ID={key},Number=.,Type=String,Description="{value}">'
+        header.append(add_line)
+    return header
+
+
+def append_info(vcf_df, xml_dict):
+    """
+    Append the xml-derived INFO fields to the INFO column
+
+    Args:
+        vcf_df: VCF dataframe
+        xml_dict: AnnotationTable returned by mine_xml, keyed by the index
+            of vcf_df
+    Returns:
+        vcf_df with the INFO column updated; rows without annotations are
+            left as they are
+    """
+    import pandas as pd  # loaded by the dataframe code paths only
+    info_add = pd.Series([xml_dict.info(idx) for idx in xml_dict],
+                         index=list(xml_dict), dtype=object)
+    info_add = info_add.reindex(vcf_df.index)
+    info = (vcf_df['INFO'] + ';' + info_add).fillna(vcf_df['INFO'])
+    # the updated INFO column goes last, as the original one is dropped
+    vcf_df = vcf_df.drop(columns=['INFO'])
+    vcf_df['INFO'] = info
+    return vcf_df
+
+
+def checkpoint_inputs(xml_file, id_dict, pre_may_2017):
+    """
+    Describe the inputs of mine_xml, so that a checkpoint is only resumed by
+    a run on the same XML file and VCF IDs
+    """
+    digest = hashlib.blake2b(digest_size=16)
+    for key_id in sorted(id_dict):
+        digest.update(key_id.encode() + b'\n')
+        digest.update(','.join(map(str, sorted(id_dict[key_id]))).encode())
+    stat = os.stat(xml_file)
+    return {'format_version': CHECKPOINT_FORMAT_VERSION,
+            'xml_file': os.path.abspath(xml_file),
+            'xml_size': stat.st_size, 'xml_mtime': stat.st_mtime,
+            'pre_may_2017': pre_may_2017, 'ids': digest.hexdigest()}
+
+
+def child_cpu_seconds():
+    """
+    Return the user and system CPU time in seconds of the finished child
+    processes, or None where it is not available (Windows)
+    """
+    try:
+        import resource  # Unix only
+    except ImportError:
+        return None
+    children = resource.getrusage(resource.RUSAGE_CHILDREN)
+    return children.ru_utime + children.ru_stime
+
+
+def expand_clinvar_vcf(xml_file, vcf_file, out_file, pre_may_2017=False,
+                       workers=1, index_file=None, streaming=False,
+                       engine='etree', gzip_backend='auto', metrics=None,
+                       profile_file=None, regions_file=None, ids_file=None,
+                       checkpoint_file=None, resume=False,
+                       checkpoint_interval=CHECKPOINT_INTERVAL,
+                       sort_merge=False, max_memory=SORT_MERGE_MEMORY,
+                       tmp_dir=None, pipeline=False):
+    """
+    Args:
+        xml_file: input ClinVar XML annotation file
+        vcf_file: input ClinVar VCF file
+        out_file: output annotated VCF
+        pre_may_2017: assume old format ClinVar file
+        workers: number of processes used to mine the XML file
+        index_file: index written by build-index, used in place of xml_file
+        streaming: annotate the VCF line by line instead of loading it into
+            a dataframe, so memory does not grow with the size of the VCF
+        engine: XML parser backend, one of XML_ENGINES
+        gzip_backend: decompression backend of a gzipped xml_file, one of
+            GZIP_BACKENDS or 'auto'
+        metrics: Metrics collecting the cost of each stage
+        profile_file: profile the XML mining stage into this file, see
+            profile_stage
+        regions_file: only annotate and write out the VCF records whose POS
+            is in the regions of this BED file
+        ids_file: only annotate and write out the VCF records with the
+            key_ids listed in this file (Variation IDs, or RCV accessions
+            with pre_may_2017)
+        checkpoint_file: save the state of the XML mining stage to this file
+            every checkpoint_interval seconds; it is removed once the output
+            is written
+        resume: start from the state saved in checkpoint_file, if it exists
+        checkpoint_interval: seconds between checkpoints
+        sort_merge: join the VCF and XML records by external sorting, so
+            memory is bounded by max_memory whatever the size of the inputs
+            (checkpoints are not taken), see sort_merge
+        max_memory: bytes of records buffered by each sort with sort_merge
+        tmp_dir: directory of the temporary files of sort_merge
+        pipeline: read, mine and (with streaming) write in threads connected
+            by bounded queues, see mine_xml_pipelined and PipelineStage
+    """
+    expand_clinvar_vcfs(xml_file, [vcf_file], [out_file],
+                        pre_may_2017=pre_may_2017, workers=workers,
+                        index_file=index_file, streaming=streaming,
+                        engine=engine, gzip_backend=gzip_backend,
+                        metrics=metrics, profile_file=profile_file,
+                        regions_file=regions_file, ids_file=ids_file,
+                        checkpoint_file=checkpoint_file, resume=resume,
+                        checkpoint_interval=checkpoint_interval,
+                        sort_merge=sort_merge, max_memory=max_memory,
+                        tmp_dir=tmp_dir, pipeline=pipeline)
+
+
+def expand_clinvar_vcfs(xml_file, vcf_files, out_files, pre_may_2017=False,
+                        workers=1, index_file=None, streaming=False,
+                        engine='etree', gzip_backend='auto', metrics=None,
+                        profile_file=None, regions_file=None, ids_file=None,
+                        checkpoint_file=None, resume=False,
+                        checkpoint_interval=CHECKPOINT_INTERVAL,
+                        sort_merge=False, max_memory=SORT_MERGE_MEMORY,
+                        tmp_dir=None, pipeline=False):
+    """
+    Annotate several VCF files, such as the GRCh37 and GRCh38 VCFs of a
+    release, from a single pass over the XML file. The records of the VCF
+    files are numbered one after the other, so one id_dict maps each key_id
+    to its records in all the files.
+
+    Args:
+        vcf_files: list of input ClinVar VCF files
+        out_files: output annotated VCF of each of vcf_files
+        see expand_clinvar_vcf for the others
+    """
+    if len(vcf_files) != len(out_files):
+        raise ValueError('Expected one output file per VCF file')
+    metrics = Metrics() if metrics is None else metrics
+    if sort_merge:
+        from clinvar_vcf.sort_merge import expand_clinvar_vcfs_sort_merge
+        expand_clinvar_vcfs_sort_merge(xml_file, vcf_files, out_files,
+                                       pre_may_2017=pre_may_2017,
+                                       workers=workers,
+                                       index_file=index_file, engine=engine,
+                                       gzip_backend=gzip_backend,
+                                       metrics=metrics,
+                                       profile_file=profile_file,
+                                       regions_file=regions_file,
+                                       ids_file=ids_file,
+                                       max_memory=max_memory,
+                                       tmp_dir=tmp_dir, pipeline=pipeline)
+        return
+    if streaming or regions_file is not None or ids_file is not None:
+        # subsets are filtered while the VCF is read line by line
+        expand_clinvar_vcfs_streaming(xml_file, vcf_files, out_files,
+                                      pre_may_2017=pre_may_2017,
+                                      workers=workers, index_file=index_file,
+                                      engine=engine,
+                                      gzip_backend=gzip_backend,
+                                      metrics=metrics,
+                                      profile_file=profile_file,
+                                      regions_file=regions_file,
+                                      ids_file=ids_file,
+                                      checkpoint_file=checkpoint_file,
+                                      resume=resume,
+                                      checkpoint_interval=checkpoint_interval,
+                                      pipeline=pipeline)
+        return
+
+    vcf_dfs = []
+    with metrics.stage('read_vcf') as stage:
+        for vcf_file, out_file in zip(vcf_files, out_files):
+            logging.info('Reading in vcf file %s', vcf_file)
+            header, vcf_df = read_vcf(vcf_file)
+            vcf_dfs.append(vcf_df)
+
+            logging.info('Writing out updated vcf header')
+            write_vcf_header(header, out_file)
+        stage['records'] = sum(len(vcf_df) for vcf_df in vcf_dfs)
+
+    with metrics.stage('lookup') as stage:
+        logging.info('Creating dictionary for looking up IDs')
+        id_dict = defaultdict(set)
+        offset = 0
+        for i, vcf_df in enumerate(vcf_dfs):
+            if pre_may_2017:
+                logging.info('VCF dataframe size:%s', vcf_df.shape)
+                logging.info('Expanding multiallelic variants')
+                vcf_df = split_multi_vcf(vcf_df)
+                logging.info('VCF dataframe size post expansion:%s',
+                             vcf_df.shape)
+            # the records of each file are numbered after those of the
+            # files before it
+            vcf_df.index = range(offset, offset + len(vcf_df))
+            if pre_may_2017:
+                # (Only works when RCV IDs are in INFO vcf column - field
+                # CLNACC. Works with ClinVar vcf older than May 2017)
+                for rcv_id, rows in split_vcf_info(vcf_df).items():
+                    id_dict[rcv_id].update(row + offset for row in rows)
+            else:
+                # (Only works when ClinVar Variation IDs are in ID vcf
+                # column. ClinVar vcf older than May 2017 won't work)
+                for variation_id, row in zip(vcf_df['ID'], vcf_df.index):
+                    id_dict[variation_id].add(row)
+            vcf_dfs[i] = vcf_df
+            offset += len(vcf_df)
+        stage['records'] = offset
+
+    with metrics.stage('mine_xml') as stage, \
+            profile_stage(profile_file):
+        logging.info('Mining through XML file')
+        xml_dict = mine_xml(xml_file, id_dict, pre_may_2017=pre_may_2017,
+                            workers=workers, index_file=index_file,
+                            engine=engine, gzip_backend=gzip_backend,
+                            metrics=metrics, checkpoint_file=checkpoint_file,
+                            resume=resume,
+                            checkpoint_interval=checkpoint_interval,
+                            pipeline=pipeline)
+        stage['records'] = metrics.counters['clinvar_sets_processed']
+
+    with metrics.stage('join_entries') as stage:
+        logging.info('Combining original INFO column with info extracted '
+                     'from xml')
+        vcf_dfs = [append_info(vcf_df, xml_dict) for vcf_df in vcf_dfs]
+        stage['records'] = len(xml_dict)
+
+    with metrics.stage('output') as stage:
+        logging.info('Writing out the main VCF body to output file')
+        for vcf_df, out_file in zip(vcf_dfs, out_files):
+            # using append mode because header already written
+            vcf_df.to_csv(out_file, mode='a', index=False, sep='\t',
+                          header=True)
+        stage['records'] = sum(len(vcf_df) for vcf_df in vcf_dfs)
+
+    if checkpoint_file is not None and os.path.exists(checkpoint_file):
+        os.remove(checkpoint_file)
+
+
+def expand_clinvar_vcfs_streaming(xml_file, vcf_files, out_files,
+                                  pre_may_2017=False, workers=1,
+                                  index_file=None, engine='etree',
+                                  gzip_backend='auto', metrics=None,
+                                  profile_file=None, regions_file=None,
+                                  ids_file=None, checkpoint_file=None,
+                                  resume=False,
+                                  checkpoint_interval=CHECKPOINT_INTERVAL,
+                                  pipeline=False):
+    """
+    Streaming version of expand_clinvar_vcfs: only the map of IDs to record
+    numbers is built up front, then each VCF is read again and each record
+    is written out as soon as it is annotated
+
+    Args:
+        see expand_clinvar_vcfs
+    """
+    metrics = Metrics() if metrics is None else metrics
+    select = read_selection(regions_file, ids_file, pre_may_2017=pre_may_2017)
+    headers = []
+    offsets = []
+    with metrics.stage('lookup') as stage:
+        logging.info('Creating dictionary for looking up IDs')
+        id_dict = defaultdict(set)
+        offset = 0
+        for vcf_file in vcf_files:
+            # the records of each file are numbered after those of the
+            # files before it
+            offsets.append(offset)
+            with get_handle(vcf_file, ftype='vcf') as f:
+                headers.append(read_vcf_header(f))
+                offset = map_vcf_ids(
+                    iter_vcf_records(f, pre_may_2017=pre_may_2017,
+                                     select=select),
+                    id_dict, pre_may_2017=pre_may_2017, first_row=offset)
+        stage['records'] = len(id_dict)
+
+    with metrics.stage('mine_xml') as stage, \
+            profile_stage(profile_file):
+        logging.info('Mining through XML file')
+        xml_dict = mine_xml(xml_file, id_dict, pre_may_2017=pre_may_2017,
+                            workers=workers, index_file=index_file,
+                            engine=engine, gzip_backend=gzip_backend,
+                            metrics=metrics, checkpoint_file=checkpoint_file,
+                            resume=resume,
+                            checkpoint_interval=checkpoint_interval,
+                            pipeline=pipeline)
+        stage['records'] = metrics.counters['clinvar_sets_processed']
+
+    with metrics.stage('output') as stage:
+        n = 0
+        for i, (vcf_file, out_file, header, offset) in enumerate(zip(
+                vcf_files, out_files, headers, offsets)):
+            logging.info('Writing out updated vcf header')
+            write_vcf_header(header, out_file)
+
+            logging.info('Writing out the main VCF body to output file')
+            with get_handle(vcf_file, ftype='vcf') as f, \
+                    open(out_file, 'a') as fout:
+                columns = next(line for line in f
+                               if not line.startswith('##'))
+                fout.write(columns.rstrip('\r\n') + '\n')
+                info_col = columns.rstrip('\r\n').split('\t').index('INFO')
+                blocks = format_vcf_records(
+                    iter_vcf_records(f, pre_may_2017=pre_may_2017,
+                                     select=select),
+                    xml_dict, info_col, first_row=offset)
+                if pipeline:
+                    # the vcf is read and annotated while blocks are written
+                    blocks = PipelineStage(f'output_lines_{i}', blocks,
+                                           metrics=metrics)
+                for block in blocks:
+                    fout.writelines(block)
+                    n += len(block)
+        stage['records'] = n
+
+    if checkpoint_file is not None and os.path.exists(checkpoint_file):
+        os.remove(checkpoint_file)
+
+
+def format_annotations(dct):
+    """
+    Return the INFO string for a {INFO field: list of values} dictionary
+    """
+    dct = join_entries(dct)  # join xml entries into strings
+    return ';'.join([k + '=' + v for k, v in dct.items()])
 
-    # Add extra column to vcf dataframe with info extracted from xml
-    for key, value in xml_dict.items():
-        xml_dict[key] = join_entries(value)  # join xml entries into strings
-        vcf_df.at[key, 'INFO_add'] = ';'.join(
-            [k + '=' + v for k, v in xml_dict[key].items()])
 
-    logging.info('Combining original INFO column with info extracted from xml')
-    vcf_df['INFO_updated'] = vcf_df['INFO'] + ';' + vcf_df['INFO_add']
-    vcf_df['INFO_updated'] = vcf_df['INFO_updated'].fillna(vcf_df['INFO'])
-    vcf_df = vcf_df.drop(columns=['INFO_add', 'INFO']).rename(
-        columns={'INFO_updated': 'INFO'})
+def format_vcf_records(records, xml_dict, info_col, first_row=0,
+                       lines_per_block=OUTPUT_BLOCK_LINES):
+    """
+    Append the annotations of xml_dict to the INFO column of VCF records
 
-    logging.info('Writing out the main VCF body to output file')
-    # using append mode because header already written
-    vcf_df.to_csv(out_file, mode='a', index=False, sep='\t', header=True)
+    Args:
+        records: lists of fields, as yielded by iter_vcf_records
+        xml_dict: AnnotationTable returned by mine_xml
+        info_col: index of the INFO column
+        first_row: row index of the first record
+        lines_per_block: number of lines per block
+    Yields:
+        lists of output lines, with line ends
+    """
+    block = []
+    for idx, fields in enumerate(records, first_row):
+        if idx in xml_dict:
+            fields[info_col] += ';' + xml_dict.info(idx)
+        block.append('\t'.join(fields) + '\n')
+        if len(block) == lines_per_block:
+            yield block
+            block = []
+    if block:
+        yield block
 
 
 def get_accession(elem, field='SCV', record_id=None):
@@ -123,6 +1175,88 @@ def get_accession(elem, field='SCV', record_id=None):
     return val_list
 
 
+def get_annotations(elem, record_id=None):
+    """
+    Extract the xml-derived INFO fields from a ClinVarSet element
+
+    Args:
+        elem: ClinVarSet XML element
+        record_id: supply for detailed feeback in logging
+    Returns:
+        dictionary of {INFO field: list of values}, one value per submission
+    """
+    cva = elem.findall('./ClinVarAssertion')
+    annotations = {}
+    annotations['CLNSUBA'] = get_submitters(elem)
+    assertion_values = get_assertion_values(cva)
+    if assertion_values is not None:
+        annotations.update(assertion_values)
+    else:
+        # irregular record: run each extractor, which logs what is missing
+        annotations['CLNREVSTATA'] = get_clinsig(
+                cva, field='status_ordered', record_id=record_id)
+        annotations['CLNDATEA'] = get_clinsig(
+                cva, field='last_eval', record_id=record_id)
+        annotations['CLNDATESUBA'] = get_submitdate(
+                cva, field='submitterDate', record_id=record_id)
+        annotations['CLNSIGA'] = get_clinsig(
+                cva, field='description', record_id=record_id)
+        annotations['CLNORA'] = get_origin(cva, as_set=False)
+        annotations['CLNCOMA'] = get_clinsig(
+                cva, field='comment', record_id=record_id)
+        annotations['CLNSCVA'] = get_accession(cva, field='SCV')
+
+    # Duplicate disease name if multiple SCV entries in one ClinVarSet
+    # record
+    scv_ids = annotations['CLNSCVA']
+    disease_name = '/'.join(get_traits(elem))
+    annotations['CLNDNA'] = [disease_name] * len(scv_ids)
+    return annotations
+
+
+def get_assertion_values(elem):
+    """
+    Read the per-submission INFO fields of get_annotations in one walk over
+    the ClinVarAssertion elements
+
+    Args:
+        elem: list of ClinVarAssertion elements
+    Returns:
+        dictionary of {INFO field: list of values} for CLNREVSTATA to
+            CLNSCVA, or None if a ClinVarSubmissionID, ClinVarAccession,
+            ReviewStatus or Description element is missing
+    """
+    status, last_eval, submit_date, description, origin, comment, scv = (
+        [], [], [], [], [], [], [])
+    for assertion in elem:
+        submission = assertion.find('./ClinVarSubmissionID')
+        accession = assertion.find('./ClinVarAccession')
+        if submission is None or accession is None:
+            return None
+        for clinsig in assertion.findall('./ClinicalSignificance'):
+            review_status = clinsig.find('./ReviewStatus')
+            desc = clinsig.find('./Description')
+            if review_status is None or desc is None:
+                return None
+            status.append(review_status.text)
+            last_eval.append(
+                clinsig.attrib.get('DateLastEvaluated', '0000-00-00'))
+            description.append(desc.text)
+            node = clinsig.find('./Comment')
+            comment.append('' if node is None else node.text)
+        submit_date.append(submission.attrib.get('submitterDate',
+                                                 '0000-00-00'))
+        node = assertion.find('./ObservedIn/Sample/Origin')
+        origin.append('' if node is None else node.text)
+        if accession.attrib.get('Type') == 'SCV':
+            scv.append(accession.attrib.get('Acc'))
+    if not status:
+        return None
+    return {'CLNREVSTATA': status, 'CLNDATEA': last_eval,
+            'CLNDATESUBA': submit_date, 'CLNSIGA': description,
+            'CLNORA': origin, 'CLNCOMA': comment, 'CLNSCVA': scv}
+
+
 def get_clinsig(elem, field=None, count=False, record_id=None):
     """
     Args:
@@ -197,18 +1331,26 @@ def get_clinsig(elem, field=None, count=False, record_id=None):
     raise NotImplementedError(f'field {field} is not handled')
 
 
-def get_handle(fname, ftype='xml'):
+def get_handle(fname, ftype='xml', gzip_backend='auto'):
     """
     Return an opened file handle
 
     Args:
         fname: name of the file
-        ftype: 'xml' or 'vcf'
+        ftype: 'xml' or 'vcf'; XML files are opened in binary mode, and an
+            uncompressed XML file is mapped into memory (see MmapReader)
+        gzip_backend: decompression backend of a gzipped XML file, see
+            open_xml_gz
     """
     if fname[-3:] == '.gz' and ftype == 'xml':
-        handle = gzip.open(fname)
+        handle = open_xml_gz(fname, backend=gzip_backend)
     elif fname[-3:] == '.gz' and ftype == 'vcf':
         handle = gzip.open(fname, 'rt')
+    elif ftype == 'xml':
+        handle = open(fname, 'rb')
+        # an empty file or a pipe cannot be mapped
+        if os.path.isfile(fname) and os.path.getsize(fname):
+            handle = MmapReader(handle)
     else:
         handle = open(fname)
     return handle
@@ -229,6 +1371,18 @@ def get_origin(elem, as_set=True):
     return origin_list
 
 
+def get_record_ids(elem, pre_may_2017=False):
+    """
+    Return (key_id, ms_id) for a ClinVarSet element, where key_id is the ID
+    used to look up VCF records: the MeasureSet ID, or the RCV accession
+    when pre_may_2017 is set
+    """
+    ms_id = elem.find('.//MeasureSet').attrib.get('ID')
+    key_id = (elem.find('.//ClinVarAccession').attrib.get('Acc')
+              if pre_may_2017 else ms_id)
+    return key_id, ms_id
+
+
 def get_submitdate(elem, field='submitterDate', record_id=None):
     """
     Extracts submitterDate from ClinVarSubmissionID
@@ -273,6 +1427,218 @@ def get_traits(elem):
         return trait_values
 
 
+def imap_xml_chunks(xml_file, func, workers=2, initializer=None, initargs=(),
+                    records_per_chunk=XML_CHUNK_RECORDS, gzip_backend='auto',
+                    metrics=None, skip=0):
+    """
+    Apply func to the chunks of iter_clinvar_set_chunks in a pool of
+    processes
+
+    Args:
+        xml_file: input ClinVar XML annotation file
+        func: picklable function of a chunk
+        workers: number of processes
+        initializer, initargs: passed to multiprocessing.Pool
+        records_per_chunk: number of ClinVarSet elements per task
+        gzip_backend: decompression backend of a gzipped xml_file
+        metrics: Metrics counting the XML bytes read
+        skip: number of ClinVarSet elements to skip, see
+            iter_clinvar_set_chunks
+    Yields:
+        func(chunk) for each chunk, in the order of the XML file
+    """
+    import multiprocessing  # only needed with more than one worker
+    with multiprocessing.Pool(workers, initializer=initializer,
+                              initargs=initargs) as pool, \
+            get_handle(xml_file, gzip_backend=gzip_backend) as handle:
+        if metrics is not None:
+            handle = metrics.reader(handle)
+        # keep a bounded number of chunks in flight so that a slow pool
+        # does not pull the whole XML file into memory
+        pending = deque()
+        for chunk in iter_clinvar_set_chunks(handle, records_per_chunk,
+                                             skip=skip):
+            # a memoryview of a mapped file cannot be pickled
+            pending.append(pool.apply_async(func, (bytes(chunk),)))
+            if len(pending) >= 2 * workers:
+                yield pending.popleft().get()
+        while pending:
+            yield pending.popleft().get()
+
+
+def init_mining_worker(keys, pre_may_2017, engine='etree'):
+    """
+    Pool initializer storing the lookup keys for mine_xml_chunk
+    """
+    _WORKER_STATE['keys'] = keys
+    _WORKER_STATE['pre_may_2017'] = pre_may_2017
+    _WORKER_STATE['engine'] = engine
+
+
+def iter_annotated_records(xml_file, vcf_file, pre_may_2017=False, workers=1,
+                           index_file=None, engine='etree',
+                           gzip_backend='auto', metrics=None,
+                           regions_file=None, ids_file=None):
+    """
+    Annotate a VCF file like expand_clinvar_vcf, but yield the records
+    instead of writing them out. The XML file is mined when the first record
+    is requested; the VCF is then read one line at a time.
+
+    Args:
+        see expand_clinvar_vcf
+    Yields:
+        AnnotatedRecord for each selected VCF record (each ALT allele with
+            pre_may_2017), in the order of the VCF file; the annotation
+            values are not escaped for the INFO column
+    """
+    metrics = Metrics() if metrics is None else metrics
+    select = read_selection(regions_file, ids_file, pre_may_2017=pre_may_2017)
+    header, id_dict = read_vcf_ids(vcf_file, pre_may_2017=pre_may_2017,
+                                   select=select)
+    xml_dict = mine_xml(xml_file, id_dict, pre_may_2017=pre_may_2017,
+                        workers=workers, index_file=index_file,
+                        engine=engine, gzip_backend=gzip_backend,
+                        metrics=metrics)
+    with get_handle(vcf_file, ftype='vcf') as f:
+        for idx, fields in enumerate(iter_vcf_records(
+                f, pre_may_2017=pre_may_2017, select=select)):
+            if idx in xml_dict:
+                annotations = xml_dict[idx]
+            else:
+                annotations = {field: [] for field in INFO_FIELDS}
+            yield AnnotatedRecord(fields[0], int(fields[1]), *fields[2:8],
+                                  annotations)
+
+
+def iter_clinvar_set_chunks(handle, records_per_chunk=XML_CHUNK_RECORDS,
+                            block_size=XML_BLOCK_SIZE, skip=0):
+    """
+    Split a binary XML stream into chunks of whole ClinVarSet elements
+
+    Args:
+        handle: XML file handle opened in binary mode
+        records_per_chunk: maximum number of ClinVarSet elements per chunk
+        block_size: number of bytes read from handle at a time
+        skip: number of ClinVarSet elements dropped from the start of the
+            stream, e.g. those mined before a checkpoint
+    Yields:
+        bytes running from the start of a <ClinVarSet> element to the end
+        of a </ClinVarSet> element; the enclosing ReleaseSet is dropped.
+        The chunks of an MmapReader are memoryview slices of the file, see
+        iter_mapped_clinvar_set_chunks
+    """
+    if getattr(handle, 'mapped', None) is not None:
+        yield from iter_mapped_clinvar_set_chunks(handle, records_per_chunk,
+                                                  skip=skip)
+        return
+    buffer = bytearray()
+    search_from = 0
+    count = 0
+    while True:
+        block = handle.read(block_size)
+        buffer += block
+        skipped_to = 0
+        while True:
+            end = buffer.find(CLINVARSET_END, search_from)
+            if end == -1:
+                search_from = max(search_from,
+                                  len(buffer) - len(CLINVARSET_END))
+                break
+            search_from = end + len(CLINVARSET_END)
+            if skip:
+                skip -= 1
+                skipped_to = search_from
+                if skip:
+                    continue
+            if skipped_to:
+                # drop the skipped elements once per block, not per element
+                del buffer[:skipped_to]
+                search_from -= skipped_to
+                skipped_to = 0
+                continue
+            count += 1
+            if count == records_per_chunk:
+                start = buffer.find(CLINVARSET_START)
+                yield bytes(buffer[start:search_from])
+                del buffer[:search_from]
+                search_from = 0
+                count = 0
+        if skipped_to:
+            del buffer[:skipped_to]
+            search_from -= skipped_to
+        if not block:
+            break
+    if count:
+        start = buffer.find(CLINVARSET_START)
+        end = buffer.rfind(CLINVARSET_END) + len(CLINVARSET_END)
+        yield bytes(buffer[start:end])
+
+
+def iter_mapped_clinvar_set_chunks(handle, records_per_chunk=XML_CHUNK_RECORDS,
+                                   skip=0):
+    """
+    iter_clinvar_set_chunks of an MmapReader: the elements are found in the
+    mapped file and the chunks are memoryview slices of it, so the
+    elements that are not parsed are never copied
+
+    Args:
+        handle: MmapReader, or CountingReader of one
+        records_per_chunk, skip: see iter_clinvar_set_chunks
+    Yields:
+        memoryview of each chunk
+    """
+    mapped = handle.mapped
+    pos = handle.tell()
+    count = 0
+    while True:
+        end = mapped.find(CLINVARSET_END, pos)
+        if end == -1:
+            break
+        pos = end + len(CLINVARSET_END)
+        if skip:
+            skip -= 1
+            handle.read_view(pos - handle.tell())
+            continue
+        count += 1
+        if count == records_per_chunk:
+            yield read_mapped_chunk(handle, pos)
+            count = 0
+    if count:
+        yield read_mapped_chunk(handle, pos)
+    handle.read_view()  # the end of the ReleaseSet
+
+
+def iter_vcf_records(lines, pre_may_2017=False, select=None):
+    """
+    Split VCF body lines into fields
+
+    Args:
+        lines: iterable of VCF lines; header and blank lines are skipped
+        pre_may_2017: split multiallelic records into one record per ALT,
+            as split_multi_vcf does
+        select: predicate on the fields of the records to yield, such as
+            a RecordSelection, applied after splitting; all records if None
+    Yields:
+        list of fields for each record
+    """
+    for line in lines:
+        line = line.rstrip('\r\n')
+        if not line or line.startswith('#'):
+            continue
+        fields = line.split('\t')
+        alts = fields[4]
+        if pre_may_2017 and ',' in alts:
+            alts = alts.split(',')
+            for alt, info in zip(alts, split_multi_info(fields[7], len(alts))):
+                split_fields = fields[:]
+                split_fields[4] = alt
+                split_fields[7] = info
+                if select is None or select(split_fields):
+                    yield split_fields
+        elif select is None or select(fields):
+            yield fields
+
+
 def join_entries(dct, with_sep='|'):
     """
     Args:
@@ -284,17 +1650,529 @@ def join_entries(dct, with_sep='|'):
         if isinstance(value, set):
             value = sorted(value)
         if isinstance(value, (set, list)):
-            value = [
-                replace_sep(string=v, sep=[';', '|', ' ', '"', ','],
-                            replace_with=[':', ':', '_', '', '&'])
-                for v in value
-            ]
-            dct[key] = remove_newlines_and_tabs(with_sep.join(value))
+            dct[key] = with_sep.join(v.translate(INFO_VALUE_ESCAPES)
+                                     for v in value)
         if value is None:
             dct[key] = ''
     return dct
 
 
+def map_vcf_ids(records, id_dict, pre_may_2017=False, first_row=0):
+    """
+    Add the IDs of VCF records to a dictionary of {id: set of record numbers}
+
+    Args:
+        records: lists of fields, as yielded by iter_vcf_records
+        id_dict: defaultdict(set) updated in place
+        pre_may_2017: map the RCV accessions in INFO field CLNACC, as
+            split_vcf_info does; otherwise map the ID column
+        first_row: number of the first record
+    Returns:
+        number following that of the last record
+    """
+    row = first_row - 1
+    for row, fields in enumerate(records, first_row):
+        if pre_may_2017:
+            for rcv_id in split_rcv_ids(fields[7], row):
+                id_dict[rcv_id].add(row)
+        else:
+            id_dict[fields[2]].add(row)
+    return row + 1
+
+
+def mine_clinvar_set(span, keys, pre_may_2017=False, engine='etree'):
+    """
+    Extract annotations from the raw bytes of one ClinVarSet element
+
+    The key_id is first read from the raw start tag of the first MeasureSet
+    (or ClinVarAccession when pre_may_2017 is set) so that records that are
+    not wanted are rejected without being parsed.
+
+    Args:
+        span: bytes (or memoryview) of a ClinVarSet element
+        keys: key_ids to extract
+        pre_may_2017: key on RCV accession instead of MeasureSet ID
+        engine: XML parser backend, one of XML_ENGINES
+    Returns:
+        (key_id, ms_id, annotations), or None if key_id is not in keys
+    """
+    key_id = scan_key_id(span, pre_may_2017=pre_may_2017)
+    if key_id is not None and key_id not in keys:
+        return None
+    return XML_ENGINES[engine](span, keys, pre_may_2017=pre_may_2017)
+
+
+def mine_xml(xml_file, id_dict, pre_may_2017=False, workers=1,
+             index_file=None, engine='etree', gzip_backend='auto',
+             metrics=None, checkpoint_file=None, resume=False,
+             checkpoint_interval=CHECKPOINT_INTERVAL, pipeline=False):
+    """
+    Extract the xml-derived INFO fields for every VCF record in id_dict
+
+    Args:
+        xml_file: input ClinVar XML annotation file
+        id_dict: dictionary of {key_id: set of VCF row indices}
+        pre_may_2017: key on RCV accession instead of MeasureSet ID
+        workers: number of processes; with more than one the XML stream is
+            split on ClinVarSet boundaries and the chunks are mined in
+            parallel, results being merged back in the original order
+        index_file: index written by build-index; when given the annotations
+            are looked up there and xml_file is not read
+        engine: XML parser backend, one of XML_ENGINES
+        gzip_backend: decompression backend of a gzipped xml_file
+        metrics: Metrics counting the ClinVarSet records processed and
+            matched, and the XML bytes read
+        checkpoint_file: save the state of the mining to this file every
+            checkpoint_interval seconds and when it is done, see
+            write_checkpoint (not used with index_file)
+        resume: start from the state saved in checkpoint_file, if it exists
+        checkpoint_interval: seconds between checkpoints
+        pipeline: read and mine the XML file on background threads, see
+            mine_xml_pipelined (not used with index_file)
+    Returns:
+        AnnotationTable of {row index: {INFO field: list of values}}
+    """
+    xml_dict = AnnotationTable()
+    metrics = Metrics() if metrics is None else metrics
+    n = 0
+    n_matched = 0
+    if index_file is not None:
+        checkpoint_file = None
+    if checkpoint_file is not None:
+        inputs = checkpoint_inputs(xml_file, id_dict, pre_may_2017)
+        if resume and os.path.exists(checkpoint_file):
+            n, n_matched, xml_dict = read_checkpoint(checkpoint_file, inputs)
+            logging.info('Resuming after %s ClinVarSet records from %s', n,
+                         checkpoint_file)
+        last_checkpoint = time.monotonic()
+
+    if index_file is not None:
+        from clinvar_vcf.annotation_index import mine_index
+        records = mine_index(index_file, id_dict.keys(),
+                             pre_may_2017=pre_may_2017)
+    elif pipeline:
+        records = mine_xml_pipelined(xml_file, id_dict.keys(),
+                                     pre_may_2017=pre_may_2017,
+                                     workers=workers, engine=engine,
+                                     gzip_backend=gzip_backend,
+                                     metrics=metrics, skip=n)
+    elif workers > 1:
+        records = mine_xml_parallel(xml_file, id_dict.keys(),
+                                    pre_may_2017=pre_may_2017,
+                                    workers=workers, engine=engine,
+                                    gzip_backend=gzip_backend,
+                                    metrics=metrics, skip=n)
+    else:
+        records = mine_xml_sequential(xml_file, id_dict.keys(),
+                                      pre_may_2017=pre_may_2017,
+                                      engine=engine,
+                                      gzip_backend=gzip_backend,
+                                      metrics=metrics, skip=n)
+
+    for n_processed, matches in records:
+        for key_id, _, annotations in matches:
+            xml_dict.add_many(id_dict[key_id], annotations)
+        n_matched += len(matches)
+
+        # Progress report
+        if (n + n_processed) // 50000 > n // 50000:
+            logging.info('%s records processed',
+                         (n + n_processed) // 50000 * 50000)
+        n += n_processed
+
+        if (checkpoint_file is not None and time.monotonic()
+                - last_checkpoint >= checkpoint_interval):
+            write_checkpoint(checkpoint_file, inputs, n, n_matched, xml_dict)
+            last_checkpoint = time.monotonic()
+
+    if checkpoint_file is not None:
+        write_checkpoint(checkpoint_file, inputs, n, n_matched, xml_dict)
+    logging.info('Finished mining through XML file')
+    logging.info('Processed %s ClinVarSet records', n)
+    metrics.count('clinvar_sets_processed', n)
+    metrics.count('clinvar_sets_matched', n_matched)
+    metrics.count('clinvar_sets_skipped', n - n_matched)
+    metrics.count('vcf_records_annotated', len(xml_dict))
+    return xml_dict
+
+
+def mine_xml_chunk(chunk, keys=None, pre_may_2017=False, engine='etree'):
+    """
+    Extract annotations from a chunk produced by iter_clinvar_set_chunks
+
+    Args:
+        chunk: bytes (or memoryview) holding one or more whole ClinVarSet
+            elements
+        keys: key_ids to extract; if not given keys, pre_may_2017 and
+            engine are those set by init_mining_worker
+        pre_may_2017: key on RCV accession instead of MeasureSet ID
+        engine: XML parser backend, one of XML_ENGINES
+    Returns:
+        (n, matches) where n is the number of ClinVarSet elements in the
+            chunk and matches is a list of (key_id, ms_id, annotations)
+    """
+    if keys is None:
+        keys = _WORKER_STATE['keys']
+        pre_may_2017 = _WORKER_STATE['pre_may_2017']
+        engine = _WORKER_STATE['engine']
+    n = 0
+    matches = []
+    for span in split_clinvar_sets(chunk):
+        n += 1
+        match = mine_clinvar_set(span, keys, pre_may_2017=pre_may_2017,
+                                 engine=engine)
+        if match is not None:
+            matches.append(match)
+    return n, matches
+
+
+def mine_xml_parallel(xml_file, keys, pre_may_2017=False, workers=2,
+                      records_per_chunk=XML_CHUNK_RECORDS, engine='etree',
+                      gzip_backend='auto', metrics=None, skip=0):
+    """
+    Mine an XML file with a pool of processes
+
+    Args:
+        xml_file: input ClinVar XML annotation file
+        keys: key_ids to extract
+        pre_may_2017: key on RCV accession instead of MeasureSet ID
+        workers: number of processes
+        records_per_chunk: number of ClinVarSet elements per task
+        engine: XML parser backend, one of XML_ENGINES
+        gzip_backend: decompression backend of a gzipped xml_file
+        metrics: Metrics counting the XML bytes read
+        skip: number of ClinVarSet elements to skip, see
+            iter_clinvar_set_chunks
+    Yields:
+        (n, matches) per chunk, in the order of the XML file
+    """
+    if not isinstance(keys, AllKeys):
+        keys = set(keys)
+    yield from imap_xml_chunks(xml_file, mine_xml_chunk, workers=workers,
+                               initializer=init_mining_worker,
+                               initargs=(keys, pre_may_2017, engine),
+                               records_per_chunk=records_per_chunk,
+                               gzip_backend=gzip_backend, metrics=metrics,
+                               skip=skip)
+
+
+def mine_xml_pipelined(xml_file, keys, pre_may_2017=False, workers=1,
+                       engine='etree', gzip_backend='auto', metrics=None,
+                       skip=0):
+    """
+    Mine an XML file in a pipeline of threads connected by bounded queues,
+    see PipelineStage: the 'xml_chunks' stage reads (and decompresses) the
+    file and splits it into chunks of ClinVarSet elements, the
+    'mined_chunks' stage parses them and extracts their annotations, and
+    the caller consumes the annotations. With more than one worker the
+    chunks are mined by mine_xml_parallel on the 'mined_chunks' thread.
+
+    Args:
+        see mine_xml_parallel
+    Yields:
+        (n, matches) per chunk, in the order of the XML file
+    """
+    if workers > 1:
+        yield from PipelineStage(
+            'mined_chunks',
+            mine_xml_parallel(xml_file, keys, pre_may_2017=pre_may_2017,
+                              workers=workers, engine=engine,
+                              gzip_backend=gzip_backend, metrics=metrics,
+                              skip=skip),
+            metrics=metrics)
+        return
+    with get_handle(xml_file, gzip_backend=gzip_backend) as handle:
+        if metrics is not None:
+            handle = metrics.reader(handle)
+        chunks = PipelineStage('xml_chunks',
+                               iter_clinvar_set_chunks(handle, skip=skip),
+                               metrics=metrics)
+        yield from PipelineStage(
+            'mined_chunks',
+            (mine_xml_chunk(chunk, keys, pre_may_2017=pre_may_2017,
+                            engine=engine) for chunk in chunks),
+            metrics=metrics)
+
+
+def mine_xml_sequential(xml_file, keys, pre_may_2017=False, engine='etree',
+                        gzip_backend='auto', metrics=None, skip=0):
+    """
+    Mine an XML file one ClinVarSet element at a time in the current process
+
+    Args:
+        xml_file: input ClinVar XML annotation file
+        keys: key_ids to extract
+        pre_may_2017: key on RCV accession instead of MeasureSet ID
+        engine: XML parser backend, one of XML_ENGINES
+        gzip_backend: decompression backend of a gzipped xml_file
+        metrics: Metrics counting the XML bytes read
+        skip: number of ClinVarSet elements to skip, see
+            iter_clinvar_set_chunks
+    Yields:
+        (1, matches) per ClinVarSet element
+    """
+    with get_handle(xml_file, gzip_backend=gzip_backend) as handle:
+        if metrics is not None:
+            handle = metrics.reader(handle)
+        for span in iter_clinvar_set_chunks(handle, records_per_chunk=1,
+                                            skip=skip):
+            match = mine_clinvar_set(span, keys, pre_may_2017=pre_may_2017,
+                                     engine=engine)
+            yield 1, [] if match is None else [match]
+
+
+def open_gzip(fname):
+    """
+    Gzip backend 'gzip': the standard library gzip module, read ahead on a
+    background thread
+    """
+    return ReadAheadReader(gzip.open(fname))
+
+
+def open_gzip_isal(fname):
+    """
+    Gzip backend 'isal': python-isal, whose inflate is several times faster
+    than zlib, decompressing on a background thread
+    """
+    from isal import igzip_threaded  # optional dependency
+    return igzip_threaded.open(fname, 'rb', threads=1,
+                               block_size=XML_BLOCK_SIZE)
+
+
+def open_gzip_zlib_ng(fname):
+    """
+    Gzip backend 'zlib-ng': python-zlib-ng, decompressing on a background
+    thread
+    """
+    from zlib_ng import gzip_ng_threaded  # optional dependency
+    return gzip_ng_threaded.open(fname, 'rb', threads=1,
+                                 block_size=XML_BLOCK_SIZE)
+
+
+def open_xml_gz(fname, backend='auto'):
+    """
+    Open a gzipped XML file for binary reading
+
+    Args:
+        fname: name of the file
+        backend: one of GZIP_BACKENDS, or 'auto' for the first of them that
+            is installed
+    """
+    if backend == 'auto':
+        for name, opener in GZIP_BACKENDS.items():
+            try:
+                handle = opener(fname)
+            except ImportError:
+                continue
+            break
+    else:
+        name = backend
+        handle = GZIP_BACKENDS[backend](fname)
+    logging.info('Decompressing %s with the %s backend', fname, name)
+    return handle
+
+
+def parse_clinvar_set_etree(span, keys, pre_may_2017=False):
+    """
+    XML engine 'etree': parse a ClinVarSet with xml.etree.ElementTree and
+    run the get_* extractors on it
+
+    Args:
+        span: bytes of a ClinVarSet element
+        keys: key_ids to extract
+        pre_may_2017: key on RCV accession instead of MeasureSet ID
+    Returns:
+        (key_id, ms_id, annotations), or None if key_id is not in keys
+    """
+    elem = ET.fromstring(span)
+    key_id, ms_id = get_record_ids(elem, pre_may_2017=pre_may_2017)
+    if key_id not in keys:
+        return None
+    return key_id, ms_id, get_annotations(elem, record_id=ms_id)
+
+
+def parse_clinvar_set_expat(span, keys, pre_may_2017=False):
+    """
+    XML engine 'expat': fill the annotations straight from expat callbacks,
+    without building an element tree. Records that ExpatClinVarSet does not
+    handle are passed to parse_clinvar_set_etree.
+
+    Args:
+        see parse_clinvar_set_etree
+    """
+    record = ExpatClinVarSet().parse(span)
+    if not record.regular:
+        return parse_clinvar_set_etree(span, keys, pre_may_2017=pre_may_2017)
+    ms_id = record.measure_set.get('ID')
+    key_id = record.accession.get('Acc') if pre_may_2017 else ms_id
+    if key_id not in keys:
+        return None
+    return key_id, ms_id, record.annotations()
+
+
+def parse_clinvar_set_lxml(span, keys, pre_may_2017=False):
+    """
+    XML engine 'lxml': parse a ClinVarSet with lxml, which is faster than
+    xml.etree.ElementTree, and run the get_* extractors on it
+
+    Args:
+        see parse_clinvar_set_etree
+    """
+    from lxml import etree  # optional dependency, only needed here
+    elem = etree.fromstring(span)
+    key_id, ms_id = get_record_ids(elem, pre_may_2017=pre_may_2017)
+    if key_id not in keys:
+        return None
+    return key_id, ms_id, get_annotations(elem, record_id=ms_id)
+
+
+def peak_rss_mb():
+    """
+    Return the peak resident set size in MB of this process or, if larger,
+    of its largest finished child process, or None where it is not available
+    (Windows)
+    """
+    try:
+        import resource  # Unix only
+    except ImportError:
+        return None
+    peak = max(resource.getrusage(resource.RUSAGE_SELF).ru_maxrss,
+               resource.getrusage(resource.RUSAGE_CHILDREN).ru_maxrss)
+    if sys.platform == 'darwin':  # ru_maxrss is in bytes, else in kB
+        peak //= 1024
+    return round(peak / 1024, 1)
+
+
+@contextmanager
+def profile_stage(profile_file):
+    """
+    Profile the body of a with statement into profile_file: an HTML report
+    with pyinstrument if the name ends with .html, else cProfile stats that
+    can be read with pstats or snakeviz. Does nothing if profile_file is None.
+    """
+    if profile_file is None:
+        yield
+    elif profile_file.endswith('.html'):
+        from pyinstrument import Profiler  # optional dependency
+        profiler = Profiler()
+        profiler.start()
+        try:
+            yield
+        finally:
+            profiler.stop()
+            with open(profile_file, 'w') as f:
+                f.write(profiler.output_html())
+    else:
+        import cProfile
+        profiler = cProfile.Profile()
+        profiler.enable()
+        try:
+            yield
+        finally:
+            profiler.disable()
+            profiler.dump_stats(profile_file)
+
+
+def read_bed_regions(fname):
+    """
+    Read the regions of a BED file (can be .gz), merging those that overlap
+
+    Args:
+        fname: name of the file; browser, track and comment lines are
+            skipped, and a 'chr' prefix of the chromosome names is dropped
+    Returns:
+        dictionary of {chromosome: (starts, ends)}, two sorted lists of the
+            0-based start and end of each merged region
+    """
+    intervals = defaultdict(list)
+    with get_handle(fname, ftype='vcf') as f:
+        for line in f:
+            if not line.strip() or line.startswith(('#', 'browser', 'track')):
+                continue
+            chrom, start, end = line.split('\t')[:3]
+            intervals[strip_chr(chrom)].append((int(start), int(end)))
+    regions = {}
+    for chrom, chrom_intervals in intervals.items():
+        starts, ends = [], []
+        for start, end in sorted(chrom_intervals):
+            if starts and start <= ends[-1]:
+                ends[-1] = max(ends[-1], end)
+            else:
+                starts.append(start)
+                ends.append(end)
+        regions[chrom] = (starts, ends)
+    return regions
+
+
+def read_checkpoint(fname, inputs):
+    """
+    Read a checkpoint written by write_checkpoint
+
+    Args:
+        fname: checkpoint file
+        inputs: checkpoint_inputs of the current run
+    Returns:
+        (n, n_matched, xml_dict) where n is the number of ClinVarSet
+            records mined before the checkpoint
+    Raises:
+        ValueError if the checkpoint was written for other inputs
+    """
+    with open(fname, 'rb') as f:
+        state = pickle.load(f)
+    if state['inputs'] != inputs:
+        raise ValueError(f'{fname} is a checkpoint of another XML file, VCF '
+                         f'or version')
+    return state['n'], state['n_matched'], state['xml_dict']
+
+
+def read_id_list(fname, pre_may_2017=False):
+    """
+    Read a file of key_ids, one per line (can be .gz)
+
+    Args:
+        fname: name of the file; blank and comment lines are skipped
+        pre_may_2017: the file lists RCV accessions, whose version is
+            dropped; otherwise Variation IDs
+    Returns:
+        set of key_ids
+    """
+    ids = set()
+    with get_handle(fname, ftype='vcf') as f:
+        for line in f:
+            key_id = line.strip()
+            if not key_id or key_id.startswith('#'):
+                continue
+            if pre_may_2017:
+                key_id = key_id.split('.')[0]
+            ids.add(key_id)
+    return ids
+
+
+def read_selection(regions_file=None, ids_file=None, pre_may_2017=False):
+    """
+    Return the RecordSelection of a BED file and/or a file of key_ids, or
+    None if neither is given
+    """
+    if regions_file is None and ids_file is None:
+        return None
+    return RecordSelection(
+        regions=None if regions_file is None
+        else read_bed_regions(regions_file),
+        ids=None if ids_file is None
+        else read_id_list(ids_file, pre_may_2017=pre_may_2017),
+        pre_may_2017=pre_may_2017)
+
+
+def read_mapped_chunk(handle, end):
+    """
+    Read an MmapReader up to end, returning the memoryview of the first
+    ClinVarSet element from there on
+    """
+    start = handle.tell()
+    first = handle.mapped.find(CLINVARSET_START, start, end)
+    return handle.read_view(end - start)[first - start:]
+
+
 def read_vcf(fname):
     """
     Read a VCF file.
@@ -313,6 +2191,7 @@ def read_vcf(fname):
                 header.append(line.strip())
             else:
                 lines.append(line)
+    import pandas as pd  # loaded by the dataframe code paths only
     vcf = pd.read_csv(
         io.StringIO(''.join(lines)),
         dtype={'#CHROM': str, 'POS': int, 'ID': str, 'REF': str, 'ALT': str,
@@ -322,6 +2201,47 @@ def read_vcf(fname):
     return (header, vcf)
 
 
+def read_vcf_header(handle):
+    """
+    Read the meta-information lines of an open VCF file, leaving the handle
+    after the #CHROM line
+
+    Returns:
+        list of header lines
+    """
+    header = []
+    for line in handle:
+        if not line.startswith('##'):
+            break
+        header.append(line.strip())
+    return header
+
+
+def read_vcf_ids(fname, pre_may_2017=False, select=None):
+    """
+    Read the header of a VCF file and map its IDs to record numbers without
+    loading the records
+
+    Args:
+        fname: name of the file
+        pre_may_2017: map the RCV accessions in INFO field CLNACC of the
+            records split by iter_vcf_records, as split_vcf_info does;
+            otherwise map the ID column
+        select: only number the records selected by this predicate, see
+            iter_vcf_records
+    Returns:
+        (header, id_dict) where header is a list of header lines and id_dict
+            is a dictionary of {id: set of record numbers}
+    """
+    id_dict = defaultdict(set)
+    with get_handle(fname, ftype='vcf') as f:
+        header = read_vcf_header(f)
+        map_vcf_ids(iter_vcf_records(f, pre_may_2017=pre_may_2017,
+                                     select=select),
+                    id_dict, pre_may_2017=pre_may_2017)
+    return header, id_dict
+
+
 def remove_newlines_and_tabs(string):
     """
     Replace each tab and newline character with a single space
@@ -345,6 +2265,71 @@ def replace_sep(string, sep, replace_with):
     return string
 
 
+def scan_key_id(span, pre_may_2017=False):
+    """
+    Read the key_id of a ClinVarSet element from its raw bytes, as
+    get_record_ids would find it, without parsing the element
+
+    Args:
+        span: bytes of a ClinVarSet element
+        pre_may_2017: read the RCV accession instead of the MeasureSet ID
+    Returns:
+        key_id, or None if it cannot be read safely from the raw bytes (the
+            element then has to be parsed)
+    """
+    tag_pattern, attrib_pattern = KEY_START_TAGS[pre_may_2017]
+    tag = tag_pattern.search(span)
+    if tag is None:
+        return None
+    attrib = attrib_pattern.search(tag.group())
+    if attrib is None:
+        return None
+    return attrib.group(1).decode()
+
+
+def split_clinvar_sets(chunk):
+    """
+    Split a chunk of iter_clinvar_set_chunks into its ClinVarSet elements,
+    slices of the chunk (not copied if it is a memoryview)
+    """
+    start = 0
+    for match in CLINVARSET_END_PATTERN.finditer(chunk):
+        yield chunk[start:match.end()]
+        start = match.end()
+
+
+def split_multi_info(info, n_alleles):
+    """
+    Split the old-format INFO string of a multiallelic record into one INFO
+    string per ALT allele, using CLNALLE to pick the per-allele CLN* values
+
+    Args:
+        info: INFO string of the multiallelic record
+        n_alleles: number of ALT alleles
+    Returns:
+        list of INFO strings, one per ALT allele
+    """
+    alleles = range(1, n_alleles + 1)
+    alt_info_n = []
+    columns = []  # values of each INFO field, one per allele
+    for field in info.split(';'):  # extract INFO field for each line
+        if field.startswith('CLNALLE='):
+            alt_info_n = [
+                int(x)
+                for x in field.replace('CLNALLE=', '').split(',')]
+            columns.append(['CLNALLE=1'] * n_alleles)
+        elif field.startswith('CLN'):
+            field_id, values = field.split('=')
+            values = values.split(',')
+            columns.append([
+                f'{field_id}={values[alt_info_n.index(n)]}'
+                if n in alt_info_n else f'{field_id}=.'
+                for n in alleles])
+        else:
+            columns.append([field] * n_alleles)
+    return [';'.join(x) for x in zip(*columns)]
+
+
 def split_multi_vcf(df):
     """
     Expand multiallelic variants in old-format VCF dataframe (--pre-may-2017)
@@ -355,113 +2340,165 @@ def split_multi_vcf(df):
     Returns:
         dataframe with one record per ALT
     """
-    pd.set_option('display.max_rows', None)
-    pd.set_option('display.max_columns', None)
-    pd.set_option('display.width', None)
-    pd.set_option('display.max_colwidth', None)  # change to None for new pandas
-    # Write temp csv for splitting multiallelic variants into multiple rows
-    # (to increase speed)
-    temp_output = io.StringIO()
-    csv_writer = writer(temp_output)
-
-    for i, alts in enumerate(df.get('ALT')):
-        temp_row = df.iloc[i].copy()
-        if ',' in alts:
-            for n, alt in enumerate(alts.split(','), 1):
-                temp_row['ALT'] = alt
-                new_info = []
-                for field in df.iloc[i]['INFO'].split(';'):  # extract INFO field for each line
-                    if field.startswith('CLNALLE='):
-                        alt_info_n = [
-                            int(x)
-                            for x in field.replace('CLNALLE=', '').split(',')]
-                        new_info.append('CLNALLE=1')
-                    elif field.startswith('CLN'):
-                        field_id, values = field.split('=')
-                        if n in alt_info_n:
-                            alt_info_index = alt_info_n.index(n)
-                            value = values.split(',')[alt_info_index]
-                            new_info.append(f'{field_id}={value}')
-                        else:
-                            new_info.append(f'{field_id}=.')
-                    else:
-                        new_info.append(field)
-                temp_row['INFO'] = ';'.join(new_info)
-                csv_writer.writerow(temp_row)
-        else:
-            csv_writer.writerow(temp_row)
+    alts = df['ALT'].str.split(',')
+    infos = [split_multi_info(info, len(alt)) if len(alt) > 1 else [info]
+             for info, alt in zip(df['INFO'], alts)]
+    return df.assign(ALT=alts, INFO=infos).explode(
+        ['ALT', 'INFO'], ignore_index=True)
+
 
-    temp_output.seek(0)  # we need to get back to the start of the StringIO
-    df_split = pd.read_csv(temp_output, header=None, names=df.columns)
-    return df_split
+def split_rcv_ids(info, i, malformed=None):
+    """
+    Return the RCV accessions (without version) in the CLNACC field of an
+    old-format INFO string
+
+    Args:
+        info: INFO string
+        i: record index, for logging
+        malformed: list to which (i, entry) is appended for each entry
+            that is not an RCV accession, instead of logging it
+    """
+    rcv_ids = []
+    for field in info.split(';'):
+        if field.startswith('CLNACC='):
+            for rcv_id_v in field.split('=')[1].split('|'):  # can have multiple IDs
+                rcv_id = rcv_id_v.split('.')[0]  # removing version
+                if not rcv_id.startswith('RCV') and rcv_id != '':
+                    if malformed is not None:
+                        malformed.append((i, rcv_id))
+                    else:
+                        logging.warning(
+                        'VCF %s at index %s is not correctly formatted, '
+                        'should be CLNACC=RCVXXX', field, i)
+                rcv_ids.append(rcv_id)
+    return rcv_ids
 
 
 def split_vcf_info(df):
     """
     Returns a dictionary of {id: line_number}
 
+    With Arrow strings (pyarrow, pandas 1.5+) the CLNACC fields of the whole
+    INFO column are split at once with the pandas string methods; otherwise
+    the INFO strings are split one at a time, which is faster on Python
+    strings. The entries that are not RCV accessions are logged in one
+    warning.
+
     Args:
         df: dataframe with INFO column
     """
+    import pandas as pd  # loaded by the dataframe code paths only
+    try:
+        import pyarrow
+        arrow_string = getattr(pd, 'ArrowDtype', None)
+    except ImportError:
+        arrow_string = None
     info_dct = defaultdict(set)
-    for i, info in enumerate(df.get('INFO')):
-        for field in info.split(';'):
-            if field.startswith('CLNACC='):
-                for rcv_id_v in field.split('=')[1].split('|'):  # can have multiple IDs
-                    rcv_id = rcv_id_v.split('.')[0]  # removing version
-                    if not rcv_id.startswith('RCV') and rcv_id != '':
-                        logging.warning(
-                        'VCF %s at index %s is not correctly formatted, '
-                        'should be CLNACC=RCVXXX', field, i)
-                    info_dct[rcv_id].add(i)  # dictionary with RCV ids and line numbers
+    malformed = []  # (line number, entry)
+    if arrow_string is None:
+        for i, info in enumerate(df['INFO']):
+            for rcv_id in split_rcv_ids(info, i, malformed=malformed):
+                info_dct[rcv_id].add(i)  # dictionary with RCV ids and line numbers
+    else:
+        info = df['INFO'].reset_index(drop=True).astype(
+            arrow_string(pyarrow.string()))
+        # one row per INFO field, indexed by line number
+        fields = info.str.split(';').explode()
+        clnacc = fields[fields.str.startswith('CLNACC=').to_numpy(
+            dtype=bool, na_value=False)]
+        # one row per RCV accession (can have multiple IDs), removing
+        # versions
+        rcv_ids = clnacc.str.slice(len('CLNACC=')) \
+            .str.replace('=.*', '', regex=True) \
+            .str.split('|').explode() \
+            .str.replace(r'\..*', '', regex=True)
+        is_malformed = (~rcv_ids.str.startswith('RCV')
+                        & (rcv_ids != '')).to_numpy(dtype=bool,
+                                                    na_value=False)
+        if is_malformed.any():
+            malformed = list(zip(rcv_ids.index[is_malformed].tolist(),
+                                 rcv_ids[is_malformed].tolist()))
+        for rcv_id, i in zip(rcv_ids.to_numpy(dtype=object).tolist(),
+                             rcv_ids.index.tolist()):
+            info_dct[rcv_id].add(i)  # dictionary with RCV ids and line numbers
+    if malformed:
+        logging.warning(
+            '%s CLNACC entries in %s VCF records are not correctly '
+            'formatted, should be CLNACC=RCVXXX (first: %s at index %s)',
+            len(malformed), len({i for i, _ in malformed}),
+            malformed[0][1], malformed[0][0])
     return info_dct
 
 
-def write_vcf_header(header, out_file):
+def strip_chr(chrom):
     """
-    Write VCF header
+    Return a chromosome name without its 'chr' prefix, so that 'chr1' and
+    '1' name the same chromosome
     """
-    vcf_header_dict = {
-        'CLNSUBA': 'Submitters - all, ordered',
-        'CLNSIGA': 'Clinical significance - all, ordered',
-        'CLNDATEA': 'Date pathogenicity last reviewed - all, ordered',
-        'CLNDATESUBA': 'Submission date - all, ordered',
-        'CLNREVSTATA': 'ClinVar review status for the Variation ID - all, ordered',
-        'CLNORA': 'Allele origin - all, ordered',
-        'CLNSCVA': 'SCV IDs - all, ordered',
-        'CLNDNA': 'Preferred disease name - all, ordered',
-        'CLNCOMA': 'Comment on clinical significance - all, ordered'
-    }
+    return chrom[3:] if chrom.startswith('chr') else chrom
 
-    for key, value in vcf_header_dict.items():
-        add_line = f'##INFO=<ID={key},Number=.,Type=String,Description="{value}">'
-        header.append(add_line)
 
+def write_checkpoint(fname, inputs, n, n_matched, xml_dict):
+    """
+    Save the state of mine_xml after n ClinVarSet records. The file is
+    written next to fname and then renamed, so a run killed while writing
+    leaves the previous checkpoint in place.
+    """
+    tmp_file = f'{fname}.tmp'
+    with open(tmp_file, 'wb') as f:
+        pickle.dump({'inputs': inputs, 'n': n, 'n_matched': n_matched,
+                     'xml_dict': xml_dict}, f,
+                    protocol=pickle.HIGHEST_PROTOCOL)
+    os.replace(tmp_file, fname)
+    logging.info('Checkpoint after %s ClinVarSet records', n)
+
+
+def write_vcf_header(header, out_file):
+    """
+    Write VCF header
+    """
     with open(out_file, 'w') as fout:
-        fout.write('\n'.join(header))
+        fout.write('\n'.join(annotated_vcf_header(header)))
         fout.write('\n')
 
 
-def main():
+def main(argv=None):
     """
     Parse the command-line and do the work.
     """
-    parser = argparse.ArgumentParser(description=__doc__)
+    argv = sys.argv[1:] if argv is None else argv
+    if argv and argv[0] in COMMANDS:
+        COMMANDS[argv[0]](argv[1:])
+        return
+
+    parser = argparse.ArgumentParser(
+        description=__doc__,
+        epilog=f'Other subcommands: {", ".join(COMMANDS)} '
+               '(run clinvar_vcf_parser SUBCOMMAND -h for help)')
     req_grp = parser.add_argument_group(title='Required')
-    req_grp.add_argument('-x',
+    src_grp = req_grp.add_mutually_exclusive_group(required=True)
+    src_grp.add_argument('-x',
                          '--xml',
                          type=str,
-                         help='ClinVar XML file (can be .gz)',
-                         required=True)
+                         help='ClinVar XML file (can be .gz)')
+    src_grp.add_argument('--index',
+                         type=str,
+                         help='Annotation index written by build-index, '
+                              'used in place of --xml')
     req_grp.add_argument('-i',
                          '--input',
                          type=str,
-                         help='ClinVar input vcf file name (can be .gz)',
+                         action='append',
+                         help='ClinVar input vcf file name (can be .gz); '
+                              'repeat -i and -o to annotate several vcf '
+                              'files (e.g. GRCh37 and GRCh38) from one pass '
+                              'over the XML file',
                          required=True)
     req_grp.add_argument('-o',
                          '--out',
                          type=str,
-                         help='Output vcf file name (non gz)',
+                         action='append',
+                         help='Output vcf file name (non gz), one per -i',
                          required=True)
     parser.add_argument('-l', '--log', type=str, help='Log file name')
     parser.add_argument('--pre-may-2017',
@@ -469,24 +2506,338 @@ def main():
                         default=False,
                         help='Assume old ClinVar file format: '
                              'RCV IDs are in INFO vcf column - field CLNACC')
+    parser.add_argument('--workers',
+                        type=int,
+                        default=1,
+                        help='Number of processes used to mine the XML file '
+                             '(default: %(default)s)')
+    parser.add_argument('--xml-engine',
+                        choices=XML_ENGINES,
+                        default='etree',
+                        help='XML parser backend (default: %(default)s; lxml '
+                             'needs the lxml package)')
+    parser.add_argument('--gzip-backend',
+                        choices=['auto', *GZIP_BACKENDS],
+                        default='auto',
+                        help='Decompression of a gzipped XML file (default: '
+                             '%(default)s, the first of isal, zlib-ng and '
+                             'gzip that is installed)')
+    parser.add_argument('--streaming',
+                        action='store_true',
+                        default=False,
+                        help='Annotate the vcf line by line without loading '
+                             'it into memory')
+    parser.add_argument('--metrics-json',
+                        type=str,
+                        help='Write the time, throughput and peak memory of '
+                             'each stage to this JSON file')
+    parser.add_argument('--profile',
+                        type=str,
+                        help='Profile the XML mining stage into this file '
+                             '(cProfile stats, or a pyinstrument report if '
+                             'the name ends with .html)')
+    parser.add_argument('--regions',
+                        type=str,
+                        help='BED file (can be .gz); only the vcf records '
+                             'with POS in these regions are annotated and '
+                             'written out')
+    parser.add_argument('--ids',
+                        type=str,
+                        help='File of Variation IDs, or RCV accessions with '
+                             '--pre-may-2017, one per line; only the vcf '
+                             'records with these IDs are annotated and '
+                             'written out')
+    parser.add_argument('--checkpoint',
+                        type=str,
+                        help='Save the state of the XML mining to this file '
+                             'every --checkpoint-interval seconds, so that '
+                             'an interrupted run can be resumed')
+    parser.add_argument('--checkpoint-interval',
+                        type=float,
+                        default=CHECKPOINT_INTERVAL,
+                        help='Seconds between checkpoints '
+                             '(default: %(default)s)')
+    parser.add_argument('--resume',
+                        action='store_true',
+                        default=False,
+                        help='Resume from the --checkpoint file, if it '
+                             'exists')
+    parser.add_argument('--pipeline',
+                        action='store_true',
+                        default=False,
+                        help='Read, mine and write on threads connected by '
+                             'bounded queues, whose occupancy is reported '
+                             'in --metrics-json')
+    parser.add_argument('--sort-merge',
+                        action='store_true',
+                        default=False,
+                        help='Join the vcf and XML records by sorting them '
+                             'in temporary files, so that memory does not '
+                             'grow with the size of the inputs')
+    parser.add_argument('--max-memory',
+                        type=int,
+                        default=SORT_MERGE_MEMORY >> 20,
+                        help='MB of records buffered by each sort with '
+                             '--sort-merge (default: %(default)s)')
+    parser.add_argument('--tmp-dir',
+                        type=str,
+                        help='Directory of the temporary files of '
+                             '--sort-merge (default: the system default)')
+
+    args = parser.parse_args(argv)
+    if len(args.input) != len(args.out):
+        parser.error('-i and -o must be given the same number of times')
+    if args.resume and args.checkpoint is None:
+        parser.error('--resume needs --checkpoint')
+    if args.sort_merge and args.checkpoint is not None:
+        parser.error('--checkpoint cannot be used with --sort-merge')
+    if args.max_memory <= 0:
+        parser.error('--max-memory must be positive')
+    setup_logging(args.log, args.out[0])
+
+    logging.info('Start time: %s\n', datetime.now())
+    logging.info(args)
 
-    args = parser.parse_args()
+    metrics = Metrics()
+    expand_clinvar_vcfs(xml_file=args.xml, out_files=args.out,
+                        vcf_files=args.input, pre_may_2017=args.pre_may_2017,
+                        workers=args.workers, index_file=args.index,
+                        streaming=args.streaming, engine=args.xml_engine,
+                        gzip_backend=args.gzip_backend, metrics=metrics,
+                        profile_file=args.profile, regions_file=args.regions,
+                        ids_file=args.ids, checkpoint_file=args.checkpoint,
+                        resume=args.resume,
+                        checkpoint_interval=args.checkpoint_interval,
+                        sort_merge=args.sort_merge,
+                        max_memory=args.max_memory << 20,
+                        tmp_dir=args.tmp_dir, pipeline=args.pipeline)
+    if args.metrics_json:
+        metrics.write(args.metrics_json)
 
-    if args.log:
-        logging.basicConfig(filename=args.log, level=logging.INFO)
-    else:
-        out_path = os.path.dirname(args.out)
-        logging.basicConfig(filename=(out_path + '/clinvar_vcf_parser.log'),
-                            level=logging.WARNING)
+    logging.info('\nEnd time: %s', datetime.now())
+
+
+def main_build_index(argv):
+    """
+    Parse the build-index command-line and write the annotation index.
+    """
+    parser = argparse.ArgumentParser(
+        prog='clinvar_vcf_parser build-index',
+        description='Mine a ClinVar XML file into an annotation index that '
+                    'can be passed to clinvar_vcf_parser --index')
+    req_grp = parser.add_argument_group(title='Required')
+    req_grp.add_argument('-x',
+                         '--xml',
+                         type=str,
+                         help='ClinVar XML file (can be .gz)',
+                         required=True)
+    req_grp.add_argument('-o',
+                         '--out',
+                         type=str,
+                         help='Output index file name',
+                         required=True)
+    parser.add_argument('-l', '--log', type=str, help='Log file name')
+    parser.add_argument('--workers',
+                        type=int,
+                        default=1,
+                        help='Number of processes used to mine the XML file '
+                             '(default: %(default)s)')
+    parser.add_argument('--xml-engine',
+                        choices=XML_ENGINES,
+                        default='etree',
+                        help='XML parser backend (default: %(default)s; lxml '
+                             'needs the lxml package)')
+    parser.add_argument('--gzip-backend',
+                        choices=['auto', *GZIP_BACKENDS],
+                        default='auto',
+                        help='Decompression of a gzipped XML file (default: '
+                             '%(default)s, the first of isal, zlib-ng and '
+                             'gzip that is installed)')
+    parser.add_argument('--previous',
+                        type=str,
+                        help='Index of an earlier release; records that are '
+                             'unchanged since then are copied from it '
+                             'instead of being parsed again')
+    parser.add_argument('--scv-table',
+                        type=str,
+                        help='Also write one row per SCV (submission) to '
+                             'this Parquet file; needs the pyarrow package')
+
+    args = parser.parse_args(argv)
+    setup_logging(args.log, args.out)
+
+    logging.info('Start time: %s\n', datetime.now())
+    logging.info(args)
+
+    from clinvar_vcf.annotation_index import build_index
+    build_index(args.xml, args.out, workers=args.workers,
+                engine=args.xml_engine, previous=args.previous,
+                gzip_backend=args.gzip_backend, scv_table=args.scv_table)
+
+    logging.info('\nEnd time: %s', datetime.now())
+
+
+def main_index_offsets(argv):
+    """
+    Parse the index-offsets command-line and write the offset index.
+    """
+    parser = argparse.ArgumentParser(
+        prog='clinvar_vcf_parser index-offsets',
+        description='Index the byte offset of every ClinVarSet record of an '
+                    'uncompressed or bgzip-compressed ClinVar XML file, for '
+                    'clinvar_vcf_parser lookup')
+    req_grp = parser.add_argument_group(title='Required')
+    req_grp.add_argument('-x',
+                         '--xml',
+                         type=str,
+                         help='ClinVar XML file (uncompressed or bgzip)',
+                         required=True)
+    parser.add_argument('-o',
+                        '--out',
+                        type=str,
+                        help='Output index file name (default: the XML file '
+                             'name followed by .offsets)')
+    parser.add_argument('-l', '--log', type=str, help='Log file name')
+
+    args = parser.parse_args(argv)
+    setup_logging(args.log, args.out or args.xml)
+
+    logging.info('Start time: %s\n', datetime.now())
+    logging.info(args)
+
+    from clinvar_vcf.offset_index import build_offset_index
+    build_offset_index(args.xml, args.out)
+
+    logging.info('\nEnd time: %s', datetime.now())
+
+
+def main_lookup(argv):
+    """
+    Parse the lookup command-line and print the records of the given IDs.
+    """
+    parser = argparse.ArgumentParser(
+        prog='clinvar_vcf_parser lookup',
+        description='Print the annotations of the ClinVarSet records of '
+                    'Variation IDs or RCV accessions as JSON, reading only '
+                    'those records through the index written by '
+                    'index-offsets')
+    req_grp = parser.add_argument_group(title='Required')
+    req_grp.add_argument('-x',
+                         '--xml',
+                         type=str,
+                         help='ClinVar XML file (uncompressed or bgzip)',
+                         required=True)
+    parser.add_argument('ids',
+                        nargs='+',
+                        metavar='ID',
+                        help='Variation ID, or RCV accession without version')
+    parser.add_argument('--offsets',
+                        type=str,
+                        help='Offset index (default: the XML file name '
+                             'followed by .offsets)')
+    parser.add_argument('-l', '--log', type=str, help='Log file name')
+    parser.add_argument('--xml-engine',
+                        choices=XML_ENGINES,
+                        default='etree',
+                        help='XML parser backend (default: %(default)s; lxml '
+                             'needs the lxml package)')
+    parser.add_argument('--raw',
+                        action='store_true',
+                        default=False,
+                        help='Print the XML of the records instead')
+
+    args = parser.parse_args(argv)
+    setup_logging(args.log, args.xml)
+
+    from clinvar_vcf.offset_index import (
+        lookup_annotations,
+        lookup_clinvar_sets)
+    try:
+        if args.raw:
+            for _, span in lookup_clinvar_sets(args.xml, args.ids,
+                                               index_file=args.offsets):
+                sys.stdout.write(span.decode() + '\n')
+            return
+        found = {key_id: [] for key_id in args.ids}
+        for key_id, rcv, ms_id, annotations in lookup_annotations(
+                args.xml, args.ids, index_file=args.offsets,
+                engine=args.xml_engine):
+            found[key_id].append({'rcv': rcv, 'ms_id': ms_id,
+                                  'annotations': annotations})
+    except ValueError as exc:
+        parser.error(str(exc))
+    json.dump(found, sys.stdout, indent=2)
+    sys.stdout.write('\n')
+
+
+def main_serve(argv):
+    """
+    Parse the serve command-line and serve the annotation index.
+    """
+    parser = argparse.ArgumentParser(
+        prog='clinvar_vcf_parser serve',
+        description='Keep an annotation index written by build-index in '
+                    'memory and annotate the VCFs and IDs posted to a local '
+                    'HTTP server (POST /annotate, /annotations, /reload; '
+                    'GET /status)')
+    req_grp = parser.add_argument_group(title='Required')
+    req_grp.add_argument('--index',
+                         type=str,
+                         help='Annotation index written by build-index',
+                         required=True)
+    parser.add_argument('-l', '--log', type=str, help='Log file name')
+    parser.add_argument('--host',
+                        type=str,
+                        default='127.0.0.1',
+                        help='Address to listen on (default: %(default)s)')
+    parser.add_argument('--port',
+                        type=int,
+                        default=8765,
+                        help='Port to listen on (default: %(default)s)')
+
+    args = parser.parse_args(argv)
+    setup_logging(args.log, args.index)
 
     logging.info('Start time: %s\n', datetime.now())
     logging.info(args)
 
-    expand_clinvar_vcf(xml_file=args.xml, out_file=args.out,
-                       vcf_file=args.input, pre_may_2017=args.pre_may_2017)
+    from clinvar_vcf.annotation_server import serve
+    serve(args.index, host=args.host, port=args.port)
 
     logging.info('\nEnd time: %s', datetime.now())
 
 
+def setup_logging(log, out):
+    """
+    Log to the log file if given, else log warnings next to the output file
+    """
+    if log:
+        logging.basicConfig(filename=log, level=logging.INFO)
+    else:
+        out_path = os.path.dirname(out)
+        logging.basicConfig(filename=(out_path + '/clinvar_vcf_parser.log'),
+                            level=logging.WARNING)
+
+
+GZIP_BACKENDS = {
+    'isal': open_gzip_isal,
+    'zlib-ng': open_gzip_zlib_ng,
+    'gzip': open_gzip,
+}
+
+XML_ENGINES = {
+    'etree': parse_clinvar_set_etree,
+    'lxml': parse_clinvar_set_lxml,
+    'expat': parse_clinvar_set_expat,
+}
+
+COMMANDS = {
+    'build-index': main_build_index,
+    'index-offsets': main_index_offsets,
+    'lookup': main_lookup,
+    'serve': main_serve,
+}
+
+
 if __name__ == '__main__':
     main()
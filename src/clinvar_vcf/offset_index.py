@@ -0,0 +1,310 @@
+"""
+Sidecar index of the byte offset of every ClinVarSet element of a ClinVar
+XML file, keyed by MeasureSet ID and RCV accession, so that a few records
+can be read and mined without a pass over the whole file.
+
+The XML file has to be uncompressed, or compressed with bgzip (BGZF: a
+gzip file made of independently compressed blocks of at most 64 KB), in
+which case the offsets are BGZF virtual offsets: the offset of the block in
+the compressed file shifted left by 16 bits, plus the offset of the element
+in the decompressed block. A plain gzip file cannot be read from the middle.
+"""
+import logging
+import os
+import sqlite3
+import struct
+import zlib
+from collections import deque
+import xml.etree.ElementTree as ET
+
+from clinvar_vcf.clinvar_vcf_parser import (
+    ALL_KEYS,
+    CLINVARSET_END,
+    CLINVARSET_START,
+    XML_BLOCK_SIZE,
+    XML_ENGINES,
+    get_record_ids,
+    scan_key_id)
+
+OFFSET_INDEX_FORMAT_VERSION = '1'
+OFFSET_INDEX_SUFFIX = '.offsets'
+BGZF_MAGIC = b'\x1f\x8b\x08\x04'
+
+OFFSET_SCHEMA = """
+CREATE TABLE meta (key TEXT PRIMARY KEY, value TEXT);
+CREATE TABLE offsets (
+    seq INTEGER PRIMARY KEY,
+    ms_id TEXT,
+    rcv TEXT,
+    offset INTEGER,
+    length INTEGER
+);
+"""
+OFFSET_INDICES = """
+CREATE INDEX offsets_ms_id ON offsets (ms_id);
+CREATE INDEX offsets_rcv ON offsets (rcv);
+"""
+
+
+class BgzfReader:
+    """
+    Binary reader of a BGZF file that can seek to a virtual offset
+    """
+
+    def __init__(self, fname):
+        self.raw = open(fname, 'rb')
+        self.block = b''
+        self.pos = 0
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc_info):
+        self.close()
+
+    def close(self):
+        """
+        Close the underlying file
+        """
+        self.raw.close()
+
+    def read(self, size):
+        """
+        Read size bytes from the current position, or up to the end of the
+        file
+        """
+        parts = []
+        while size > 0:
+            if self.pos == len(self.block):
+                if self.read_block() is None:
+                    break
+                continue
+            part = self.block[self.pos:self.pos + size]
+            self.pos += len(part)
+            size -= len(part)
+            parts.append(part)
+        return b''.join(parts)
+
+    def read_block(self):
+        """
+        Decompress the next block of the file
+
+        Returns:
+            the decompressed block (b'' for the empty end-of-file block),
+                or None at the end of the file
+        """
+        header = self.raw.read(12)
+        if not header:
+            return None
+        if header[:4] != BGZF_MAGIC:
+            raise ValueError(f'{self.raw.name} is not a BGZF file')
+        extra = self.raw.read(struct.unpack('<H', header[10:12])[0])
+        bsize = None
+        i = 0
+        while i + 4 <= len(extra):
+            subfield_id = extra[i:i + 2]
+            length = struct.unpack('<H', extra[i + 2:i + 4])[0]
+            if subfield_id == b'BC':
+                bsize = struct.unpack('<H', extra[i + 4:i + 6])[0]
+            i += 4 + length
+        if bsize is None:
+            raise ValueError(f'{self.raw.name} is not a BGZF file')
+        data = self.raw.read(bsize + 1 - 12 - len(extra))
+        self.block = zlib.decompress(data[:-8], -15)
+        self.pos = 0
+        return self.block
+
+    def seek_virtual(self, offset):
+        """
+        Move to a virtual offset
+        """
+        self.raw.seek(offset >> 16)
+        if self.read_block() is None:
+            raise ValueError(f'Virtual offset {offset} is past the end of '
+                             f'{self.raw.name}')
+        self.pos = offset & 0xffff
+
+
+def build_offset_index(xml_file, index_file=None):
+    """
+    Write the offset of every ClinVarSet element of an XML file to an SQLite
+    index
+
+    Args:
+        xml_file: uncompressed or BGZF ClinVar XML file
+        index_file: output index file, replaced if it exists (default:
+            xml_file + OFFSET_INDEX_SUFFIX)
+    Returns:
+        number of ClinVarSet records indexed
+    """
+    index_file = index_file or xml_file + OFFSET_INDEX_SUFFIX
+    tmp_file = f'{index_file}.tmp'
+    if os.path.exists(tmp_file):
+        os.remove(tmp_file)
+    n = 0
+    with sqlite3.connect(tmp_file) as conn:
+        conn.executescript(OFFSET_SCHEMA)
+        rows = []
+        for offset, span in iter_clinvar_set_offsets(xml_file):
+            ms_id = scan_key_id(span)
+            rcv = scan_key_id(span, pre_may_2017=True)
+            if ms_id is None or rcv is None:
+                rcv, ms_id = get_record_ids(ET.fromstring(span),
+                                            pre_may_2017=True)
+            rows.append((ms_id, rcv, offset, len(span)))
+            if len(rows) == 10000:
+                conn.executemany('INSERT INTO offsets (ms_id, rcv, offset, '
+                                 'length) VALUES (?, ?, ?, ?)', rows)
+                n += len(rows)
+                rows = []
+        conn.executemany('INSERT INTO offsets (ms_id, rcv, offset, length) '
+                         'VALUES (?, ?, ?, ?)', rows)
+        n += len(rows)
+        conn.executescript(OFFSET_INDICES)
+        conn.executemany(
+            'INSERT INTO meta (key, value) VALUES (?, ?)',
+            [('format_version', OFFSET_INDEX_FORMAT_VERSION),
+             ('xml_file', os.path.basename(xml_file)),
+             ('xml_size', str(os.path.getsize(xml_file))),
+             ('bgzf', str(int(is_bgzf(xml_file)))),
+             ('records', str(n))])
+    conn.close()
+    os.replace(tmp_file, index_file)
+    logging.info('Indexed the offsets of %s ClinVarSet records of %s in %s',
+                 n, xml_file, index_file)
+    return n
+
+
+def is_bgzf(fname):
+    """
+    Return True if fname starts with a BGZF block
+    """
+    with open(fname, 'rb') as f:
+        header = f.read(18)
+    return header[:4] == BGZF_MAGIC and b'BC' in header[12:]
+
+
+def iter_clinvar_set_offsets(xml_file):
+    """
+    Split an uncompressed or BGZF XML file into ClinVarSet elements
+
+    Yields:
+        (offset, span) per ClinVarSet element, offset being the byte offset
+            of its start tag, or its virtual offset in a BGZF file
+    """
+    if xml_file.endswith('.gz') and not is_bgzf(xml_file):
+        raise ValueError(f'{xml_file} is gzipped but not with bgzip, so it '
+                         'cannot be read from the middle; decompress it or '
+                         'compress it again with bgzip')
+    bgzf = is_bgzf(xml_file)
+    buffer = bytearray()
+    buffer_start = 0  # offset of buffer[0] in the decompressed stream
+    # (decompressed offset, file offset) of the BGZF blocks in the buffer
+    blocks = deque()
+    with (BgzfReader(xml_file) if bgzf else open(xml_file, 'rb')) as reader:
+        while True:
+            if bgzf:
+                file_offset = reader.raw.tell()
+                block = reader.read_block()
+                if block:
+                    blocks.append((buffer_start + len(buffer), file_offset))
+            else:
+                block = reader.read(XML_BLOCK_SIZE)
+            if block:
+                buffer += block
+            while True:
+                end = buffer.find(CLINVARSET_END)
+                if end == -1:
+                    break
+                start = buffer.find(CLINVARSET_START, 0, end)
+                end += len(CLINVARSET_END)
+                offset = buffer_start + start
+                if bgzf:
+                    while len(blocks) > 1 and blocks[1][0] <= offset:
+                        blocks.popleft()
+                    offset = (blocks[0][1] << 16) | (offset - blocks[0][0])
+                yield offset, bytes(buffer[start:end])
+                # deleting from the front of a bytearray does not copy it
+                del buffer[:end]
+                buffer_start += end
+            if block is None or (not bgzf and not block):
+                break
+
+
+def lookup_annotations(xml_file, key_ids, index_file=None, engine='etree'):
+    """
+    Mine the ClinVarSet records of key_ids, reading only those records
+
+    Args:
+        see lookup_clinvar_sets
+        engine: XML parser backend, one of XML_ENGINES
+    Yields:
+        (key_id, rcv, ms_id, annotations) per ClinVarSet record found
+    """
+    for key_id, span in lookup_clinvar_sets(xml_file, key_ids,
+                                            index_file=index_file):
+        rcv, ms_id, annotations = XML_ENGINES[engine](
+            span, ALL_KEYS, pre_may_2017=True)
+        yield key_id, rcv, ms_id, annotations
+
+
+def lookup_clinvar_sets(xml_file, key_ids, index_file=None):
+    """
+    Read the ClinVarSet elements of key_ids from an XML file, seeking to
+    their offsets in an index written by build_offset_index
+
+    Args:
+        xml_file: the XML file the index was built from
+        key_ids: MeasureSet (Variation) IDs and/or RCV accessions (without
+            version)
+        index_file: index file (default: xml_file + OFFSET_INDEX_SUFFIX)
+    Yields:
+        (key_id, span) per ClinVarSet element, in the order of key_ids then
+            of the XML file
+    """
+    conn = open_offset_index(xml_file, index_file)
+    bgzf = conn.execute(
+        "SELECT value FROM meta WHERE key = 'bgzf'").fetchone()[0] == '1'
+    try:
+        with (BgzfReader(xml_file) if bgzf else open(xml_file, 'rb')) as f:
+            for key_id in key_ids:
+                column = 'rcv' if key_id.startswith('RCV') else 'ms_id'
+                for offset, length in conn.execute(
+                        f'SELECT offset, length FROM offsets '
+                        f'WHERE {column} = ? ORDER BY seq', (key_id,)):
+                    if bgzf:
+                        f.seek_virtual(offset)
+                    else:
+                        f.seek(offset)
+                    span = f.read(length)
+                    if not (span.startswith(CLINVARSET_START)
+                            and span.endswith(CLINVARSET_END)):
+                        raise ValueError(f'{xml_file} has changed since the '
+                                         'offset index was built')
+                    yield key_id, span
+    finally:
+        conn.close()
+
+
+def open_offset_index(xml_file, index_file=None):
+    """
+    Open the offset index of an XML file, checking its format version and
+    that it was built from a file of the same size
+    """
+    index_file = index_file or xml_file + OFFSET_INDEX_SUFFIX
+    if not os.path.exists(index_file):
+        raise ValueError(f'{index_file} not found, write it with '
+                         'clinvar_vcf_parser index-offsets')
+    conn = sqlite3.connect(index_file)
+    try:
+        meta = dict(conn.execute('SELECT key, value FROM meta'))
+    except sqlite3.DatabaseError:
+        meta = {}
+    if meta.get('format_version') != OFFSET_INDEX_FORMAT_VERSION:
+        conn.close()
+        raise ValueError(f'{index_file} is not a ClinVar offset index')
+    if meta['xml_size'] != str(os.path.getsize(xml_file)):
+        conn.close()
+        raise ValueError(f'{xml_file} has changed since {index_file} was '
+                         'built')
+    return conn
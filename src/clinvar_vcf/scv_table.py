@@ -0,0 +1,125 @@
+"""
+Long, typed table of the ClinVar submissions (SCVs), one row per SCV, written
+as Parquet so that submitters, review status and so on can be queried
+without re-parsing the INFO column of the annotated VCF. Needs pyarrow.
+"""
+import logging
+from datetime import date
+
+from clinvar_vcf.clinvar_vcf_parser import INFO_FIELDS
+
+# columns of the table, with the INFO field each one is read from (None for
+# the ClinVarSet IDs), and whether its strings are dictionary-encoded
+SCV_COLUMNS = (
+    ('variation_id', None, False),
+    ('rcv', None, False),
+    ('scv', 'CLNSCVA', False),
+    ('submitter', 'CLNSUBA', True),
+    ('significance', 'CLNSIGA', True),
+    ('review_status', 'CLNREVSTATA', True),
+    ('date_last_evaluated', 'CLNDATEA', False),
+    ('submission_date', 'CLNDATESUBA', False),
+    ('origin', 'CLNORA', True),
+    ('disease', 'CLNDNA', True),
+    ('comment', 'CLNCOMA', False),
+)
+DATE_COLUMNS = {'date_last_evaluated', 'submission_date'}
+
+# number of SCVs buffered before a row group is written
+SCV_ROW_GROUP_SIZE = 100000
+
+
+class ScvTableWriter:
+    """
+    Write the SCVs of ClinVarSet records to a Parquet file, one row group
+    every row_group_size SCVs, so memory does not grow with the release
+    """
+
+    def __init__(self, fname, row_group_size=SCV_ROW_GROUP_SIZE):
+        import pyarrow as pa  # optional dependency
+        import pyarrow.parquet as pq
+        self.pa = pa
+        self.schema = pa.schema([
+            (name, pa.int64() if name == 'variation_id'
+             else pa.date32() if name in DATE_COLUMNS
+             else pa.dictionary(pa.int32(), pa.string()) if dictionary
+             else pa.string())
+            for name, _, dictionary in SCV_COLUMNS])
+        self.writer = pq.ParquetWriter(fname, self.schema)
+        self.row_group_size = row_group_size
+        self.columns = {name: [] for name, _, _ in SCV_COLUMNS}
+        self.n = 0
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc_info):
+        self.close()
+
+    def add(self, ms_id, rcv, annotations):
+        """
+        Add the SCVs of a ClinVarSet record
+
+        Args:
+            ms_id: MeasureSet (Variation) ID
+            rcv: RCV accession
+            annotations: {INFO field: list of values}, one value per SCV
+        """
+        n = len(annotations['CLNSCVA'])
+        # e.g. the ClinicalSignificance fields of a record with a
+        # ClinVarAssertion without ClinicalSignificance: which SCV each
+        # value belongs to is lost, so the field is null for every SCV
+        misaligned = [field for field in INFO_FIELDS
+                      if len(annotations[field]) != n]
+        if misaligned:
+            logging.warning('Record %s has %s values not matching its %s '
+                            'SCVs, written as null', rcv,
+                            ', '.join(misaligned), n)
+        for name, field, _ in SCV_COLUMNS[2:]:
+            values = ([None] * n if field in misaligned
+                      else [value or None  # missing values are null
+                            for value in annotations[field]])
+            if name in DATE_COLUMNS:
+                values = [parse_date(value) for value in values]
+            self.columns[name].extend(values)
+        self.columns['variation_id'].extend(
+            [None if ms_id is None else int(ms_id)] * n)
+        self.columns['rcv'].extend([rcv] * n)
+        self.n += n
+        if len(self.columns['rcv']) >= self.row_group_size:
+            self.flush()
+
+    def close(self):
+        """
+        Write the last row group and close the file
+        """
+        self.flush()
+        self.writer.close()
+
+    def flush(self):
+        """
+        Write the buffered SCVs as a row group
+        """
+        if not self.columns['rcv']:
+            return
+        pa = self.pa
+        arrays = []
+        for name, _, dictionary in SCV_COLUMNS:
+            array = pa.array(self.columns[name],
+                             type=self.schema.field(name).type.value_type
+                             if dictionary else self.schema.field(name).type)
+            arrays.append(array.dictionary_encode() if dictionary else array)
+            self.columns[name] = []
+        self.writer.write_table(pa.Table.from_arrays(arrays,
+                                                     schema=self.schema))
+
+
+def parse_date(value):
+    """
+    Return the date of a YYYY-MM-DD string, or None for a missing date
+    ('0000-00-00') or a value that is not a date
+    """
+    try:
+        return date.fromisoformat(value[:10])
+    except (TypeError, ValueError):
+        return None
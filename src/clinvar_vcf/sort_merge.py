@@ -0,0 +1,363 @@
+"""
+External sort-merge join of ClinVar VCF records with the ClinVarSet records
+of the XML file, for machines that cannot hold a release in memory. Neither
+the VCF nor the annotations are kept in memory: memory is bounded by
+max_memory whatever the size of the inputs, at the cost of writing sorted
+runs to temporary files.
+
+    1. the (key_id, row) pairs of the VCF records and the (key_id, seq,
+       annotations) of the ClinVarSet records are sorted into runs
+    2. both are merged and joined on key_id into (row, seq, annotations)
+       runs
+    3. these are merged in the order of the VCF records, which are written
+       out as the VCF files are read again, the annotations of each record
+       in the order of the XML file
+"""
+import heapq
+import logging
+import os
+import pickle
+import tempfile
+from itertools import groupby
+from operator import itemgetter
+
+from clinvar_vcf.clinvar_vcf_parser import (
+    ALL_KEYS,
+    INFO_FIELDS,
+    SORT_MERGE_MEMORY,
+    Metrics,
+    format_annotations,
+    get_handle,
+    iter_vcf_records,
+    mine_xml_parallel,
+    mine_xml_pipelined,
+    mine_xml_sequential,
+    profile_stage,
+    read_selection,
+    read_vcf_header,
+    split_rcv_ids,
+    write_vcf_header)
+
+# estimated bytes of memory taken by a buffered item besides its strings
+ITEM_OVERHEAD = 200
+# maximum number of runs merged at once; more are first merged in groups
+MERGE_FAN_IN = 64
+# number of items pickled together in a run file
+RUN_BLOCK_ITEMS = 256
+
+
+class ExternalSorter:
+    """
+    Sort more items than fit in memory: items are buffered until their
+    estimated size reaches max_memory, then sorted and written to a run
+    file in tmp_dir, and sorted() merges the runs
+    """
+
+    def __init__(self, tmp_dir, max_memory=SORT_MERGE_MEMORY, name='run'):
+        self.tmp_dir = tmp_dir
+        self.max_memory = max_memory
+        self.name = name
+        self.buffer = []
+        self.buffer_size = 0
+        self.runs = []
+        self.n = 0
+        self.n_runs = 0
+
+    def add(self, item, size=0):
+        """
+        Add an item, size being the length of the strings it holds
+        """
+        self.buffer.append(item)
+        self.buffer_size += size + ITEM_OVERHEAD
+        self.n += 1
+        if self.buffer_size >= self.max_memory:
+            self.spill()
+
+    def close(self):
+        """
+        Write the buffered items, so that the sorter takes no memory until
+        sorted() is called
+        """
+        if self.buffer:
+            self.spill()
+
+    def run_name(self):
+        """
+        Return the name of a new run file
+        """
+        self.n_runs += 1
+        return os.path.join(self.tmp_dir, f'{self.name}_{self.n_runs}.run')
+
+    def sorted(self):
+        """
+        Yield the items in sorted order, removing the run files
+        """
+        self.close()
+        runs = self.runs
+        while len(runs) > MERGE_FAN_IN:
+            logging.info('Merging %s %s runs', len(runs), self.name)
+            merged = []
+            for i in range(0, len(runs), MERGE_FAN_IN):
+                fname = self.run_name()
+                write_run(fname, heapq.merge(
+                    *map(iter_run, runs[i:i + MERGE_FAN_IN])))
+                merged.append(fname)
+            runs = merged
+        self.runs = []
+        yield from heapq.merge(*map(iter_run, runs))
+
+    def spill(self):
+        """
+        Sort the buffered items into a new run file
+        """
+        self.buffer.sort()
+        fname = self.run_name()
+        write_run(fname, self.buffer)
+        self.runs.append(fname)
+        self.buffer = []
+        self.buffer_size = 0
+
+
+def expand_clinvar_vcfs_sort_merge(xml_file, vcf_files, out_files,
+                                   pre_may_2017=False, workers=1,
+                                   index_file=None, engine='etree',
+                                   gzip_backend='auto', metrics=None,
+                                   profile_file=None, regions_file=None,
+                                   ids_file=None,
+                                   max_memory=SORT_MERGE_MEMORY,
+                                   tmp_dir=None, pipeline=False):
+    """
+    Sort-merge version of expand_clinvar_vcfs, taking about max_memory
+    bytes of memory besides the runs being merged. Every ClinVarSet record
+    is mined, as their key_ids cannot be looked up in memory.
+
+    Args:
+        max_memory: bytes of items buffered by each sort before they are
+            written to a run file
+        tmp_dir: directory of the run files (default: the system default)
+        see expand_clinvar_vcfs for the others
+    """
+    metrics = Metrics() if metrics is None else metrics
+    select = read_selection(regions_file, ids_file, pre_may_2017=pre_may_2017)
+    headers = []
+    offsets = []
+    with tempfile.TemporaryDirectory(prefix='clinvar_vcf_',
+                                     dir=tmp_dir) as tmp:
+        vcf_pairs = ExternalSorter(tmp, max_memory, 'vcf')
+        with metrics.stage('lookup') as stage:
+            logging.info('Sorting the IDs of the VCF records')
+            row = 0
+            for vcf_file in vcf_files:
+                # the records of each file are numbered after those of the
+                # files before it
+                offsets.append(row)
+                with get_handle(vcf_file, ftype='vcf') as f:
+                    headers.append(read_vcf_header(f))
+                    for fields in iter_vcf_records(
+                            f, pre_may_2017=pre_may_2017, select=select):
+                        key_ids = (split_rcv_ids(fields[7], row)
+                                   if pre_may_2017 else [fields[2]])
+                        for key_id in key_ids:
+                            vcf_pairs.add((key_id, row), len(key_id))
+                        row += 1
+            vcf_pairs.close()
+            stage['records'] = row
+
+        clinvar_sets = ExternalSorter(tmp, max_memory, 'xml')
+        with metrics.stage('mine_xml') as stage, \
+                profile_stage(profile_file):
+            logging.info('Sorting the ClinVarSet records of the XML file')
+            records = iter_clinvar_set_payloads(
+                xml_file, pre_may_2017=pre_may_2017, workers=workers,
+                index_file=index_file, engine=engine,
+                gzip_backend=gzip_backend, metrics=metrics,
+                pipeline=pipeline)
+            for seq, key_id, payload in records:
+                clinvar_sets.add((key_id, seq, payload),
+                                 len(key_id) + len(payload))
+                if clinvar_sets.n % 50000 == 0:
+                    logging.info('%s records processed', clinvar_sets.n)
+            clinvar_sets.close()
+            metrics.count('clinvar_sets_processed', clinvar_sets.n)
+            stage['records'] = clinvar_sets.n
+
+        joined = ExternalSorter(tmp, max_memory, 'joined')
+        with metrics.stage('join_entries') as stage:
+            logging.info('Joining the VCF records with the ClinVarSet '
+                         'records')
+            for row, seq, payload in join_sorted(
+                    vcf_pairs.sorted(), clinvar_sets.sorted(),
+                    metrics=metrics):
+                joined.add((row, seq, payload), len(payload))
+            joined.close()
+            metrics.count('clinvar_sets_skipped',
+                          metrics.counters['clinvar_sets_processed']
+                          - metrics.counters['clinvar_sets_matched'])
+            stage['records'] = joined.n
+
+        with metrics.stage('output') as stage:
+            annotated = iter_row_annotations(joined.sorted())
+            next_row, annotations = next(annotated, (None, None))
+            n = 0
+            for vcf_file, out_file, header, offset in zip(
+                    vcf_files, out_files, headers, offsets):
+                logging.info('Writing out updated vcf header')
+                write_vcf_header(header, out_file)
+
+                logging.info('Writing out the main VCF body to output file')
+                with get_handle(vcf_file, ftype='vcf') as f, \
+                        open(out_file, 'a') as fout:
+                    columns = next(line for line in f
+                                   if not line.startswith('##'))
+                    fout.write(columns.rstrip('\r\n') + '\n')
+                    info_col = columns.rstrip('\r\n').split('\t').index(
+                        'INFO')
+                    for idx, fields in enumerate(iter_vcf_records(
+                            f, pre_may_2017=pre_may_2017, select=select),
+                            offset):
+                        if idx == next_row:
+                            fields[info_col] += (
+                                ';' + format_annotations(annotations))
+                            metrics.count('vcf_records_annotated')
+                            next_row, annotations = next(annotated,
+                                                         (None, None))
+                        fout.write('\t'.join(fields) + '\n')
+                        n += 1
+            stage['records'] = n
+
+
+def iter_clinvar_set_payloads(xml_file, pre_may_2017=False, workers=1,
+                              index_file=None, engine='etree',
+                              gzip_backend='auto', metrics=None,
+                              pipeline=False):
+    """
+    Mine every ClinVarSet record of an XML file, or read it from an index
+
+    Args:
+        see mine_xml
+    Yields:
+        (seq, key_id, payload) per ClinVarSet record in the order of the
+            XML file, payload being the encode_annotations string of its
+            annotations
+    """
+    from clinvar_vcf.annotation_index import (
+        encode_annotations,
+        iter_index_records)
+    if index_file is not None:
+        for seq, ms_id, rcv, payload in iter_index_records(index_file):
+            key_id = rcv if pre_may_2017 else ms_id
+            if key_id is not None:
+                yield seq, key_id, payload
+        return
+
+    if pipeline:
+        records = mine_xml_pipelined(xml_file, ALL_KEYS,
+                                     pre_may_2017=pre_may_2017,
+                                     workers=workers, engine=engine,
+                                     gzip_backend=gzip_backend,
+                                     metrics=metrics)
+    elif workers > 1:
+        records = mine_xml_parallel(xml_file, ALL_KEYS,
+                                    pre_may_2017=pre_may_2017,
+                                    workers=workers, engine=engine,
+                                    gzip_backend=gzip_backend,
+                                    metrics=metrics)
+    else:
+        records = mine_xml_sequential(xml_file, ALL_KEYS,
+                                      pre_may_2017=pre_may_2017,
+                                      engine=engine,
+                                      gzip_backend=gzip_backend,
+                                      metrics=metrics)
+    seq = 0
+    for n_processed, matches in records:
+        for key_id, _, annotations in matches:
+            if key_id is not None:
+                yield seq, key_id, encode_annotations(annotations)
+            seq += 1
+        seq += n_processed - len(matches)
+
+
+def iter_row_annotations(joined):
+    """
+    Merge the annotations of each VCF record
+
+    Args:
+        joined: (row, seq, payload) items sorted by row and seq
+    Yields:
+        (row, {INFO field: list of values}) per row, the values of its
+            ClinVarSet records in the order of the XML file
+    """
+    from clinvar_vcf.annotation_index import decode_annotations
+    for row, items in groupby(joined, key=itemgetter(0)):
+        annotations = {field: [] for field in INFO_FIELDS}
+        for _, _, payload in items:
+            for field, values in decode_annotations(payload).items():
+                annotations[field] += values
+        yield row, annotations
+
+
+def iter_run(fname):
+    """
+    Yield the items of a run file written by write_run
+    """
+    with open(fname, 'rb') as f:
+        while True:
+            try:
+                block = pickle.load(f)
+            except EOFError:
+                break
+            yield from block
+    os.remove(fname)
+
+
+def join_sorted(vcf_pairs, clinvar_sets, metrics=None):
+    """
+    Merge-join VCF records with ClinVarSet records on key_id
+
+    Args:
+        vcf_pairs: (key_id, row) pairs sorted by key_id and row
+        clinvar_sets: (key_id, seq, payload) records sorted by key_id and
+            seq
+        metrics: Metrics counting the ClinVarSet records matched
+    Yields:
+        (row, seq, payload) for each ClinVarSet record of the key_ids of
+            each row
+    """
+    records = iter(clinvar_sets)
+    record = next(records, None)
+    group_key = None
+    group = []
+    last_pair = None
+    for pair in vcf_pairs:
+        if pair == last_pair:  # key_id listed twice in a VCF record
+            continue
+        last_pair = pair
+        key_id, row = pair
+        if key_id != group_key:
+            # records of key_ids that are in no VCF record are skipped
+            while record is not None and record[0] < key_id:
+                record = next(records, None)
+            group_key = key_id
+            group = []
+            while record is not None and record[0] == key_id:
+                group.append(record[1:])
+                record = next(records, None)
+            if metrics is not None:
+                metrics.count('clinvar_sets_matched', len(group))
+        for seq, payload in group:
+            yield row, seq, payload
+
+
+def write_run(fname, items):
+    """
+    Pickle items to a run file, RUN_BLOCK_ITEMS at a time
+    """
+    with open(fname, 'wb') as f:
+        block = []
+        for item in items:
+            block.append(item)
+            if len(block) == RUN_BLOCK_ITEMS:
+                pickle.dump(block, f, pickle.HIGHEST_PROTOCOL)
+                block = []
+        if block:
+            pickle.dump(block, f, pickle.HIGHEST_PROTOCOL)
@@ -0,0 +1,56 @@
+"""
+Shared check of expand_clinvar_vcfs against the annotated VCFs of
+tests.resources, for the tests of each way of running it
+"""
+import importlib.resources as pkg_resources
+import tempfile
+
+from pathlib import Path
+
+from clinvar_vcf.clinvar_vcf_parser import Metrics, expand_clinvar_vcfs
+
+import tests.resources
+
+GOLDEN_XML = 'ClinVarFullRelease_2021-03_5_records.xml'
+# (input VCF, expected output, pre_may_2017)
+GOLDEN_OUTPUTS = (
+    ('clinvar_20210302_3_records.vcf',
+     'clinvar_20210302_3_records_annotated.vcf', False),
+    ('clinvar_20170404_13_records.vcf',
+     'clinvar_20170404_13_records_annotated.vcf', True),
+)
+
+
+def assert_golden_outputs(test, xml_file=GOLDEN_XML, n_vcfs=1, **kwargs):
+    """
+    Annotate each VCF of GOLDEN_OUTPUTS with expand_clinvar_vcfs and check
+    that every output is the expected one
+
+    Args:
+        test: TestCase running the check
+        xml_file: name of the XML file in tests.resources, or None (e.g.
+            with index_file)
+        n_vcfs: number of times the VCF is passed, each to its own output
+        kwargs: passed to expand_clinvar_vcfs
+    Returns:
+        list of the Metrics of each run
+    """
+    runs = []
+    for vcf, annotated, pre_may_2017 in GOLDEN_OUTPUTS:
+        with (
+            tempfile.TemporaryDirectory() as tempdir,
+            pkg_resources.path(tests.resources,
+                               xml_file or GOLDEN_XML) as xmlpath,
+            pkg_resources.path(tests.resources, vcf) as vcfpath):
+            outfiles = [Path(tempdir) / f'parsed_{i}.vcf'
+                        for i in range(n_vcfs)]
+            metrics = Metrics()
+            expand_clinvar_vcfs(None if xml_file is None else str(xmlpath),
+                                [str(vcfpath)] * n_vcfs, outfiles,
+                                pre_may_2017=pre_may_2017, metrics=metrics,
+                                **kwargs)
+            expected = pkg_resources.read_text(tests.resources, annotated)
+            for outfile in outfiles:
+                test.assertEqual(outfile.read_text(), expected)
+        runs.append(metrics)
+    return runs
@@ -0,0 +1,171 @@
+import importlib.resources as pkg_resources
+import tempfile
+
+from pathlib import Path
+from unittest import TestCase
+
+from clinvar_vcf.annotation_index import (
+    build_index,
+    decode_annotations,
+    encode_annotations,
+    is_index,
+    mine_index,
+    open_index,
+    record_stamp)
+from clinvar_vcf.clinvar_vcf_parser import (
+    main,
+    mine_xml_sequential)
+
+import tests.resources
+from tests.golden import assert_golden_outputs
+
+
+class TestAnnotationIndex(TestCase):
+    """
+    Test the annotation index functions
+    """
+
+    def setUp(self):
+        self.tempdir = tempfile.TemporaryDirectory()
+        self.index_file = str(Path(self.tempdir.name) / 'clinvar.idx')
+        with pkg_resources.path(
+                tests.resources,
+                'ClinVarFullRelease_2021-03_5_records.xml') as xmlpath:
+            self.xml_file = str(xmlpath)
+            self.n = build_index(self.xml_file, self.index_file)
+
+    def tearDown(self):
+        self.tempdir.cleanup()
+
+    def test_build_index(self):
+        """
+        build_index stores every ClinVarSet record
+        """
+        self.assertEqual(self.n, 5)
+        self.assertTrue(is_index(self.index_file))
+        self.assertFalse(is_index(self.xml_file))
+        with self.assertRaises(ValueError):
+            open_index(self.xml_file)
+
+    def test_build_index_workers(self):
+        """
+        build_index writes the same records with a pool of processes
+        """
+        index_file = str(Path(self.tempdir.name) / 'workers.idx')
+        self.assertEqual(build_index(self.xml_file, index_file, workers=2), 5)
+        with open_index(self.index_file) as conn1, \
+                open_index(index_file) as conn2:
+            query = 'SELECT * FROM clinvar_sets ORDER BY seq'
+            self.assertEqual(conn1.execute(query).fetchall(),
+                             conn2.execute(query).fetchall())
+
+    def test_build_index_previous(self):
+        """
+        build_index with a previous index copies unchanged records and
+        re-extracts the updated ones
+        """
+        query = 'SELECT ms_id, rcv, stamp, annotations FROM clinvar_sets ' \
+                'ORDER BY seq'
+        for workers in (1, 2):
+            index_file = str(Path(self.tempdir.name) / f'next{workers}.idx')
+            self.assertEqual(build_index(self.xml_file, index_file,
+                                         workers=workers,
+                                         previous=self.index_file), 5)
+            with open_index(self.index_file) as conn1, \
+                    open_index(index_file) as conn2:
+                self.assertEqual(conn1.execute(query).fetchall(),
+                                 conn2.execute(query).fetchall())
+                self.assertEqual(conn2.execute(
+                    "SELECT value FROM meta WHERE key = 'reused'").fetchone(),
+                    ('5',))
+
+        # SCV000212601 is updated to Likely pathogenic in the next release
+        lines = Path(self.xml_file).read_text().split('\n')
+        scv = next(i for i, line in enumerate(lines)
+                   if 'Acc="SCV000212601"' in line)
+        lines[scv] = lines[scv].replace('Version="1"', 'Version="2"')
+        description = next(i for i in range(scv, len(lines))
+                           if '<Description>' in lines[i])
+        lines[description] = lines[description].replace(
+            'Pathogenic', 'Likely pathogenic')
+        xml_file = Path(self.tempdir.name) / 'next.xml'
+        xml_file.write_text('\n'.join(lines))
+
+        index_file = str(Path(self.tempdir.name) / 'next.idx')
+        full_index_file = str(Path(self.tempdir.name) / 'full.idx')
+        build_index(str(xml_file), index_file, previous=self.index_file)
+        build_index(str(xml_file), full_index_file)
+        with open_index(full_index_file) as conn1, \
+                open_index(index_file) as conn2:
+            self.assertEqual(conn1.execute(query).fetchall(),
+                             conn2.execute(query).fetchall())
+            self.assertEqual(conn2.execute(
+                "SELECT value FROM meta WHERE key = 'reused'").fetchone(),
+                ('4',))
+        returned = [m for _, matches in mine_index(
+            index_file, {'RCV000162196'}, pre_may_2017=True)
+                    for m in matches]
+        self.assertEqual(returned[0][2]['CLNSIGA'], ['Likely pathogenic'])
+
+    def test_encode_annotations(self):
+        """
+        encode_annotations and decode_annotations round trip
+        """
+        annotations = [m for _, matches in mine_xml_sequential(
+            self.xml_file, {'RCV000159614'}, pre_may_2017=True)
+                       for m in matches][0][2]
+        self.assertEqual(
+            decode_annotations(encode_annotations(annotations)), annotations)
+
+    def test_record_stamp(self):
+        """
+        record_stamp changes with the version attributes only
+        """
+        span = (b'<ClinVarSet ID="1"><ReferenceClinVarAssertion '
+                b'DateLastUpdated="2020-06-01"><ClinVarAccession '
+                b'Acc="RCV000000001" Version="1"/><Description>Benign'
+                b'</Description></ReferenceClinVarAssertion></ClinVarSet>')
+        self.assertEqual(record_stamp(span),
+                         record_stamp(span.replace(b'Benign', b'Pathogenic')))
+        self.assertNotEqual(record_stamp(span),
+                            record_stamp(span.replace(b'Version="1"',
+                                                      b'Version="2"')))
+
+    def test_mine_index(self):
+        """
+        mine_index returns the records of mine_xml_sequential in XML order
+        """
+        for keys, pre_may_2017 in (({'846933', '17661'}, False),
+                                   ({'RCV000193277', 'RCV000162196'}, True)):
+            returned = [m for _, matches in mine_index(
+                self.index_file, keys, pre_may_2017=pre_may_2017)
+                        for m in matches]
+            expected = [m for _, matches in mine_xml_sequential(
+                self.xml_file, keys, pre_may_2017=pre_may_2017)
+                        for m in matches]
+            self.assertEqual(returned, expected)
+
+    def test_expand_clinvar_vcf_index(self):
+        """
+        expand_clinvar_vcf output is the same from the index and the XML
+        """
+        assert_golden_outputs(self, xml_file=None,
+                              index_file=self.index_file)
+
+    def test_main_build_index(self):
+        """
+        clinvar_vcf_parser build-index writes an index usable with --index
+        """
+        index_file = Path(self.tempdir.name) / 'main.idx'
+        outfile = Path(self.tempdir.name) / 'parsed.vcf'
+        logfile = Path(self.tempdir.name) / 'parsed.log'
+        main(['build-index', '-x', self.xml_file, '-o', str(index_file),
+              '-l', str(logfile)])
+        with pkg_resources.path(tests.resources,
+                                'clinvar_20210302_3_records.vcf') as vcfpath:
+            main(['--index', str(index_file), '-i', str(vcfpath),
+                  '-o', str(outfile), '-l', str(logfile)])
+        self.assertEqual(
+            outfile.read_text(),
+            pkg_resources.read_text(
+                tests.resources, 'clinvar_20210302_3_records_annotated.vcf'))
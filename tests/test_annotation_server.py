@@ -0,0 +1,153 @@
+import http.client
+import importlib.resources as pkg_resources
+import json
+import tempfile
+import threading
+import urllib.error
+import urllib.request
+
+from concurrent.futures import ThreadPoolExecutor
+from pathlib import Path
+from unittest import TestCase
+
+from clinvar_vcf.annotation_index import SQLITE_MAGIC, build_index
+from clinvar_vcf.annotation_server import AnnotationServer
+from clinvar_vcf.clinvar_vcf_parser import main
+
+import tests.resources
+
+
+class TestAnnotationServer(TestCase):
+    """
+    Test the annotation service
+    """
+
+    def setUp(self):
+        self.tempdir = tempfile.TemporaryDirectory()
+        self.index_file = str(Path(self.tempdir.name) / 'clinvar.idx')
+        with pkg_resources.path(
+                tests.resources,
+                'ClinVarFullRelease_2021-03_5_records.xml') as xmlpath:
+            build_index(str(xmlpath), self.index_file)
+        self.server = AnnotationServer(('127.0.0.1', 0), self.index_file)
+        self.url = 'http://127.0.0.1:%s' % self.server.server_address[1]
+        self.thread = threading.Thread(target=self.server.serve_forever)
+        self.thread.start()
+
+    def tearDown(self):
+        self.server.shutdown()
+        self.server.server_close()
+        self.thread.join()
+        self.tempdir.cleanup()
+
+    def request(self, path, body=None):
+        """
+        Return the body of the response to a GET, or a POST of body (str or
+        bytes)
+        """
+        if isinstance(body, str):
+            body = body.encode()
+        data = body
+        with urllib.request.urlopen(self.url + path, data=data) as response:
+            return response.read().decode()
+
+    def test_annotate(self):
+        """
+        POST /annotate returns the output of clinvar_vcf_parser
+        """
+        for vcf, annotated, query in (
+                ('clinvar_20210302_3_records.vcf',
+                 'clinvar_20210302_3_records_annotated.vcf', ''),
+                ('clinvar_20170404_13_records.vcf',
+                 'clinvar_20170404_13_records_annotated.vcf',
+                 '?pre_may_2017=1')):
+            body = pkg_resources.read_text(tests.resources, vcf)
+            expected = pkg_resources.read_text(tests.resources, annotated)
+            self.assertEqual(self.request('/annotate' + query, body),
+                             expected)
+            # concurrent requests
+            with ThreadPoolExecutor(4) as pool:
+                for returned in pool.map(
+                        lambda _: self.request('/annotate' + query, body),
+                        range(8)):
+                    self.assertEqual(returned, expected)
+
+    def test_annotate_errors(self):
+        """
+        POST /annotate answers 400 to a body that is not a VCF, and goes on
+        serving
+        """
+        for body in ('##fileformat=VCFv4.1\n1\t1\t17661\tA\tG\n',
+                     b'\xff\xfe'):
+            with self.assertRaises(urllib.error.HTTPError) as cm:
+                self.request('/annotate', body)
+            self.assertEqual(cm.exception.code, 400)
+        self.assertEqual(json.loads(self.request('/status'))['records'], 5)
+
+    def test_content_length_errors(self):
+        """
+        POST answers 400 to a Content-Length that is not a byte count
+        """
+        for length in ('abc', '-1'):
+            conn = http.client.HTTPConnection(
+                *self.server.server_address[:2], timeout=10)
+            try:
+                conn.putrequest('POST', '/annotations')
+                conn.putheader('Content-Length', length)
+                conn.endheaders()
+                self.assertEqual(conn.getresponse().status, 400)
+            finally:
+                conn.close()
+        self.assertEqual(json.loads(self.request('/status'))['records'], 5)
+
+    def test_annotations(self):
+        """
+        POST /annotations returns the annotations of the IDs found
+        """
+        returned = json.loads(self.request(
+            '/annotations', json.dumps(['17661', '1'])))
+        self.assertEqual(list(returned), ['17661'])
+        self.assertEqual(returned['17661']['CLNSCVA'],
+                         ['SCV000210031', 'SCV000185672', 'SCV000253789'])
+        returned = json.loads(self.request(
+            '/annotations?pre_may_2017=1', json.dumps(['RCV000193277'])))
+        self.assertEqual(returned['RCV000193277']['CLNSCVA'],
+                         ['SCV000247730', 'SCV000301122'])
+        for body in ('{"not": "a list"}', '"17661"'):
+            with self.assertRaises(urllib.error.HTTPError) as cm:
+                self.request('/annotations', body)
+            self.assertEqual(cm.exception.code, 400)
+
+    def test_reload(self):
+        """
+        POST /reload serves a new index without restarting
+        """
+        self.assertEqual(json.loads(self.request('/status'))['records'], 5)
+        new_index = str(Path(self.tempdir.name) / 'new.idx')
+        with pkg_resources.path(
+                tests.resources,
+                'ClinVarFullRelease_2021-03_1_record.xml') as xmlpath:
+            build_index(str(xmlpath), new_index)
+        status = json.loads(self.request(
+            '/reload', json.dumps({'index': new_index})))
+        self.assertEqual(status['index'], new_index)
+        self.assertEqual(status['records'], 1)
+        self.assertEqual(status['meta']['xml_file'],
+                         'ClinVarFullRelease_2021-03_1_record.xml')
+        self.assertEqual(json.loads(self.request('/status'))['records'], 1)
+        corrupt_index = str(Path(self.tempdir.name) / 'corrupt.idx')
+        Path(corrupt_index).write_bytes(SQLITE_MAGIC + b'\0' * 100)
+        for body in [json.dumps({'index': index_file})
+                     for index_file in (__file__, corrupt_index)] + ['[1]']:
+            with self.assertRaises(urllib.error.HTTPError) as cm:
+                self.request('/reload', body)
+            self.assertEqual(cm.exception.code, 400)
+        self.assertEqual(json.loads(self.request('/status'))['records'], 1)
+
+    def test_main_serve(self):
+        """
+        serve takes the index with --index only, -x being the XML file of
+        the other commands
+        """
+        with self.assertRaises(SystemExit):
+            main(['serve', '-x', self.index_file])
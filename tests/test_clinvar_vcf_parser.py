@@ -1,31 +1,69 @@
 import filecmp
+import gzip
+import json
+import pstats
 import importlib.resources as pkg_resources
+import importlib.util
+import io
 import os.path
 import shlex
+import subprocess
 import sys
 import tempfile
 
 from pathlib import Path
-from unittest import TestCase, skipIf
+from unittest import TestCase, mock, skipIf
 import xml.etree.ElementTree as ET
 
+import pandas as pd
+
 from clinvar_vcf.clinvar_vcf_parser import (
+    append_info,
     expand_clinvar_vcf,
+    expand_clinvar_vcfs,
     get_accession,
+    get_annotations,
+    get_assertion_values,
     get_clinsig,
+    get_handle,
     get_origin,
+    get_record_ids,
     get_submitdate,
     get_submitters,
     get_traits,
+    iter_annotated_records,
+    iter_clinvar_set_chunks,
+    iter_vcf_records,
     join_entries,
+    mine_clinvar_set,
+    mine_xml,
+    mine_xml_chunk,
+    mine_xml_parallel,
+    mine_xml_sequential,
+    read_bed_regions,
+    read_id_list,
     read_vcf,
+    read_vcf_ids,
     replace_sep,
     remove_newlines_and_tabs,
+    scan_key_id,
     split_multi_vcf,
+    split_rcv_ids,
     split_vcf_info,
-    main)
+    main,
+    ALL_KEYS,
+    INFO_FIELDS,
+    AnnotationTable,
+    Metrics,
+    MmapReader,
+    PipelineStage,
+    ReadAheadReader,
+    RecordSelection,
+    GZIP_BACKENDS,
+    XML_ENGINES)
 
 import tests.resources
+from tests.golden import assert_golden_outputs
 
 
 CV2021_XML = '/reference/data/clinvar/xml/ClinVarFullRelease_2021-03.xml.gz'
@@ -36,12 +74,43 @@ CV2021_OUT = ('/working/genomeinfo/share/olgaK/parse_ClinVar_vcfs/'
 CV2021_INTEGRATION_TEST_RESOURCES = all(
     os.path.isfile(f) for f in (CV2021_XML, CV2021_VCF, CV2021_OUT))
 
+try:
+    import lxml  # noqa: F401
+    AVAILABLE_XML_ENGINES = list(XML_ENGINES)
+except ImportError:
+    AVAILABLE_XML_ENGINES = [x for x in XML_ENGINES if x != 'lxml']
+
+AVAILABLE_GZIP_BACKENDS = [
+    x for x, module in (('isal', 'isal'), ('zlib-ng', 'zlib_ng'),
+                        ('gzip', 'gzip'))
+    if importlib.util.find_spec(module) is not None]
+
 
 class TestModuleFunctions(TestCase):
     """
     Test the top-level module functions in clinvar_vcf_parser
     """
 
+    def test_append_info(self):
+        """
+        append_info adds the annotations of the rows found in the XML
+        """
+        vcf_df = pd.DataFrame({'ID': ['1', '2', '3'],
+                               'INFO': ['A=1', 'A=2', 'A=3']},
+                              index=[10, 11, 12])
+        table = AnnotationTable()
+        annotations = {field: [] for field in INFO_FIELDS}
+        annotations['CLNSIGA'] = ['Likely pathogenic; low penetrance']
+        table.add(12, annotations)
+        returned = append_info(vcf_df, table)
+        self.assertEqual(list(returned.columns), ['ID', 'INFO'])
+        self.assertEqual(
+            list(returned['INFO']),
+            ['A=1', 'A=2',
+             'A=3;CLNSUBA=;CLNREVSTATA=;CLNDATEA=;CLNDATESUBA=;'
+             'CLNSIGA=Likely_pathogenic:_low_penetrance;CLNORA=;CLNCOMA=;'
+             'CLNSCVA=;CLNDNA='])
+
     def test_expand_clinvar_vcf(self):
         with (
             tempfile.TemporaryDirectory() as tempdir,
@@ -59,6 +128,195 @@ class TestModuleFunctions(TestCase):
                 'clinvar_20210302_1_record_annotated.vcf')
             self.assertEqual(returned, expected)
 
+    def test_expand_clinvar_vcf_workers(self):
+        """
+        expand_clinvar_vcf output does not depend on the number of workers
+        """
+        for workers in (1, 2):
+            assert_golden_outputs(self, workers=workers)
+
+    def test_expand_clinvar_vcf_pipeline(self):
+        """
+        expand_clinvar_vcf writes the same output with pipeline=True, and
+        reports the occupancy of each queue
+        """
+        for streaming, workers, queues in (
+                (False, 1, ['xml_chunks', 'mined_chunks']),
+                (True, 1, ['xml_chunks', 'mined_chunks', 'output_lines_0']),
+                (True, 2, ['mined_chunks', 'output_lines_0'])):
+            for metrics in assert_golden_outputs(
+                    self, streaming=streaming, workers=workers,
+                    pipeline=True):
+                self.assertEqual(list(metrics.queues), queues)
+                self.assertEqual(
+                    metrics.counters['clinvar_sets_processed'], 5)
+
+    def test_expand_clinvar_vcf_streaming(self):
+        """
+        expand_clinvar_vcf writes the same output with streaming=True
+        """
+        assert_golden_outputs(self, streaming=True)
+
+    def test_expand_clinvar_vcfs(self):
+        """
+        several VCF files annotated from one pass over the XML file get the
+        same output as when annotated one at a time
+        """
+        # e.g. the GRCh37 and GRCh38 VCFs of a release, with the same IDs
+        annotated = ('clinvar_20210302_3_records_annotated.vcf',) * 2
+        with (
+            tempfile.TemporaryDirectory() as tempdir,
+            pkg_resources.path(
+                tests.resources,
+                'ClinVarFullRelease_2021-03_5_records.xml') as xmlpath,
+            pkg_resources.path(
+                tests.resources,
+                'clinvar_20210302_3_records.vcf') as vcfpath_0,
+            pkg_resources.path(
+                tests.resources,
+                'clinvar_20210302_3_records.vcf') as vcfpath_1):
+            for streaming in ([], ['--streaming']):
+                outfiles = [Path(tempdir) / f'parsed_{i}.vcf'
+                            for i in range(2)]
+                main(['-x', str(xmlpath),
+                      '-i', str(vcfpath_0), '-o', str(outfiles[0]),
+                      '-i', str(vcfpath_1), '-o', str(outfiles[1]),
+                      '-l', str(Path(tempdir) / 'parsed.log'), *streaming])
+                for outfile, expected in zip(outfiles, annotated):
+                    self.assertEqual(
+                        outfile.read_text(),
+                        pkg_resources.read_text(tests.resources, expected))
+            with self.assertRaises(SystemExit):
+                main(['-x', str(xmlpath), '-i', str(vcfpath_0),
+                      '-i', str(vcfpath_1), '-o', str(outfiles[0])])
+        with (
+            tempfile.TemporaryDirectory() as tempdir,
+            pkg_resources.path(
+                tests.resources,
+                'ClinVarFullRelease_2021-03_5_records.xml') as xmlpath,
+            pkg_resources.path(
+                tests.resources,
+                'clinvar_20170404_13_records.vcf') as vcfpath):
+            for streaming in (False, True):
+                outfiles = [Path(tempdir) / f'parsed_{i}.vcf'
+                            for i in range(2)]
+                expand_clinvar_vcfs(str(xmlpath), [str(vcfpath)] * 2,
+                                    outfiles, pre_may_2017=True,
+                                    streaming=streaming)
+                for outfile in outfiles:
+                    self.assertEqual(
+                        outfile.read_text(),
+                        pkg_resources.read_text(
+                            tests.resources,
+                            'clinvar_20170404_13_records_annotated.vcf'))
+
+    def test_expand_clinvar_vcf_subset(self):
+        """
+        expand_clinvar_vcf with regions_file or ids_file writes out the
+        selected records of the full output
+        """
+        for vcf, annotated, pre_may_2017, bed, ids, positions in (
+                ('clinvar_20210302_3_records.vcf',
+                 'clinvar_20210302_3_records_annotated.vcf', False,
+                 'chr11\t108175000\t108176000\n', None, ['108175462']),
+                ('clinvar_20210302_3_records.vcf',
+                 'clinvar_20210302_3_records_annotated.vcf', False,
+                 None, '846933\n17661\n', ['865568', '108175462']),
+                ('clinvar_20210302_3_records.vcf',
+                 'clinvar_20210302_3_records_annotated.vcf', False,
+                 '1\t0\t2000000\n', '846933\n17661\n', ['865568']),
+                ('clinvar_20170404_13_records.vcf',
+                 'clinvar_20170404_13_records_annotated.vcf', True,
+                 '11\t108151706\t108151707\n', None, ['108151707'] * 5),
+                ('clinvar_20170404_13_records.vcf',
+                 'clinvar_20170404_13_records_annotated.vcf', True,
+                 None, '# RCVs\nRCV000193277.2\nRCV000224503\n',
+                 ['955619', '108151707'])):
+            with (
+                tempfile.TemporaryDirectory() as tempdir,
+                pkg_resources.path(
+                    tests.resources,
+                    'ClinVarFullRelease_2021-03_5_records.xml') as xmlpath,
+                pkg_resources.path(tests.resources, vcf) as vcfpath):
+                regions_file = ids_file = None
+                if bed is not None:
+                    regions_file = os.path.join(tempdir, 'regions.bed')
+                    Path(regions_file).write_text(bed)
+                if ids is not None:
+                    ids_file = os.path.join(tempdir, 'ids.txt')
+                    Path(ids_file).write_text(ids)
+                outfile = Path(tempdir) / 'parsed.vcf'
+                expand_clinvar_vcf(str(xmlpath), str(vcfpath), outfile,
+                                   pre_may_2017=pre_may_2017,
+                                   regions_file=regions_file,
+                                   ids_file=ids_file)
+                lines = pkg_resources.read_text(
+                    tests.resources, annotated).splitlines(keepends=True)
+                returned = outfile.read_text().splitlines(keepends=True)
+                header = [x for x in lines if x.startswith('#')]
+                self.assertEqual(returned[:len(header)], header)
+                self.assertEqual([x.split('\t')[1]
+                                  for x in returned[len(header):]], positions)
+                self.assertTrue(set(returned) <= set(lines))
+
+    def test_metrics_json(self):
+        """
+        --metrics-json reports every stage and the ClinVarSet counts, and
+        --profile writes cProfile stats of the XML stage
+        """
+        with (
+            tempfile.TemporaryDirectory() as tempdir,
+            pkg_resources.path(
+                tests.resources,
+                'ClinVarFullRelease_2021-03_5_records.xml') as xmlpath,
+            pkg_resources.path(
+                tests.resources, 'clinvar_20210302_3_records.vcf') as vcfpath):
+            for streaming, stages in (
+                    ([], ['read_vcf', 'lookup', 'mine_xml', 'join_entries',
+                          'output']),
+                    (['--streaming'], ['lookup', 'mine_xml', 'output'])):
+                metrics_file = Path(tempdir) / 'metrics.json'
+                profile_file = Path(tempdir) / 'mine_xml.prof'
+                main(['-x', str(xmlpath), '-i', str(vcfpath),
+                      '-o', str(Path(tempdir) / 'parsed.vcf'),
+                      '-l', str(Path(tempdir) / 'parsed.log'),
+                      '--metrics-json', str(metrics_file),
+                      '--profile', str(profile_file), *streaming])
+                metrics = json.loads(metrics_file.read_text())
+                self.assertEqual(list(metrics['stages']), stages)
+                for stats in metrics['stages'].values():
+                    self.assertGreaterEqual(stats['wall_seconds'], 0)
+                    self.assertIn('cpu_seconds', stats)
+                    self.assertGreater(stats['peak_rss_mb'], 0)
+                self.assertEqual(metrics['stages']['mine_xml']['records'], 5)
+                self.assertEqual(metrics['counters'], {
+                    'xml_bytes_read': xmlpath.stat().st_size,
+                    'clinvar_sets_processed': 5,
+                    'clinvar_sets_matched': 3,
+                    'clinvar_sets_skipped': 2,
+                    'vcf_records_annotated': 2})
+                self.assertTrue(any(
+                    func[2] == 'mine_xml'
+                    for func in pstats.Stats(str(profile_file)).stats))
+
+    def test_metrics_stage(self):
+        """
+        a stage is recorded even if its body raises, and its RSS and child
+        CPU time are None without the resource module (Windows)
+        """
+        metrics = Metrics()
+        with self.assertRaises(ValueError), metrics.stage('failed'):
+            raise ValueError
+        self.assertGreaterEqual(metrics.stages['failed']['wall_seconds'], 0)
+        with mock.patch.dict(sys.modules, {'resource': None}):
+            with metrics.stage('no_resource') as stats:
+                stats['records'] = 1
+            self.assertIsNone(metrics.report()['peak_rss_mb'])
+        stats = metrics.stages['no_resource']
+        self.assertIsNone(stats['child_cpu_seconds'])
+        self.assertIsNone(stats['peak_rss_mb'])
+        self.assertIn('cpu_seconds', stats)
+
     def test_get_accession(self):
         """
         get_accession behaves as expected
@@ -72,6 +330,49 @@ class TestModuleFunctions(TestCase):
             expected = ['SCV001214463']
             self.assertEqual(returned, expected)
 
+    def test_get_annotations(self):
+        """
+        get_annotations returns one list per INFO field
+        """
+        with pkg_resources.path(
+                tests.resources,
+                'ClinVarFullRelease_2021-03_1_record.xml') as fpath:
+            cvs = ET.parse(fpath).getroot().find('./ClinVarSet')
+            returned = get_annotations(cvs)
+            self.assertEqual(
+                list(returned),
+                ['CLNSUBA', 'CLNREVSTATA', 'CLNDATEA', 'CLNDATESUBA',
+                 'CLNSIGA', 'CLNORA', 'CLNCOMA', 'CLNSCVA', 'CLNDNA'])
+            self.assertEqual(returned['CLNSCVA'], ['SCV001214463'])
+            self.assertEqual(returned['CLNDNA'], ['not provided'])
+
+    def test_get_assertion_values(self):
+        """
+        get_assertion_values agrees with the per-field extractors and gives
+        up on irregular records
+        """
+        with pkg_resources.path(
+                tests.resources,
+                'ClinVarFullRelease_2021-03_5_records.xml') as fpath:
+            for cvs in ET.parse(fpath).getroot().findall('./ClinVarSet'):
+                cva = cvs.findall('./ClinVarAssertion')
+                returned = get_assertion_values(cva)
+                self.assertEqual(returned['CLNREVSTATA'],
+                                 get_clinsig(cva, field='status_ordered'))
+                self.assertEqual(returned['CLNDATEA'],
+                                 get_clinsig(cva, field='last_eval'))
+                self.assertEqual(returned['CLNSIGA'],
+                                 get_clinsig(cva, field='description'))
+                self.assertEqual(returned['CLNCOMA'],
+                                 get_clinsig(cva, field='comment'))
+                self.assertEqual(returned['CLNDATESUBA'], get_submitdate(cva))
+                self.assertEqual(returned['CLNORA'],
+                                 get_origin(cva, as_set=False))
+                self.assertEqual(returned['CLNSCVA'], get_accession(cva))
+            for node in cva[0].findall('./ClinicalSignificance'):
+                node.remove(node.find('./Description'))
+            self.assertIsNone(get_assertion_values(cva))
+
     def test_get_clinsig_status_ordered(self):
         """
         get_clinsig behaves as expected
@@ -137,6 +438,18 @@ class TestModuleFunctions(TestCase):
             expected = ['germline']
             self.assertEqual(returned, expected)
 
+    def test_get_record_ids(self):
+        """
+        get_record_ids keys on MeasureSet ID or, pre May 2017, RCV accession
+        """
+        with pkg_resources.path(
+                tests.resources,
+                'ClinVarFullRelease_2021-03_1_record.xml') as fpath:
+            cvs = ET.parse(fpath).getroot().find('./ClinVarSet')
+            self.assertEqual(get_record_ids(cvs), ('846933', '846933'))
+            self.assertEqual(get_record_ids(cvs, pre_may_2017=True),
+                             ('RCV001050361', '846933'))
+
     def test_get_submitdate(self):
         """
         get_submitdate behaves as expected
@@ -174,6 +487,271 @@ class TestModuleFunctions(TestCase):
             expected = ['not provided']
             self.assertEqual(returned, expected)
 
+    def test_get_handle_gzip_backends(self):
+        """
+        get_handle decompresses a gzipped XML file with every backend
+        """
+        with tempfile.TemporaryDirectory() as tempdir, \
+                pkg_resources.path(
+                    tests.resources,
+                    'ClinVarFullRelease_2021-03_5_records.xml') as fpath:
+            expected = fpath.read_bytes()
+            gz_file = str(Path(tempdir) / 'clinvar.xml.gz')
+            with gzip.open(gz_file, 'wb') as f:
+                f.write(expected)
+            for backend in ['auto', *AVAILABLE_GZIP_BACKENDS]:
+                with get_handle(gz_file, gzip_backend=backend) as handle:
+                    self.assertEqual(b''.join(iter_clinvar_set_chunks(
+                        handle, block_size=100)),
+                        b''.join(iter_clinvar_set_chunks(
+                            io.BytesIO(expected))))
+            self.assertEqual(set(GZIP_BACKENDS), {'isal', 'zlib-ng', 'gzip'})
+
+    def test_read_ahead_reader(self):
+        """
+        ReadAheadReader returns the bytes of the wrapped file
+        """
+        data = bytes(range(256)) * 50
+        with ReadAheadReader(io.BytesIO(data), block_size=1000,
+                             blocks=2) as reader:
+            self.assertEqual(reader.read(10), data[:10])
+            self.assertEqual(reader.read(2500), data[10:2510])
+            self.assertEqual(reader.read(), data[2510:])
+            self.assertEqual(reader.read(10), b'')
+        # closing before the end stops the background thread
+        reader = ReadAheadReader(io.BytesIO(data), block_size=10, blocks=1)
+        reader.read(5)
+        reader.close()
+        self.assertFalse(reader.thread.is_alive())
+
+    def test_pipeline_stage(self):
+        """
+        PipelineStage yields the items of its source in order, re-raises
+        its errors and stops its thread when the consumer stops early
+        """
+        metrics = Metrics()
+        self.assertEqual(list(PipelineStage('numbers', range(100), maxsize=2,
+                                            metrics=metrics)),
+                         list(range(100)))
+        stats = metrics.queues['numbers']
+        self.assertEqual(stats['items'], 100)
+        self.assertEqual(stats['size'], 2)
+        self.assertTrue(0 <= stats['mean_occupancy'] <= 1)
+
+        def failing():
+            yield 1
+            raise ValueError('bad record')
+        with self.assertRaisesRegex(ValueError, 'bad record'):
+            list(PipelineStage('failing', failing()))
+
+        stage = PipelineStage('endless', iter(int, 1), maxsize=1)
+        for i in stage:
+            if i == 0:
+                break
+        stage.close()
+        self.assertFalse(stage.thread.is_alive())
+
+    def test_iter_annotated_records(self):
+        """
+        iter_annotated_records yields the records of the annotated VCF
+        """
+        for vcf, annotated, pre_may_2017 in (
+                ('clinvar_20210302_3_records.vcf',
+                 'clinvar_20210302_3_records_annotated.vcf', False),
+                ('clinvar_20170404_13_records.vcf',
+                 'clinvar_20170404_13_records_annotated.vcf', True)):
+            with pkg_resources.path(
+                    tests.resources,
+                    'ClinVarFullRelease_2021-03_5_records.xml') as xmlpath, \
+                    pkg_resources.path(tests.resources, vcf) as vcfpath:
+                records = list(iter_annotated_records(
+                    str(xmlpath), str(vcfpath), pre_may_2017=pre_may_2017))
+                expected = list(iter_vcf_records(pkg_resources.read_text(
+                    tests.resources, annotated).splitlines()))
+                self.assertEqual(len(records), len(expected))
+                n_annotated = 0
+                for record, fields in zip(records, expected):
+                    self.assertIsInstance(record.pos, int)
+                    self.assertEqual(
+                        [record.chrom, str(record.pos), record.id,
+                         record.ref, record.alt, record.qual, record.filter],
+                        fields[:7])
+                    self.assertEqual(list(record.annotations),
+                                     list(INFO_FIELDS))
+                    info = record.info
+                    if record.annotations['CLNSCVA']:
+                        n_annotated += 1
+                        info += ';' + ';'.join(
+                            f'{k}={v}' for k, v in join_entries(
+                                dict(record.annotations)).items())
+                    self.assertEqual(info, fields[7])
+                self.assertGreater(n_annotated, 0)
+
+    def test_iter_clinvar_set_chunks(self):
+        """
+        iter_clinvar_set_chunks splits on ClinVarSet boundaries
+        """
+        with pkg_resources.path(
+                tests.resources,
+                'ClinVarFullRelease_2021-03_5_records.xml') as fpath:
+            with open(fpath, 'rb') as handle:
+                chunks = list(iter_clinvar_set_chunks(
+                    handle, records_per_chunk=2, block_size=100))
+            self.assertEqual(len(chunks), 3)
+            ids = []
+            for chunk in chunks:
+                self.assertTrue(chunk.startswith(b'<ClinVarSet '))
+                self.assertTrue(chunk.endswith(b'</ClinVarSet>'))
+                root = ET.fromstring(b'<R>' + chunk + b'</R>')
+                ids.extend(x.attrib['ID'] for x in root)
+            self.assertEqual(ids, [x.attrib['ID'] for x in ET.parse(fpath)
+                                   .getroot().findall('./ClinVarSet')])
+
+    def test_iter_clinvar_set_chunks_skip(self):
+        """
+        iter_clinvar_set_chunks drops the first skip ClinVarSet elements
+        """
+        with pkg_resources.path(
+                tests.resources,
+                'ClinVarFullRelease_2021-03_5_records.xml') as fpath:
+            expected = [x.attrib['ID'] for x in ET.parse(fpath)
+                        .getroot().findall('./ClinVarSet')]
+            for skip in range(7):
+                for block_size in (100, 1 << 20):
+                    with open(fpath, 'rb') as handle:
+                        chunks = list(iter_clinvar_set_chunks(
+                            handle, records_per_chunk=2,
+                            block_size=block_size, skip=skip))
+                    root = ET.fromstring(b'<R>' + b''.join(chunks) + b'</R>')
+                    self.assertEqual([x.attrib['ID'] for x in root],
+                                     expected[skip:])
+
+    def test_iter_clinvar_set_chunks_mmap(self):
+        """
+        an uncompressed XML file is mapped into memory, and its chunks are
+        memoryview slices with the bytes of the chunks of a stream
+        """
+        with pkg_resources.path(
+                tests.resources,
+                'ClinVarFullRelease_2021-03_5_records.xml') as fpath, \
+                mock.patch('clinvar_vcf.clinvar_vcf_parser.'
+                           'MMAP_RELEASE_BYTES', 1):
+            for records_per_chunk in (1, 2, 5):
+                for skip in (0, 3):
+                    with open(fpath, 'rb') as handle:
+                        expected = list(iter_clinvar_set_chunks(
+                            handle, records_per_chunk, skip=skip))
+                    metrics = Metrics()
+                    with get_handle(str(fpath)) as handle:
+                        self.assertIsInstance(handle, MmapReader)
+                        chunks = list(iter_clinvar_set_chunks(
+                            metrics.reader(handle), records_per_chunk,
+                            skip=skip))
+                        for chunk in chunks:
+                            self.assertIsInstance(chunk, memoryview)
+                        self.assertEqual([bytes(x) for x in chunks], expected)
+                        self.assertEqual(
+                            mine_xml_chunk(chunks[0], ALL_KEYS),
+                            mine_xml_chunk(expected[0], ALL_KEYS))
+                        del chunks
+                    self.assertEqual(metrics.counters['xml_bytes_read'],
+                                     os.path.getsize(fpath))
+        with tempfile.TemporaryDirectory() as tempdir:
+            empty = Path(tempdir) / 'empty.xml'
+            empty.touch()
+            with get_handle(str(empty)) as handle:
+                self.assertNotIsInstance(handle, MmapReader)
+                self.assertEqual(list(iter_clinvar_set_chunks(handle)), [])
+
+    def test_mine_xml_resume(self):
+        """
+        mine_xml resumed from a checkpoint returns the annotations of an
+        uninterrupted run, without mining the records again
+        """
+        with (
+            tempfile.TemporaryDirectory() as tempdir,
+            pkg_resources.path(
+                tests.resources,
+                'ClinVarFullRelease_2021-03_5_records.xml') as xmlpath,
+            pkg_resources.path(
+                tests.resources, 'clinvar_20210302_3_records.vcf') as vcfpath):
+            xml_file = str(xmlpath)
+            _, id_dict = read_vcf_ids(str(vcfpath))
+            expected = dict(mine_xml(xml_file, id_dict).items())
+            checkpoint = os.path.join(tempdir, 'mine.ckpt')
+
+            calls = []
+
+            def interrupted(*args, **kwargs):
+                calls.append(args[0])
+                if len(calls) == 4:
+                    raise KeyboardInterrupt
+                return mine_clinvar_set(*args, **kwargs)
+
+            with mock.patch('clinvar_vcf.clinvar_vcf_parser.mine_clinvar_set',
+                            interrupted):
+                with self.assertRaises(KeyboardInterrupt):
+                    mine_xml(xml_file, id_dict, checkpoint_file=checkpoint,
+                             checkpoint_interval=0)
+                self.assertTrue(os.path.exists(checkpoint))
+                calls.clear()
+                returned = mine_xml(xml_file, id_dict,
+                                    checkpoint_file=checkpoint, resume=True)
+            self.assertEqual(len(calls), 2)
+            self.assertEqual(dict(returned.items()), expected)
+
+            with self.assertRaises(ValueError):
+                mine_xml(xml_file, {'846933': {0}},
+                         checkpoint_file=checkpoint, resume=True)
+
+    def test_expand_clinvar_vcf_resume(self):
+        """
+        --resume after an interrupted run writes the same output as an
+        uninterrupted run, and the checkpoint is removed at the end
+        """
+        with (
+            tempfile.TemporaryDirectory() as tempdir,
+            pkg_resources.path(
+                tests.resources,
+                'ClinVarFullRelease_2021-03_5_records.xml') as xmlpath,
+            pkg_resources.path(
+                tests.resources,
+                'clinvar_20170404_13_records.vcf') as vcfpath):
+            outfile = os.path.join(tempdir, 'parsed.vcf')
+            checkpoint = os.path.join(tempdir, 'parsed.ckpt')
+            args = ['-x', str(xmlpath), '-i', str(vcfpath), '-o', outfile,
+                    '-l', os.path.join(tempdir, 'parsed.log'),
+                    '--pre-may-2017', '--checkpoint', checkpoint,
+                    '--checkpoint-interval', '0']
+            with mock.patch('clinvar_vcf.clinvar_vcf_parser.append_info',
+                            side_effect=KeyboardInterrupt):
+                with self.assertRaises(KeyboardInterrupt):
+                    main(args)
+            self.assertTrue(os.path.exists(checkpoint))
+            main(args + ['--resume'])
+            self.assertFalse(os.path.exists(checkpoint))
+            self.assertEqual(
+                Path(outfile).read_text(),
+                pkg_resources.read_text(
+                    tests.resources,
+                    'clinvar_20170404_13_records_annotated.vcf'))
+
+    def test_iter_vcf_records(self):
+        """
+        iter_vcf_records splits multiallelic records like split_multi_vcf
+        """
+        with pkg_resources.path(tests.resources,
+                                'clinvar_20170404_13_records.vcf') as fpath:
+            header, vcf = read_vcf(str(fpath))
+            split_vcf = split_multi_vcf(vcf)
+            with open(fpath) as f:
+                records = list(iter_vcf_records(f, pre_may_2017=True))
+            self.assertEqual(len(records), len(split_vcf))
+            self.assertEqual([x[4] for x in records], list(split_vcf['ALT']))
+            self.assertEqual([x[7] for x in records], list(split_vcf['INFO']))
+            with open(fpath) as f:
+                self.assertEqual(len(list(iter_vcf_records(f))), len(vcf))
+
     def test_join_entries(self):
         """
         join_entries works as expected
@@ -182,6 +760,152 @@ class TestModuleFunctions(TestCase):
         returned = join_entries(dct)
         expected = {'a': '1|2|3', 'b': '4|5|6'}
         self.assertEqual(returned, expected)
+        value = 'a;b|c d"e,f\tg\nh\ri'
+        self.assertEqual(
+            join_entries({'a': [value]})['a'],
+            remove_newlines_and_tabs(replace_sep(
+                value, sep=[';', '|', ' ', '"', ','],
+                replace_with=[':', ':', '_', '', '&'])))
+
+    def test_annotation_table(self):
+        """
+        AnnotationTable stores each distinct value once and joins rows like
+        join_entries
+        """
+        with pkg_resources.path(
+                tests.resources,
+                'ClinVarFullRelease_2021-03_5_records.xml') as fpath:
+            annotations = [m[2] for _, matches in mine_xml_sequential(
+                str(fpath), ALL_KEYS, pre_may_2017=True) for m in matches]
+        table = AnnotationTable()
+        table.add(7, annotations[0])
+        table.add(3, annotations[1])
+        table.add(7, annotations[2])
+        self.assertEqual(list(table), [7, 3])
+        self.assertNotIn(0, table)
+        self.assertEqual(table[3], annotations[1])
+        merged = {field: annotations[0][field] + annotations[2][field]
+                  for field in annotations[0]}
+        self.assertEqual(table[7], merged)
+        self.assertEqual(len(table.values), len(set(table.values)))
+        self.assertEqual(table.joined(7), join_entries(dict(merged)))
+
+    def test_mine_clinvar_set(self):
+        """
+        mine_clinvar_set rejects unwanted records without parsing them
+        """
+        with pkg_resources.path(
+                tests.resources,
+                'ClinVarFullRelease_2021-03_1_record.xml') as fpath:
+            with open(fpath, 'rb') as handle:
+                (span,) = iter_clinvar_set_chunks(handle)
+        key_id, ms_id, annotations = mine_clinvar_set(span, {'846933'})
+        self.assertEqual((key_id, ms_id), ('846933', '846933'))
+        self.assertEqual(annotations['CLNSUBA'], ['Invitae'])
+        self.assertIsNone(mine_clinvar_set(span, {'17661'}))
+        # not well-formed, so would raise if it was parsed
+        broken = span.replace(b'</ClinVarAssertion>', b'')
+        self.assertIsNone(mine_clinvar_set(broken, {'17661'}))
+        with self.assertRaises(ET.ParseError):
+            mine_clinvar_set(broken, {'846933'})
+
+    def test_mine_clinvar_set_engines(self):
+        """
+        every XML engine extracts the same annotations
+        """
+        with pkg_resources.path(
+                tests.resources,
+                'ClinVarFullRelease_2021-03_5_records.xml') as fpath:
+            with open(fpath, 'rb') as handle:
+                spans = list(iter_clinvar_set_chunks(handle, 1))
+        # irregular records: no Description, no submitter, no ClinVarAssertion
+        spans.append(spans[3].replace(b'<Description>Pathogenic</Description>',
+                                      b''))
+        spans.append(spans[3].replace(b' submitter="Ambry Genetics"', b''))
+        spans.append(spans[1].split(b'<ClinVarAssertion ')[0]
+                     + b'</ClinVarSet>')
+        for pre_may_2017 in (False, True):
+            for span in spans:
+                try:
+                    expected = mine_clinvar_set(span, ALL_KEYS, pre_may_2017)
+                except (IndexError, TypeError) as e:
+                    expected = type(e)
+                for engine in AVAILABLE_XML_ENGINES:
+                    try:
+                        returned = mine_clinvar_set(span, ALL_KEYS,
+                                                    pre_may_2017, engine)
+                    except (IndexError, TypeError) as e:
+                        returned = type(e)
+                    self.assertEqual(returned, expected, engine)
+
+    def test_mine_xml_parallel(self):
+        """
+        mine_xml_parallel yields the matches of mine_xml_sequential in order
+        """
+        keys = {'846933', '17661'}
+        with pkg_resources.path(
+                tests.resources,
+                'ClinVarFullRelease_2021-03_5_records.xml') as fpath:
+            sequential = list(mine_xml_sequential(str(fpath), keys))
+            parallel = list(mine_xml_parallel(str(fpath), keys, workers=2,
+                                              records_per_chunk=2))
+            self.assertEqual([n for n, _ in parallel], [2, 2, 1])
+            self.assertEqual(
+                [m for _, matches in parallel for m in matches],
+                [m for _, matches in sequential for m in matches])
+            self.assertEqual(
+                [key_id for _, matches in parallel for key_id, _, _ in matches],
+                ['846933', '846933', '17661'])
+
+    def test_read_bed_regions(self):
+        """
+        read_bed_regions merges overlapping regions of each chromosome
+        """
+        with tempfile.TemporaryDirectory() as tempdir:
+            fname = os.path.join(tempdir, 'regions.bed')
+            Path(fname).write_text(
+                'track name=panel\n# comment\n'
+                'chr1\t200\t300\tGENE2\n'
+                'chr1\t100\t150\tGENE1\n'
+                '1\t250\t400\n'
+                'chrX\t10\t20\n\n')
+            self.assertEqual(read_bed_regions(fname),
+                             {'1': ([100, 200], [150, 400]),
+                              'X': ([10], [20])})
+
+    def test_read_id_list(self):
+        """
+        read_id_list skips comments and drops RCV versions
+        """
+        with tempfile.TemporaryDirectory() as tempdir:
+            fname = os.path.join(tempdir, 'ids.txt')
+            Path(fname).write_text('# IDs\nRCV000193277.2\n\nRCV000224503\n')
+            self.assertEqual(read_id_list(fname, pre_may_2017=True),
+                             {'RCV000193277', 'RCV000224503'})
+            self.assertEqual(read_id_list(fname),
+                             {'RCV000193277.2', 'RCV000224503'})
+
+    def test_record_selection(self):
+        """
+        RecordSelection keeps the 1-based POS in the 0-based BED regions
+        """
+        selection = RecordSelection(regions={'1': ([100, 200], [150, 400])})
+        for pos, selected in ((100, False), (101, True), (150, True),
+                              (151, False), (201, True), (400, True),
+                              (401, False)):
+            self.assertEqual(selection.in_regions('chr1', pos), selected)
+            self.assertEqual(selection(['1', str(pos), '5', 'A', 'G']),
+                             selected)
+        self.assertFalse(selection.in_regions('2', 120))
+        selection = RecordSelection(ids={'5'})
+        self.assertTrue(selection(['2', '120', '5']))
+        self.assertFalse(selection(['2', '120', '6']))
+        selection = RecordSelection(ids={'RCV000192572'}, pre_may_2017=True)
+        fields = ['1', '10', 'rs1', 'A', 'G', '.', '.']
+        self.assertTrue(selection(
+            fields + ['RS=1;CLNACC=RCV000159614.2|RCV000192572.2']))
+        self.assertFalse(selection(fields + ['RS=1;CLNACC=RCV000159614.2']))
+        self.assertFalse(selection(fields + ['RS=1']))
 
     def test_read_vcf(self):
         """
@@ -196,6 +920,22 @@ class TestModuleFunctions(TestCase):
             self.assertEqual(vcf['#CHROM'][0], '1')
             self.assertEqual(len(vcf), 1)
 
+    def test_read_vcf_ids(self):
+        """
+        read_vcf_ids maps IDs to record numbers without reading the records
+        """
+        with pkg_resources.path(tests.resources,
+                                'clinvar_20210302_3_records.vcf') as fpath:
+            header, id_dict = read_vcf_ids(str(fpath))
+            self.assertEqual(len(header), 27)
+            self.assertEqual(id_dict,
+                             {'846933': {0}, '555555': {1}, '17661': {2}})
+        with pkg_resources.path(tests.resources,
+                                'clinvar_20170404_13_records.vcf') as fpath:
+            header, vcf = read_vcf(str(fpath))
+            _, id_dict = read_vcf_ids(str(fpath), pre_may_2017=True)
+            self.assertEqual(id_dict, split_vcf_info(split_multi_vcf(vcf)))
+
     def test_remove_newlines_and_tabs(self):
         """
         remove_newlines_and_tabs behaves as expected
@@ -216,6 +956,23 @@ class TestModuleFunctions(TestCase):
         expected = 'a:b:c_de&f'
         self.assertEqual(returned, expected)
 
+    def test_scan_key_id(self):
+        """
+        scan_key_id reads the key_id of a raw ClinVarSet like get_record_ids
+        """
+        span = (b'<ClinVarSet ID="1"><ReferenceClinVarAssertion ID="2">'
+                b'<ClinVarAccession Acc="RCV000000001" Type="RCV"/>'
+                b'<MeasureSet Type="Variant" ID="10" Acc="VCV000000010">'
+                b'</MeasureSet></ReferenceClinVarAssertion>'
+                b'<ClinVarAssertion><MeasureSet ID="20"/></ClinVarAssertion>'
+                b'</ClinVarSet>')
+        self.assertEqual(scan_key_id(span), '10')
+        self.assertEqual(scan_key_id(span, pre_may_2017=True),
+                         'RCV000000001')
+        # undecided when the first MeasureSet has no plain ID attribute
+        self.assertIsNone(scan_key_id(span.replace(b' ID="10"', b'')))
+        self.assertIsNone(scan_key_id(span.replace(b'"10"', b'"1&#48;"')))
+
     def test_split_multi_vcf(self):
         """
         split_multi_vcf works as expected on old-format vcf
@@ -235,6 +992,18 @@ class TestModuleFunctions(TestCase):
             self.assertEqual(split_vcf['INFO'][6], 'RS=201073369;RSPOS=955619;dbSNPBuildID=137;SSR=0;SAO=0;VP=0x050128000a05040026000100;GENEINFO=AGRN:375790;WGT=1;VC=SNV;PM;PMC;SLO;NSM;REF;ASP;VLD;KGPhase3;CLNALLE=1;CLNHGVS=.;CLNSRC=.;CLNORIGIN=.;CLNSRCID=.;CLNSIG=.;CLNDSDB=.;CLNDSDBID=.;CLNDBN=.;CLNREVSTAT=.;CLNACC=.;CAF=0.9912,.,0.008786;COMMON=1')
             self.assertEqual(split_vcf['INFO'][7], 'RS=201073369;RSPOS=955619;dbSNPBuildID=137;SSR=0;SAO=0;VP=0x050128000a05040026000100;GENEINFO=AGRN:375790;WGT=1;VC=SNV;PM;PMC;SLO;NSM;REF;ASP;VLD;KGPhase3;CLNALLE=1;CLNHGVS=NC_000001.10:g.955619G>C;CLNSRC=.;CLNORIGIN=1;CLNSRCID=.;CLNSIG=255;CLNDSDB=MedGen;CLNDSDBID=CN169374;CLNDBN=not_specified;CLNREVSTAT=conf;CLNACC=RCV000193277.2;CAF=0.9912,.,0.008786;COMMON=1')
 
+    def test_split_multi_vcf_reference(self):
+        """
+        split_multi_vcf output matches that of the row-by-row implementation
+        """
+        with pkg_resources.path(tests.resources,
+                                'clinvar_20170404_13_records.vcf') as fpath:
+            header, vcf = read_vcf(str(fpath))
+            returned = split_multi_vcf(vcf).to_csv(sep='\t', index=False)
+            expected = pkg_resources.read_text(
+                tests.resources, 'clinvar_20170404_13_records_split.vcf')
+            self.assertEqual(returned, expected)
+
     def test_split_vcf_info(self):
         """
         split_vcf_info works as expected on old-format vcf
@@ -264,12 +1033,76 @@ class TestModuleFunctions(TestCase):
             }
             self.assertEqual(returned, expected)
 
+    def test_split_vcf_info_malformed(self):
+        """
+        split_vcf_info maps the same RCV accessions to the same lines as
+        split_rcv_ids on each INFO string, with or without pyarrow and
+        pd.ArrowDtype (pandas < 1.5), and logs the malformed ones in a
+        single warning
+        """
+        vcf = pd.DataFrame({'INFO': [
+            'A=1;CLNACC=RCV000000001.2|XYZ.1|', 'CLNACC=;B=2',
+            'CLNACC=foo=bar;CLNACC=RCV000000009', 'X=1', '']},
+            index=range(5, 10))
+        expected = {}
+        with self.assertLogs(level='WARNING'):
+            for i, info in enumerate(vcf['INFO']):
+                for rcv_id in split_rcv_ids(info, i):
+                    expected.setdefault(rcv_id, set()).add(i)
+        no_arrow_dtype = {k: v for k, v in vars(pd).items()
+                          if k != 'ArrowDtype'}
+        for patcher in (mock.patch.dict(sys.modules),
+                        mock.patch.dict(sys.modules, {'pyarrow': None}),
+                        mock.patch.dict(vars(pd), no_arrow_dtype,
+                                        clear=True)):
+            with patcher, self.assertLogs(level='WARNING') as logs:
+                self.assertEqual(split_vcf_info(vcf), expected)
+            self.assertEqual(len(logs.records), 1)
+            self.assertIn('2 CLNACC entries in 2 VCF records',
+                          logs.output[0])
+
 
 class TestMain(TestCase):
     """
     Integration tests
     """
 
+    def test_without_pandas(self):
+        """
+        the CLI and the XML helpers do not import pandas: --help and a
+        streaming run work with pandas hidden
+        """
+        with (
+            tempfile.TemporaryDirectory() as tempdir,
+            pkg_resources.path(
+                tests.resources,
+                'ClinVarFullRelease_2021-03_5_records.xml') as xmlpath,
+            pkg_resources.path(
+                tests.resources, 'clinvar_20210302_3_records.vcf') as vcfpath):
+            outfile = Path(tempdir) / 'parsed.vcf'
+            code = (
+                'import sys\n'
+                'sys.modules["pandas"] = None  # import pandas fails\n'
+                'from clinvar_vcf.clinvar_vcf_parser import get_traits, main\n'
+                'import xml.etree.ElementTree as ET\n'
+                f'root = ET.parse({str(xmlpath)!r}).getroot()\n'
+                'assert get_traits(root.find("./ClinVarSet"))\n'
+                f'main(["-x", {str(xmlpath)!r}, "-i", {str(vcfpath)!r}, '
+                f'"-o", {str(outfile)!r}, "-l", {str(outfile)!r} + ".log", '
+                '"--streaming"])\n'
+                'try:\n'
+                '    main(["--help"])\n'
+                'except SystemExit:\n'
+                '    pass\n')
+            env = dict(os.environ, PYTHONPATH=os.pathsep.join(sys.path))
+            subprocess.run([sys.executable, '-c', code], check=True,
+                           capture_output=True, env=env)
+            self.assertEqual(
+                outfile.read_text(),
+                pkg_resources.read_text(
+                    tests.resources,
+                    'clinvar_20210302_3_records_annotated.vcf'))
+
     @skipIf(not CV2021_INTEGRATION_TEST_RESOURCES,
             'Runs only when integration test resources are available')
     def test_cv2021(self):
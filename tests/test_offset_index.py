@@ -0,0 +1,144 @@
+import contextlib
+import importlib.resources as pkg_resources
+import io
+import json
+import os
+import struct
+import tempfile
+import zlib
+
+from pathlib import Path
+from unittest import TestCase
+
+from clinvar_vcf.clinvar_vcf_parser import ALL_KEYS, main, mine_xml_sequential
+from clinvar_vcf.offset_index import (
+    BgzfReader,
+    build_offset_index,
+    is_bgzf,
+    iter_clinvar_set_offsets,
+    lookup_annotations,
+    lookup_clinvar_sets)
+
+import tests.resources
+
+BGZF_EOF = bytes.fromhex('1f8b08040000000000ff0600424302001b0003000000000000'
+                         '000000')
+
+
+def write_bgzf(data, fname, block_size=1000):
+    """
+    Compress data into a BGZF file of blocks of block_size bytes, as bgzip
+    does with blocks of 64 KB
+    """
+    with open(fname, 'wb') as f:
+        for i in range(0, len(data), block_size):
+            block = data[i:i + block_size]
+            compressor = zlib.compressobj(6, zlib.DEFLATED, -15)
+            cdata = compressor.compress(block) + compressor.flush()
+            f.write(b'\x1f\x8b\x08\x04\x00\x00\x00\x00\x00\xff\x06\x00BC'
+                    + struct.pack('<HH', 2, len(cdata) + 25) + cdata
+                    + struct.pack('<II', zlib.crc32(block), len(block)))
+        f.write(BGZF_EOF)
+
+
+class TestOffsetIndex(TestCase):
+    """
+    Test the offset index
+    """
+
+    def setUp(self):
+        self.tempdir = tempfile.TemporaryDirectory()
+        with pkg_resources.path(
+                tests.resources,
+                'ClinVarFullRelease_2021-03_5_records.xml') as xmlpath:
+            self.data = xmlpath.read_bytes()
+        self.xml_file = str(Path(self.tempdir.name) / 'clinvar.xml')
+        Path(self.xml_file).write_bytes(self.data)
+        self.bgzf_file = str(Path(self.tempdir.name) / 'clinvar.xml.gz')
+        write_bgzf(self.data, self.bgzf_file)
+
+    def tearDown(self):
+        self.tempdir.cleanup()
+
+    def test_iter_clinvar_set_offsets(self):
+        """
+        the offsets point to the start of each ClinVarSet element, and the
+        BGZF virtual offsets to the same bytes in the decompressed file
+        """
+        spans = list(iter_clinvar_set_offsets(self.xml_file))
+        self.assertEqual(len(spans), 5)
+        for offset, span in spans:
+            self.assertEqual(self.data[offset:offset + len(span)], span)
+        bgzf_spans = list(iter_clinvar_set_offsets(self.bgzf_file))
+        self.assertEqual([span for _, span in bgzf_spans],
+                         [span for _, span in spans])
+        with BgzfReader(self.bgzf_file) as reader:
+            for offset, span in bgzf_spans:
+                reader.seek_virtual(offset)
+                self.assertEqual(reader.read(len(span)), span)
+
+    def test_lookup(self):
+        """
+        lookup_annotations returns what a full pass over the XML file mines
+        """
+        expected = [(rcv, ms_id, annotations)
+                    for _, matches in mine_xml_sequential(
+                        self.xml_file, ALL_KEYS, pre_may_2017=True)
+                    for rcv, ms_id, annotations in matches]
+        for xml_file in (self.xml_file, self.bgzf_file):
+            self.assertEqual(build_offset_index(xml_file), 5)
+            self.assertTrue(os.path.exists(xml_file + '.offsets'))
+            for rcv, ms_id, annotations in expected:
+                self.assertEqual(list(lookup_annotations(xml_file, [rcv])),
+                                 [(rcv, rcv, ms_id, annotations)])
+                # a MeasureSet ID can be shared by several RCV records
+                self.assertEqual(
+                    list(lookup_annotations(xml_file, [ms_id])),
+                    [(ms_id, *record) for record in expected
+                     if record[1] == ms_id])
+            self.assertEqual(list(lookup_clinvar_sets(xml_file, ['1'])), [])
+        self.assertTrue(is_bgzf(self.bgzf_file))
+        self.assertFalse(is_bgzf(self.xml_file))
+
+    def test_lookup_errors(self):
+        """
+        the XML file must be seekable, indexed, and unchanged since
+        """
+        gz_file = str(Path(self.tempdir.name) / 'plain.xml.gz')
+        with open(gz_file, 'wb') as f:
+            f.write(zlib.compress(self.data, wbits=31))
+        with self.assertRaisesRegex(ValueError, 'bgzip'):
+            build_offset_index(gz_file)
+        with self.assertRaisesRegex(ValueError, 'index-offsets'):
+            list(lookup_clinvar_sets(self.xml_file, ['17661']))
+        build_offset_index(self.xml_file)
+        Path(self.xml_file).write_bytes(self.data + b'\n')
+        with self.assertRaisesRegex(ValueError, 'changed'):
+            list(lookup_clinvar_sets(self.xml_file, ['17661']))
+
+    def test_main_lookup(self):
+        """
+        clinvar_vcf_parser index-offsets and lookup
+        """
+        log = str(Path(self.tempdir.name) / 'log')
+        index_file = str(Path(self.tempdir.name) / 'index')
+        main(['index-offsets', '-x', self.bgzf_file, '-o', index_file,
+              '-l', log])
+        stdout = io.StringIO()
+        with contextlib.redirect_stdout(stdout):
+            main(['lookup', '-x', self.bgzf_file, '--offsets', index_file,
+                  '-l', log, '17661', 'RCV000193277', '1'])
+        returned = json.loads(stdout.getvalue())
+        self.assertEqual(list(returned), ['17661', 'RCV000193277', '1'])
+        self.assertEqual(
+            [record['rcv'] for record in returned['17661']],
+            ['RCV000159614'])
+        self.assertEqual(returned['1'], [])
+        self.assertEqual(
+            returned['RCV000193277'][0]['annotations']['CLNSCVA'],
+            ['SCV000247730', 'SCV000301122'])
+        stdout = io.StringIO()
+        with contextlib.redirect_stdout(stdout):
+            main(['lookup', '-x', self.bgzf_file, '--offsets', index_file,
+                  '-l', log, '--raw', 'RCV000193277'])
+        self.assertTrue(stdout.getvalue().startswith('<ClinVarSet'))
@@ -0,0 +1,135 @@
+import importlib.resources as pkg_resources
+import importlib.util
+import tempfile
+
+from datetime import date
+from pathlib import Path
+from unittest import TestCase, skipIf
+import xml.etree.ElementTree as ET
+
+from clinvar_vcf.annotation_index import build_index
+from clinvar_vcf.clinvar_vcf_parser import INFO_FIELDS, main
+from clinvar_vcf.scv_table import SCV_COLUMNS, ScvTableWriter, parse_date
+
+import tests.resources
+
+HAVE_PYARROW = importlib.util.find_spec('pyarrow') is not None
+
+
+@skipIf(not HAVE_PYARROW, 'pyarrow is not installed')
+class TestScvTable(TestCase):
+    """
+    Test the Parquet table of SCVs
+    """
+
+    def setUp(self):
+        self.tempdir = tempfile.TemporaryDirectory()
+        self.table_file = str(Path(self.tempdir.name) / 'scv.parquet')
+        with pkg_resources.path(
+                tests.resources,
+                'ClinVarFullRelease_2021-03_5_records.xml') as xmlpath:
+            self.xml_file = str(xmlpath)
+
+    def tearDown(self):
+        self.tempdir.cleanup()
+
+    def test_build_index_scv_table(self):
+        """
+        build-index --scv-table writes one row per SCV of the XML file
+        """
+        import pyarrow.parquet as pq
+        main(['build-index', '-x', self.xml_file,
+              '-o', str(Path(self.tempdir.name) / 'clinvar.idx'),
+              '-l', str(Path(self.tempdir.name) / 'build.log'),
+              '--scv-table', self.table_file])
+        table = pq.read_table(self.table_file)
+        self.assertEqual(table.column_names,
+                         [name for name, _, _ in SCV_COLUMNS])
+        root = ET.parse(self.xml_file).getroot()
+        self.assertEqual(
+            table.column('scv').to_pylist(),
+            [x.attrib['Acc'] for x in root.iterfind(
+                './ClinVarSet/ClinVarAssertion/ClinVarAccession')])
+        rows = table.to_pylist()
+        self.assertEqual(rows[6]['variation_id'], 17661)
+        self.assertEqual(rows[6]['rcv'], 'RCV000159614')
+        self.assertEqual(rows[6]['submitter'], 'Invitae')
+        self.assertEqual(rows[6]['date_last_evaluated'], date(2020, 10, 7))
+        self.assertIsNone(rows[3]['date_last_evaluated'])
+        self.assertIsNone(rows[3]['origin'])
+
+        # predicate pushdown on a dictionary-encoded column
+        pathogenic = pq.read_table(
+            self.table_file, columns=['scv'],
+            filters=[('significance', '=', 'Pathogenic')])
+        self.assertEqual(pathogenic.column('scv').to_pylist(),
+                         ['SCV000212601', 'SCV000253789'])
+
+    def test_build_index_scv_table_previous(self):
+        """
+        records copied from a previous index are in the SCV table too
+        """
+        import pyarrow.parquet as pq
+        previous = str(Path(self.tempdir.name) / 'previous.idx')
+        build_index(self.xml_file, previous, scv_table=self.table_file)
+        expected = pq.read_table(self.table_file)
+        build_index(self.xml_file,
+                    str(Path(self.tempdir.name) / 'clinvar.idx'),
+                    previous=previous, scv_table=self.table_file)
+        self.assertTrue(pq.read_table(self.table_file).equals(expected))
+
+    def test_build_index_scv_table_no_clinsig(self):
+        """
+        the significance of a record with a ClinVarAssertion without
+        ClinicalSignificance is null, the other columns staying aligned on
+        the SCVs
+        """
+        import pyarrow.parquet as pq
+        tree = ET.parse(self.xml_file)
+        for cva in tree.getroot().iterfind('./ClinVarSet/ClinVarAssertion'):
+            if cva.find('./ClinVarAccession').attrib['Acc'] == 'SCV000247730':
+                cva.remove(cva.find('./ClinicalSignificance'))
+        xml_file = str(Path(self.tempdir.name) / 'clinvar.xml')
+        tree.write(xml_file)
+        with self.assertLogs(level='WARNING') as logs:
+            build_index(xml_file,
+                        str(Path(self.tempdir.name) / 'clinvar.idx'),
+                        scv_table=self.table_file)
+        self.assertTrue(any('Record RCV000193277 has' in x
+                            for x in logs.output))
+        rows = [row for row in pq.read_table(self.table_file).to_pylist()
+                if row['rcv'] == 'RCV000193277']
+        self.assertEqual([row['scv'] for row in rows],
+                         ['SCV000247730', 'SCV000301122'])
+        self.assertEqual([row['submission_date'] for row in rows],
+                         [date(2015, 11, 2), date(2016, 7, 13)])
+        for name in ('significance', 'review_status', 'date_last_evaluated',
+                     'comment'):
+            self.assertEqual([row[name] for row in rows], [None, None])
+
+    def test_scv_table_writer(self):
+        """
+        ScvTableWriter writes a row group every row_group_size SCVs
+        """
+        import pyarrow.parquet as pq
+        annotations = {field: ['x', 'y'] for field in INFO_FIELDS}
+        annotations['CLNDATEA'] = ['2020-01-02', '0000-00-00']
+        with ScvTableWriter(self.table_file, row_group_size=3) as writer:
+            for ms_id in range(4):
+                writer.add(str(ms_id), f'RCV{ms_id}', annotations)
+        self.assertEqual(writer.n, 8)
+        parquet_file = pq.ParquetFile(self.table_file)
+        self.assertEqual(parquet_file.metadata.num_row_groups, 2)
+        table = parquet_file.read()
+        self.assertEqual(table.column('variation_id').to_pylist(),
+                         [0, 0, 1, 1, 2, 2, 3, 3])
+        self.assertEqual(table.column('date_last_evaluated').to_pylist(),
+                         [date(2020, 1, 2), None] * 4)
+
+    def test_parse_date(self):
+        """
+        parse_date returns None for missing dates
+        """
+        self.assertEqual(parse_date('2019-12-11'), date(2019, 12, 11))
+        self.assertIsNone(parse_date('0000-00-00'))
+        self.assertIsNone(parse_date(None))
@@ -0,0 +1,91 @@
+import importlib.resources as pkg_resources
+import os
+import random
+import tempfile
+
+from pathlib import Path
+from unittest import TestCase, mock
+
+from clinvar_vcf.clinvar_vcf_parser import Metrics, main
+from clinvar_vcf.sort_merge import ExternalSorter, join_sorted
+
+import tests.resources
+from tests.golden import assert_golden_outputs
+
+
+class TestSortMerge(TestCase):
+    """
+    Test the sort-merge mode
+    """
+
+    def test_expand_clinvar_vcfs_sort_merge(self):
+        """
+        sort_merge gets the same output whatever the memory cap
+        """
+        with tempfile.TemporaryDirectory() as tmp_dir:
+            # 1 byte: every record is written to its own run
+            for max_memory in (1, 1 << 20):
+                for metrics in assert_golden_outputs(
+                        self, n_vcfs=2, sort_merge=True,
+                        max_memory=max_memory, tmp_dir=tmp_dir):
+                    self.assertEqual(
+                        metrics.counters['clinvar_sets_processed'], 5)
+                self.assertEqual(os.listdir(tmp_dir), [])
+
+    def test_main_sort_merge(self):
+        """
+        --sort-merge and its options on the command line
+        """
+        with (
+            tempfile.TemporaryDirectory() as tempdir,
+            pkg_resources.path(
+                tests.resources,
+                'ClinVarFullRelease_2021-03_5_records.xml') as xmlpath,
+            pkg_resources.path(
+                tests.resources,
+                'clinvar_20210302_3_records.vcf') as vcfpath):
+            outfile = Path(tempdir) / 'parsed.vcf'
+            args = ['-x', str(xmlpath), '-i', str(vcfpath),
+                    '-o', str(outfile), '-l', str(Path(tempdir) / 'log'),
+                    '--sort-merge']
+            main([*args, '--max-memory', '1', '--tmp-dir', tempdir])
+            self.assertEqual(
+                outfile.read_text(),
+                pkg_resources.read_text(
+                    tests.resources,
+                    'clinvar_20210302_3_records_annotated.vcf'))
+            for wrong in (['--max-memory', '0'],
+                          ['--checkpoint', str(Path(tempdir) / 'ckpt')]):
+                with self.assertRaises(SystemExit):
+                    main([*args, *wrong])
+
+    def test_external_sorter(self):
+        """
+        ExternalSorter sorts items spilled to many runs, merging them in
+        several passes when there are more than MERGE_FAN_IN
+        """
+        items = [(str(random.randrange(1000)), i) for i in range(2000)]
+        with tempfile.TemporaryDirectory() as tempdir, \
+                mock.patch('clinvar_vcf.sort_merge.MERGE_FAN_IN', 3):
+            sorter = ExternalSorter(tempdir, max_memory=20000)
+            for item in items:
+                sorter.add(item, len(item[0]))
+            self.assertEqual(sorter.n, 2000)
+            self.assertGreater(len(sorter.runs), 9)
+            self.assertEqual(list(sorter.sorted()), sorted(items))
+            self.assertEqual(os.listdir(tempdir), [])
+
+    def test_join_sorted(self):
+        """
+        join_sorted yields each ClinVarSet record of the key_id of each VCF
+        record once
+        """
+        vcf_pairs = [('1', 0), ('2', 1), ('2', 1), ('2', 3), ('4', 2)]
+        clinvar_sets = [('0', 5, 'a'), ('2', 1, 'b'), ('2', 4, 'c'),
+                        ('3', 0, 'd'), ('4', 2, 'e')]
+        metrics = Metrics()
+        self.assertEqual(
+            list(join_sorted(vcf_pairs, clinvar_sets, metrics=metrics)),
+            [(1, 1, 'b'), (1, 4, 'c'), (3, 1, 'b'), (3, 4, 'c'),
+             (2, 2, 'e')])
+        self.assertEqual(metrics.counters['clinvar_sets_matched'], 3)